@@ -0,0 +1,169 @@
+"""
+Who gets in, and how fast they can talk
+
+- listen backlog: how many connections the kernel holds for us until we
+  accept them. the old listen(5) made connection storms fail for no reason
+- max connections: past this new clients are told the server is full and
+  closed right away, so a storm cant make an unlimited number of threads
+- max per ip: same, but per client address (0 = no limit)
+- message rate: every client has a token bucket, rate messages per second
+  with bursts of up to burst. messages over the limit are dropped and the
+  client is told (once, not for every dropped message)
+
+Everything here is a couple of additions and comparisons, the per message
+check doesnt take any lock. Rejections and drops are counted in metrics.py.
+
+A turned away client gets a server notice saying why. Just closing
+the socket right after sending it would often lose it (the client's name is
+still unread, so the close turns into a reset), so the threaded servers
+hand those sockets to one Bouncer thread that waits for the client to hang
+up first.
+"""
+
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+import metrics
+from protocol import notice
+
+DEFAULT_BACKLOG = 1024
+DEFAULT_MAX_CONNECTIONS = 10000
+DEFAULT_MAX_PER_IP = 0          # 0 = no limit
+DEFAULT_MESSAGE_RATE = 100.0    # messages per second per client, 0 = no limit
+DEFAULT_MESSAGE_BURST = 200
+REJECT_LINGER = 2.0             # seconds a turned away client has to read why
+
+SERVER_FULL = "Server is full, try again later."
+TOO_MANY_FROM_IP = "Too many connections from your address."
+SLOW_DOWN_FRAME = notice("You are sending messages too fast, some of them were dropped. "
+                         "Slow down!")
+
+
+def rejection_frame(reason):
+    return notice(reason)
+
+
+class Admission:
+    """counts connections in total and per ip, and hands out the token buckets"""
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, max_per_ip=DEFAULT_MAX_PER_IP,
+                 message_rate=DEFAULT_MESSAGE_RATE, message_burst=DEFAULT_MESSAGE_BURST):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        self.lock = threading.Lock()
+        self.total = 0
+        self.per_ip = {}
+        metrics.LIMIT_MAX_CONNECTIONS.set(max_connections)
+        metrics.LIMIT_MAX_PER_IP.set(max_per_ip)
+        metrics.LIMIT_MESSAGE_RATE.set(message_rate)
+        metrics.LIMIT_MESSAGE_BURST.set(message_burst)
+
+    def admit(self, ip):
+        """None if ip can connect (and counts it), otherwise why not"""
+        with self.lock:
+            if self.max_connections and self.total >= self.max_connections:
+                metrics.REJECTED_FULL.inc()
+                return SERVER_FULL
+            count = self.per_ip.get(ip, 0)
+            if self.max_per_ip and count >= self.max_per_ip:
+                metrics.REJECTED_PER_IP.inc()
+                return TOO_MANY_FROM_IP
+            self.total += 1
+            self.per_ip[ip] = count + 1
+            return None
+
+    def release(self, ip):
+        with self.lock:
+            self.total -= 1
+            count = self.per_ip.pop(ip) - 1
+            if count:
+                self.per_ip[ip] = count
+
+    def bucket(self, now):
+        return TokenBucket(self.message_rate, self.message_burst, now)
+
+
+class Bouncer:
+    """one thread that closes turned away connections politely"""
+
+    def __init__(self):
+        self.incoming = deque()
+        self.thread = None
+
+    def reject(self, conn, reason):
+        """sends the reason and half closes, the thread closes it properly later"""
+        try:
+            conn.setblocking(False)
+            conn.send(rejection_frame(reason))
+            conn.shutdown(socket.SHUT_WR)
+        except OSError:
+            conn.close()
+            return
+        self.incoming.append(conn)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="bouncer", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        sel = selectors.DefaultSelector()
+        deadlines = deque()  # (deadline, conn), in the order they came in
+        while True:
+            now = time.monotonic()
+            while self.incoming:
+                conn = self.incoming.popleft()
+                sel.register(conn, selectors.EVENT_READ)
+                deadlines.append((now + REJECT_LINGER, conn))
+            for key, _ in sel.select(timeout=0.1):
+                try:
+                    done = not key.fileobj.recv(4096)  # throw away whatever they sent
+                except OSError:
+                    done = True
+                if done:
+                    sel.unregister(key.fileobj)
+                    key.fileobj.close()
+            # everything still open after REJECT_LINGER gets closed anyway
+            while deadlines and (deadlines[0][0] <= now or deadlines[0][1].fileno() == -1):
+                _, conn = deadlines.popleft()
+                if conn.fileno() != -1:
+                    sel.unregister(conn)
+                    conn.close()
+
+
+class TokenBucket:
+    """rate tokens a second, holds at most burst. one per message"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'warned')
+
+    def __init__(self, rate=DEFAULT_MESSAGE_RATE, burst=DEFAULT_MESSAGE_BURST, now=0.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+        self.warned = False  # told them to slow down since they last got through
+
+    def allow(self, now):
+        if not self.rate:
+            return True
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+def over_limit(bucket, conn, now):
+    """True if this message has to be dropped, warns conn the first time"""
+    if bucket.allow(now):
+        bucket.warned = False
+        return False
+    metrics.RATE_LIMITED.inc()
+    if not bucket.warned:
+        bucket.warned = True
+        conn.send(SLOW_DOWN_FRAME)
+    return True
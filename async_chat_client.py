@@ -0,0 +1,164 @@
+"""
+Console chat client on one asyncio loop - stdin and the socket together, no threads
+
+Run it with:  python chat_client.py --engine asyncio
+
+When the connection drops (server restart, wifi gone for a bit) it doesnt
+give up, it reconnects on its own. Between tries it waits a random time up
+to 0.5s, 1s, 2s, ... (at most 30s), so when a server restarts its clients
+dont all come back at the same moment. Whatever you type in the meantime is
+queued and sent once it is connected again, and the hello asks for the room
+we were in and everything after the last message we saw (room= and since=,
+see protocol.py), so nothing is missed (as long as the server still has it).
+
+/send <path> and /get <id> run as tasks next to the chat (the transfer
+itself on a worker thread, see chat_sdk.AsyncClient.share), they are not
+queued while disconnected - they need the server right now.
+"""
+
+import asyncio
+import random
+import sys
+from collections import deque
+
+from chat_sdk import AsyncClient, file_command
+from framing import FrameError
+from protocol import BYE, ProtocolError
+
+RECONNECT_MIN = 0.5     # seconds, the first retry waits up to this long...
+RECONNECT_MAX = 30.0    # ...and it doubles every failed try, up to this
+MAX_OUTBOX = 1000       # messages kept while disconnected, the oldest go first
+
+
+def backoff(attempt):
+    """how long to wait before try number attempt (0, 1, ...), with full jitter"""
+    return random.uniform(0, min(RECONNECT_MAX, RECONNECT_MIN * 2 ** attempt))
+
+
+async def stdin_lines():
+    """yields what the user types without blocking the loop"""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    try:
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    except (ValueError, NotImplementedError, OSError):
+        # windows, or stdin is a plain file - a thread does the blocking read then
+        while True:
+            line = await loop.run_in_executor(None, sys.stdin.readline)
+            if not line:
+                return
+            yield line
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        yield line.decode('utf-8', errors='replace')
+
+
+class AsyncChatClient:
+    def __init__(self, host, port, name, tls=None):
+        self.host = host
+        self.port = port
+        self.name = name
+        self.tls = tls                  # the same context every time, so reconnects resume
+        self.client = None              # None while disconnected
+        self.outbox = deque(maxlen=MAX_OUTBOX)
+        self.room = None                # where we were, for the next hello
+        self.last_seq = None            # last message we saw in that room
+        self.stopped = asyncio.Event()  # said bye (or stdin ended)
+        self.transfers = set()          # running file transfer tasks
+
+    async def run(self):
+        typing = asyncio.ensure_future(self.read_input())
+        attempt = 0
+        try:
+            while not self.stopped.is_set():
+                client = AsyncClient(self.name, self.host, self.port, room=self.room,
+                                     since=self.last_seq, tls=self.tls)
+                try:
+                    await client.connect()
+                except (OSError, asyncio.TimeoutError) as e:
+                    delay = backoff(attempt)
+                    attempt += 1
+                    print(f"[Could not connect ({e}), trying again in {delay:.1f}s]")
+                    await self.pause(delay)
+                    continue
+                if await self.session(client):
+                    attempt = 0  # we really got in, start over with short waits
+                if not self.stopped.is_set():
+                    delay = backoff(attempt)
+                    attempt += 1
+                    print(f"[Disconnected from server, reconnecting in {delay:.1f}s]")
+                    await self.pause(delay)
+        finally:
+            typing.cancel()
+
+    async def pause(self, delay):
+        """sleeps, but wakes up right away if the user says bye meanwhile"""
+        try:
+            await asyncio.wait_for(self.stopped.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def session(self, client):
+        """one connection, from the hello until it drops. True if we got in"""
+        self.client = client
+        while self.outbox:
+            client.send_line(self.outbox.popleft())
+        try:
+            async for event in client:
+                if event.type == BYE:
+                    self.stopped.set()
+                shown = event.display()
+                if shown is not None:
+                    print(shown[0])
+        except (OSError, FrameError, ProtocolError) as e:
+            # OSError and not just ConnectionError: timeouts and tls errors
+            # (ssl.SSLError) are a dropped connection too, not a reason to quit
+            print(f"[Connection error: {e}]")
+        finally:
+            self.client = None
+            # the next hello asks for this room and what came after last_seq
+            self.room, self.last_seq = client.room, client.last_seq
+            await client.close(bye=False)
+        return client.id is not None
+
+    async def read_input(self):
+        async for line in stdin_lines():
+            line = line.strip()
+            if not line:
+                continue
+            transfer = file_command(line)
+            if transfer is not None:
+                self.start_transfer(transfer)
+                continue
+            bye = line.lower() == 'bye'
+            if self.client is not None:
+                self.client.send_line(line)
+            elif bye:
+                break  # nobody to say bye to
+            else:
+                self.outbox.append(line)
+                print("[Not connected, it goes out once we are back]")
+            if bye:
+                return  # the server answers with BYE and hangs up
+        self.stopped.set()  # stdin closed (or bye while disconnected)
+        if self.client is not None:
+            self.client.send_line('bye')
+
+    def start_transfer(self, transfer):
+        if self.client is None:
+            print("[Not connected, try that again once we are back]")
+            return
+        task = asyncio.ensure_future(self.client.transfer(*transfer, print))
+        self.transfers.add(task)  # the loop only keeps a weak reference
+        task.add_done_callback(self.transfers.discard)
+
+
+def run(host, port, name, tls=None):
+    """blocking entry point used by chat_client.main()"""
+    try:
+        asyncio.run(AsyncChatClient(host, port, name, tls).run())
+    except KeyboardInterrupt:
+        print("\n\nDisconnecting...")
+    print("Disconnected from chat.")
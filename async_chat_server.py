@@ -0,0 +1,393 @@
+"""
+Event loop version of the chat server - one asyncio loop serves every client
+instead of one thread per client. Same protocol as chat_server.py:
+first message is the name, then chat messages, 'bye' to leave.
+
+Run it with:  python chat_server.py --engine asyncio
+
+With --tls-cert the loop does the tls handshakes too, without blocking (the
+ssl module works on memory buffers here, see asyncio's sslproto), so a slow
+handshake only delays that one client. connection_made() comes after it.
+"""
+
+import asyncio
+import time
+from collections import deque
+
+import chatlog
+import metrics
+from admission import Admission, DEFAULT_BACKLOG, REJECT_LINGER, over_limit, rejection_frame
+from file_share import offer_frame
+from framing import DEFAULT_COMPRESS_LEVEL, DEFAULT_COMPRESS_MIN_SIZE, FrameDecoder, FrameError
+from heartbeat import DEFAULT_IDLE_TIMEOUT, DEFAULT_PING_INTERVAL, Reaper, enable_keepalive
+from history import RoomHistory
+from outbound import (DEFAULT_FLUSH_BYTES, DEFAULT_FLUSH_DELAY, DEFAULT_MAX_QUEUE,
+                      DISCONNECT, DROP_OLDEST, compressed_copy)
+from protocol import (BYE, BYE_FRAME, CHAT, COMMAND, HELLO, JOINED, LEFT, NAMED, OFFER,
+                      PING_FRAME, PONG, WELCOME, BodyText, ProtocolError, decode_message,
+                      encode_message, int_option, message_type, notice, parse_hello,
+                      relay_frame, sender_of, strip_body, wants_compression)
+from rooms import RoomIndex, handle_command, start_room
+from transport import (HANDSHAKE_TIMEOUT, close_unix, count_handshake, listen_unix, peer,
+                       peer_address)
+
+# once the transport has this much unsent data we stop handing it frames and
+# queue them ourselves instead, so the slow consumer policy can apply
+WRITE_HIGH_WATER = 64 * 1024
+
+# the reaper runs at least this often (seconds), it is one timer for everybody
+REAP_TICK = 1.0
+
+
+class ChatProtocol(asyncio.BufferedProtocol):
+    """one of these per connected client, the loop calls us when stuff happens
+
+    no thread and no coroutine per client, just a small object, so 10k idle
+    connections cost about 10k of these plus the kernel socket buffers
+
+    a BufferedProtocol, so the loop reads with recv_into() straight into our
+    decoder's buffer instead of handing us a new bytes object every time
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.addr = None
+        self.name = None
+        self.leaving = False
+        self.decoder = FrameDecoder()
+        # frames waiting for the next flush (write coalescing)
+        self.pending = []
+        self.pending_bytes = 0
+        self.flush_handle = None
+        # outbound queue, only used while the transport says it is full
+        self.queue = deque()
+        self.paused = False
+        self.dropped = 0
+        self.last_seen = time.monotonic()  # see heartbeat.py
+        self.admitted = False
+        self.bucket = None  # message rate limit, made once they said their name
+        self.compress = False  # asked for compressed broadcasts in the hello
+        self.id = 0  # sender id, see rooms.Senders
+        self.known = set()  # sender ids we already sent this client the name of
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=WRITE_HIGH_WATER)
+        self.addr = peer(transport.get_extra_info('peername'))
+        ssl_object = transport.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            count_handshake(ssl_object)
+        reason = self.server.admission.admit(peer_address(self.addr))
+        if reason is not None:
+            chatlog.warning('rejected', "[!] turned away {addr}: {reason}", addr=self.addr,
+                            reason=reason)
+            # say why, and give them a moment to read it before we hang up
+            # (closing with their name still unread would reset the connection)
+            transport.write(rejection_frame(reason))
+            transport.write_eof()
+            asyncio.get_running_loop().call_later(REJECT_LINGER, transport.abort)
+            return
+        self.admitted = True
+        enable_keepalive(transport.get_extra_info('socket'))
+        self.server.reaper.watch(self)
+        chatlog.info('connect', "[*] New connection from {addr}", addr=self.addr)
+
+    def get_buffer(self, sizehint):
+        return self.decoder.buffer()
+
+    def buffer_updated(self, nbytes):
+        if not self.admitted:
+            return  # not parsed, the space just gets reused
+        self.last_seen = time.monotonic()
+        try:
+            # views into the decoder's buffer, only good until we return
+            frames = self.decoder.received(nbytes, copy=False)
+            for frame in frames:
+                if self.leaving:
+                    return  # already said bye, ignore whatever is still in flight
+                msg = decode_message(frame)
+                if msg.type == PONG:
+                    continue  # heartbeat
+                if self.name is not None:
+                    metrics.MESSAGES_IN.inc()
+                    metrics.BYTES_IN.inc(len(frame))
+                self.handle_message(msg)
+        except (FrameError, ProtocolError, UnicodeDecodeError) as e:
+            chatlog.error('error', "[!] error with {who}: {error}", who=self.name or self.addr,
+                          error=e)
+            self.transport.close()
+
+    def handle_message(self, msg):
+        # first thing the client sends is their name (plus maybe some options)
+        if self.name is None:
+            if msg.type != HELLO:
+                self.transport.close()
+                return
+            self.name, options = parse_hello(msg.text)
+            self.compress = wants_compression(options)
+            self.bucket = self.server.admission.bucket(self.last_seen)
+            self.server.join(self, start_room(options), since=int_option(options, 'since'))
+            return
+
+        # check if client wants to leave
+        if msg.type == BYE:
+            chatlog.info('bye', "[-] {name} said bye, disconnecting them", name=self.name)
+            self.send(BYE_FRAME)
+            self.flush()
+            self.leaving = True
+            self.transport.close()  # sends whatever is still buffered first
+            return
+
+        if over_limit(self.bucket, self, self.last_seen):
+            return  # too fast, dropped (they get told once)
+
+        if msg.type == COMMAND:
+            server = self.server
+            handle_command(server.clients, self.name, self, msg.text, server.broadcast,
+                           server.direct, server.history)
+        elif msg.type == CHAT:
+            # normal message - goes to everyone in the same room, copied
+            # once into the frame that goes out and never decoded (see chat_server)
+            frame = relay_frame(CHAT, strip_body(msg.body), sender=self.id)
+            chatlog.info('message', "  {name}: {text}", name=self.name, text=BodyText(frame))
+            self.server.broadcast(frame, skip_name=self.name,
+                                  room=self.server.clients.room(self.name), record=True)
+        elif msg.type == OFFER:
+            self.server.share_file(self, msg.body)
+
+    def connection_lost(self, exc):
+        if self.leaving:
+            pass  # said bye, the client can be gone before our bye (or the tls close) gets there
+        elif isinstance(exc, ConnectionResetError):
+            chatlog.warning('reset', "[!] {who} connection was reset", who=self.name or self.addr)
+        elif exc is not None:
+            chatlog.error('error', "[!] error with {who}: {error}", who=self.name or self.addr,
+                          error=exc)
+
+        if not self.admitted:
+            return
+        self.server.admission.release(peer_address(self.addr))
+        if self.name is not None:
+            self.server.leave(self)
+
+    def send(self, frame):
+        """queue an encoded frame for this client, never blocks"""
+        if self.transport.is_closing():
+            return
+        if not self.paused:
+            # batch it up, the flush happens after flush_delay or as soon as
+            # there are flush_bytes waiting, whichever comes first
+            self.pending.append(frame)
+            self.pending_bytes += len(frame)
+            if self.pending_bytes >= self.server.flush_bytes:
+                self.flush()
+            elif self.flush_handle is None:
+                loop = asyncio.get_running_loop()
+                if self.server.flush_delay:
+                    self.flush_handle = loop.call_later(self.server.flush_delay, self.flush)
+                else:
+                    self.flush_handle = loop.call_soon(self.flush)
+            return
+
+        # client isnt reading fast enough, hold it in our own bounded queue
+        if len(self.queue) >= self.server.max_queue:
+            if self.server.policy == DISCONNECT:
+                chatlog.warning('slow', "[!] {name} is too slow, disconnecting them",
+                                name=self.name)
+                metrics.SLOW_KICKS.inc()
+                self.queue.clear()
+                self.transport.abort()
+                return
+            self.queue.popleft()
+            self.dropped += 1
+            metrics.FRAMES_DROPPED.inc()
+        self.queue.append(frame)
+
+    def depth(self):
+        """frames waiting on our side (the transport's own buffer isnt counted)"""
+        return len(self.pending) + len(self.queue)
+
+    def flush(self):
+        """hand everything pending to the transport in one go"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.pending or self.transport.is_closing():
+            return
+        frames = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+        metrics.FRAMES_SENT.inc(len(frames))
+        metrics.SEND_CALLS.inc()
+        self.transport.writelines(frames)
+
+    def pause_writing(self):
+        # the transport calls this when its buffer goes over the high water mark
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        if self.queue:
+            frames = list(self.queue)
+            self.queue.clear()
+            metrics.FRAMES_SENT.inc(len(frames))
+            metrics.SEND_CALLS.inc()
+            self.transport.writelines(frames)
+
+
+class AsyncChatServer:
+    """keeps track of who is connected and in which room
+
+    everything runs on the loop thread, so the RoomIndex lock is never contended
+    """
+
+    def __init__(self, max_queue=DEFAULT_MAX_QUEUE, policy=DROP_OLDEST,
+                 flush_bytes=DEFAULT_FLUSH_BYTES, flush_delay=DEFAULT_FLUSH_DELAY,
+                 compress_min_size=DEFAULT_COMPRESS_MIN_SIZE,
+                 compress_level=DEFAULT_COMPRESS_LEVEL,
+                 ping_interval=DEFAULT_PING_INTERVAL, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 backlog=DEFAULT_BACKLOG, admission=None,
+                 metrics_port=None, history=None, store=None, senders=None, spool=None):
+        self.clients = RoomIndex()  # name -> ChatProtocol, plus rooms
+        if senders is not None:
+            self.clients.senders = senders  # already has the ids from the message store
+        self.history = history if history is not None else RoomHistory()
+        self.store = store  # message_store.MessageStore or None
+        # uploads (file_share.Spool), None = no file sharing. the transfers
+        # themselves run on the file server's threads, not on the loop
+        self.spool = spool
+        self.backlog = backlog
+        self.admission = admission if admission is not None else Admission()
+        self.metrics_port = metrics_port
+        metrics.watch_clients(self.clients)
+        self.server = None
+        self.closing = False
+        self.max_queue = max_queue
+        self.policy = policy
+        self.flush_bytes = flush_bytes
+        self.flush_delay = flush_delay
+        self.compress_min_size = compress_min_size
+        self.compress_level = compress_level
+        # abort() skips the goodbye flush, connection_lost then does the leave
+        self.reaper = Reaper(ping=lambda proto: proto.send(PING_FRAME),
+                             kick=lambda proto: proto.transport.abort(),
+                             alive=lambda proto: not proto.transport.is_closing(),
+                             ping_interval=ping_interval, idle_timeout=idle_timeout)
+
+    def share_file(self, proto, body):
+        """OFFER - the file is in the spool already, tell the room about it"""
+        frame = offer_frame(self.spool, body, proto.id) if self.spool is not None else None
+        if frame is None:
+            proto.send(notice("That file isnt on the server (or file sharing is off)."))
+            return
+        chatlog.info('file', "  {name} shares a file", name=proto.name)
+        self.broadcast(frame, skip_name=proto.name, room=self.clients.room(proto.name),
+                       record=True)
+
+    def reap(self):
+        wait = self.reaper.expire()
+        asyncio.get_running_loop().call_later(min(wait or REAP_TICK, REAP_TICK), self.reap)
+
+    def join(self, proto, room, since=None):
+        proto.id = self.clients.senders.assign(proto.name)
+        proto.known.add(proto.id)
+        proto.send(encode_message(WELCOME, proto.name, sender=proto.id))
+        self.clients.add(proto.name, proto, room)  # the lobby, usually
+        chatlog.info('join', "[+] {name} joined the chat (from {addr})", name=proto.name,
+                     addr=proto.addr)
+        self.broadcast(encode_message(JOINED, proto.name, sender=proto.id), skip_name=proto.name,
+                       room=room)
+        self.history.send_catch_up(proto, room, since, self.clients.senders)
+
+    def leave(self, proto):
+        if self.closing:
+            return  # shutting down, no point telling anyone
+        # returns None if someone else reconnected with the same name
+        room = self.clients.remove(proto.name, proto)
+        if room is not None:
+            self.broadcast(encode_message(LEFT, proto.name, sender=proto.id), room=room)
+        chatlog.info('leave', "[-] {name} removed from chat", name=proto.name)
+
+    def broadcast(self, frame, skip_name=None, room=None, record=False):
+        """send an encoded message to everyone in room (everyone at all if room is
+        None) except skip_name. record=True keeps it in the room history"""
+        start = time.perf_counter()
+        seq = None
+        if record and room is not None:
+            seq, frame = self.history.record(room, frame)  # stamps the seq into the frame
+        targets = self.clients.members(room, skip=skip_name)
+        if message_type(frame) in NAMED:
+            self.clients.senders.introduce(targets, sender_of(frame))
+        packed, saved = compressed_copy(frame, targets, self.compress_level,
+                                        self.compress_min_size)
+        if packed is frame:
+            for proto in targets:
+                proto.send(frame)
+        else:
+            for proto in targets:
+                proto.send(packed if proto.compress else frame)
+        metrics.MESSAGES_OUT.inc(len(targets))
+        metrics.BYTES_OUT.inc(len(frame) * len(targets) - saved)
+        metrics.BROADCAST_SECONDS.observe(time.perf_counter() - start)
+        # persisting is the next stage, it only queues the frame for the store's thread
+        if seq is not None and self.store is not None:
+            self.store.append(room, seq, frame)
+
+    def direct(self, target, frame):
+        proto = self.clients.get(target)
+        if proto is None:
+            return False
+        self.clients.senders.introduce((proto,), sender_of(frame))
+        proto.send(frame)
+        return True
+
+    async def serve(self, host, port, unix_path=None, tls=None):
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(
+            lambda: ChatProtocol(self), host, port,
+            reuse_address=True, backlog=self.backlog,
+            ssl=tls, ssl_handshake_timeout=HANDSHAKE_TIMEOUT if tls else None)
+        unix_server = None
+        if unix_path:
+            # same protocol objects, same loop, same registry
+            unix_sock = listen_unix(unix_path, self.backlog)
+            unix_server = await loop.create_unix_server(
+                lambda: ChatProtocol(self), sock=unix_sock, backlog=self.backlog)
+        self.reap()
+
+        print(f"Server started on {host}:{port} (asyncio engine{', tls' if tls else ''})")
+        if unix_server is not None:
+            print(f"Also listening on unix:{unix_path}")
+        if self.metrics_port:
+            # the http endpoint runs on its own thread, scrapes just read the numbers
+            metrics.serve(self.metrics_port)
+            print(f"Metrics on http://127.0.0.1:{self.metrics_port}/metrics")
+        print("Waiting for connections...")
+        print("(press Ctrl+C to stop)\n")
+
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            if unix_server is not None:
+                unix_server.close()
+                close_unix(unix_sock, unix_path)
+            self.close_all()
+
+    def close_all(self):
+        self.closing = True
+        for proto in self.clients.all_connections():
+            proto.transport.abort()
+        self.clients.clear()
+
+
+def run(host, port, unix_path=None, tls=None, **options):
+    """blocking entry point used by chat_server.main(), options go to AsyncChatServer"""
+    chat = AsyncChatServer(**options)
+    try:
+        asyncio.run(chat.serve(host, port, unix_path, tls))
+    except KeyboardInterrupt:
+        print("\n\nShutting down server...")
+    chatlog.LOGGER.close()
+    print("Server stopped.")
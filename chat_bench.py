@@ -0,0 +1,751 @@
+"""
+Load generator / latency benchmark for the chat server
+
+Starts chat_server.py itself (--spawn) or talks to one that is already
+running, connects lots of simulated clients that speak the real protocol
+(name first, then framed messages) and has some of them send timestamped
+messages. Every client that gets a message works out how long it took from
+send to receive, so the latency numbers are end to end fan-out latency.
+
+    python chat_bench.py --spawn --clients 2000 --senders 20 --rate 50 --duration 10
+    python chat_bench.py --spawn --server-args "--engine asyncio" --out asyncio.json
+    python chat_bench.py --clients 500 --server-pid 1234      (already running server)
+    python chat_bench.py --spawn --metrics-port 9100          (+ server side counters)
+    python chat_bench.py --spawn --message-size 4000 --compress   (bandwidth vs cpu)
+    python chat_bench.py --spawn --churn 200 --metrics-port 9100  (join storm during the run)
+    python chat_bench.py --spawn --unix /tmp/chat.sock --compare-transports   (tcp vs unix socket)
+    python chat_bench.py --spawn --compare-tls                (plain vs tls vs resumed tls)
+    python chat_bench.py --spawn --hot-restart 2              (new server takes over mid run)
+
+Prints a summary and writes the full results as JSON (--out) so runs can be
+compared. Everything is localhost only.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import transport
+from framing import FrameDecoder, FrameError
+from protocol import (CHAT, COMPRESSION, PING, PONG_FRAME, ProtocolError, decode_message,
+                      encode_message, hello_frame)
+
+HOST = '127.0.0.1'
+PORT = 12345
+
+# marker for benchmark messages, the rest of the message is the send time in ns
+MARK = b'#bench '
+
+# --message-size pads messages with this, repetitive like pasted logs or bot output
+FILLER = "2024-05-01 12:00:00 INFO worker-3 request handled in 12ms status=200 path=/api/items\n"
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat_server.py')
+
+# server counters we report the change of over the sending phase (see metrics.py)
+SERVER_COUNTERS = ('chat_messages_in_total', 'chat_messages_out_total', 'chat_bytes_out_total',
+                   'chat_send_calls_total', 'chat_frames_sent_total',
+                   'chat_frames_dropped_total', 'chat_compressed_frames_total',
+                   'chat_compression_saved_bytes_total',
+                   # contention: joins/leaves waiting for the registry lock, time per broadcast
+                   'chat_registry_lock_wait_seconds_sum', 'chat_registry_lock_wait_seconds_count',
+                   'chat_broadcast_seconds_sum', 'chat_broadcast_seconds_count')
+
+# --churn clients stay connected this long (seconds) before they hang up
+CHURN_STAY = 1.0
+
+# the self-signed certificate --spawn makes for --tls, made with the openssl command
+OPENSSL = 'openssl'
+CERT_DAYS = 1
+
+# --hot-restart: seconds the old server gets to hand over and exit
+RESTART_TIMEOUT = 30.0
+
+
+def percentile(sorted_values, p):
+    """nearest rank percentile, p between 0 and 100"""
+    if not sorted_values:
+        return None
+    k = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[k]
+
+
+def read_rss(pid):
+    """(current rss, peak rss) of a process in kB from /proc, None if we cant tell"""
+    if pid is None:
+        return None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return {
+            'rss_kb': int(fields['VmRSS'].split()[0]),
+            'peak_rss_kb': int(fields['VmHWM'].split()[0]),
+        }
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def read_cpu(pid):
+    """user + system cpu seconds a process has used so far, None if we cant tell"""
+    if pid is None:
+        return None
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # the name in () can have spaces, the numbers start after it
+            fields = f.read().rpartition(')')[2].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def scrape_metrics(host, port):
+    """unlabeled samples from the server's /metrics endpoint, None if it isnt there"""
+    if not port:
+        return None
+    try:
+        with urllib.request.urlopen(f"http://{host}:{port}/metrics", timeout=2) as resp:
+            text = resp.read().decode('utf-8')
+    except OSError:
+        return None
+    values = {}
+    for line in text.splitlines():
+        if line.startswith('#') or '{' in line:
+            continue
+        name, _, value = line.partition(' ')
+        try:
+            values[name] = float(value)
+        except ValueError:
+            pass
+    return values
+
+
+def counter_deltas(before, after):
+    if before is None or after is None:
+        return None
+    deltas = {name: after.get(name, 0) - before.get(name, 0) for name in SERVER_COUNTERS}
+    # how well write coalescing works - 1.0 means one syscall per frame
+    calls = deltas['chat_send_calls_total']
+    deltas['frames_per_send_call'] = (round(deltas['chat_frames_sent_total'] / calls, 2)
+                                      if calls else None)
+    deltas['lock_wait_mean_us'] = _mean_us(deltas, 'chat_registry_lock_wait_seconds')
+    deltas['broadcast_mean_us'] = _mean_us(deltas, 'chat_broadcast_seconds')
+    return deltas
+
+
+def _mean_us(deltas, histogram):
+    count = deltas[histogram + '_count']
+    return round(deltas[histogram + '_sum'] / count * 1e6, 2) if count else None
+
+
+def raise_fd_limit():
+    """thousands of clients need thousands of file descriptors"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class BenchClient:
+    """one simulated user"""
+
+    def __init__(self, bench, index):
+        self.bench = bench
+        self.name = f"bench{index}"
+        self.reader = None
+        self.writer = None
+        self.decoder = FrameDecoder()
+        self.received = 0
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await transport.open_connection(host, port, self.bench.tls)
+        ssl_object = self.writer.get_extra_info('ssl_object')
+        if ssl_object is not None and ssl_object.session_reused:
+            self.bench.resumed += 1
+        compress = COMPRESSION if self.bench.args.compress else None
+        self.writer.write(hello_frame(self.name, compress=compress))
+        await self.writer.drain()
+
+    def send_text(self, text):
+        self.writer.write(encode_message(CHAT, text))
+
+    async def read_loop(self):
+        latencies = self.bench.latencies
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    self.bench.lost(self)
+                    return
+                now = time.perf_counter_ns()
+                self.bench.wire_bytes_in += len(data)
+                for frame in self.decoder.feed(data):
+                    msg = decode_message(frame)
+                    if msg.type == PING:
+                        self.writer.write(PONG_FRAME)  # answer it like a real client
+                        continue
+                    self.bench.bytes_in += len(frame)
+                    if msg.type != CHAT:
+                        continue  # names, notices
+                    self.received += 1
+                    i = msg.body.find(MARK)
+                    if i >= 0:
+                        latencies.append(now - int(msg.body[i + len(MARK):]))
+                        self.bench.arrived(now)
+        except (ConnectionError, FrameError, ProtocolError, ValueError):
+            self.bench.lost(self)
+            return
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.transport.abort()
+
+
+class Bench:
+    def __init__(self, args, host=None, tls=None, resume=False, restart=None):
+        self.args = args
+        self.host = host or args.host  # where the clients connect, maybe unix:PATH
+        self.tls = tls          # a transport.client_context() for a tls server
+        self.resume = resume    # every client offers the session of a warm up connection
+        self.resumed = 0        # connects that resumed a session
+        self.clients = []
+        self.latencies = []  # ns, one entry per delivered benchmark message
+        self.sent = 0
+        self.bytes_in = 0       # message bytes after decompressing
+        self.wire_bytes_in = 0  # what actually came over the sockets
+        # the padding goes in front, the timestamp has to stay at the end
+        size = args.message_size
+        self.padding = (FILLER * (size // len(FILLER) + 1))[:size]
+        self.churn_joins = 0
+        self.churn_failed = 0
+        # --hot-restart: restart() starts the next server and waits for the
+        # old one to go, returns (new pid, seconds it took)
+        self.restart = restart
+        self.restart_seconds = None
+        self.closing = False
+        self.disconnects = 0    # clients the server hung up on
+        self.last_arrival = None
+        self.longest_pause = 0  # ns, the longest nobody got a benchmark message
+
+    async def connect_all(self):
+        args = self.args
+        sem = asyncio.Semaphore(args.connect_concurrency)
+        failures = 0
+
+        async def one(i):
+            nonlocal failures
+            client = BenchClient(self, i)
+            async with sem:
+                try:
+                    await client.connect(self.host, args.port)
+                except OSError:
+                    failures += 1
+                    return None
+            return client
+
+        start = time.perf_counter()
+        server_cpu_start = read_cpu(args.server_pid)
+        results = await asyncio.gather(*(one(i) for i in range(args.clients)))
+        elapsed = time.perf_counter() - start
+        server_cpu = cpu_since(server_cpu_start, args.server_pid)
+        self.clients = [c for c in results if c is not None]
+        return {
+            'clients': len(self.clients),
+            'failed': failures,
+            'resumed': self.resumed,
+            'seconds': round(elapsed, 4),
+            'per_sec': round(len(self.clients) / elapsed, 1) if elapsed else None,
+            # mostly the tls handshakes when there are some
+            'server_cpu_us_per_connect': (round(server_cpu / len(self.clients) * 1e6, 1)
+                                          if server_cpu is not None and self.clients else None),
+        }
+
+    async def warm_up(self):
+        """--tls-resume: connects once so the context has a session for the
+        real clients to resume. tls 1.3 sends the ticket after the handshake,
+        it is there once the welcome is"""
+        client = BenchClient(self, 'warmup')
+        await client.connect(self.host, self.args.port)
+        await client.reader.read(65536)
+        self.tls.remember(client.writer.get_extra_info('ssl_object'))
+        client.close()
+        self.resumed = 0
+
+    def lost(self, client):
+        if not self.closing:
+            self.disconnects += 1
+
+    def arrived(self, now):
+        if self.last_arrival is not None:
+            self.longest_pause = max(self.longest_pause, now - self.last_arrival)
+        self.last_arrival = now
+
+    async def hot_restart(self, at):
+        """--hot-restart: the next server takes over at `at`, while the load runs"""
+        await asyncio.sleep(max(0.0, at - time.perf_counter()))
+        pid, self.restart_seconds = await asyncio.to_thread(self.restart)
+        self.args.server_pid = pid
+
+    async def sender(self, client, interval, stop_at):
+        next_send = time.perf_counter()
+        while True:
+            now = time.perf_counter()
+            if now >= stop_at:
+                return
+            # catch up if we fell behind instead of drifting
+            while next_send <= now:
+                client.send_text(f"{self.padding}#bench {time.perf_counter_ns()}")
+                self.sent += 1
+                next_send += interval
+            try:
+                await client.writer.drain()
+            except ConnectionError:
+                return  # the server hung up on it (counted in disconnects)
+            await asyncio.sleep(min(next_send, stop_at) - time.perf_counter())
+
+    async def churn_one(self, index):
+        client = BenchClient(self, index)
+        try:
+            await client.connect(self.host, self.args.port)
+        except OSError:
+            self.churn_failed += 1
+            return
+        self.churn_joins += 1
+        await asyncio.sleep(CHURN_STAY)
+        client.close()  # never reads, it is only there to join and leave
+
+    async def churn(self, stop_at):
+        """--churn: extra clients joining and leaving the whole time (a join
+        storm next to the traffic), so the latency shows if it stalls delivery"""
+        interval = 1.0 / self.args.churn
+        index = self.args.clients  # names after the normal clients
+        tasks = []
+        next_join = time.perf_counter()
+        while next_join < stop_at:
+            while next_join <= time.perf_counter():
+                tasks.append(asyncio.ensure_future(self.churn_one(index)))
+                index += 1
+                next_join += interval
+            await asyncio.sleep(max(0.0, min(next_join, stop_at) - time.perf_counter()))
+        await asyncio.gather(*tasks)
+
+    async def run(self):
+        args = self.args
+        results = {'config': vars(args).copy(), 'transport': self.host,
+                   'tls': ('resumed' if self.resume else 'full') if self.tls else None}
+
+        results['server_before'] = read_rss(args.server_pid)
+        if self.resume:
+            await self.warm_up()
+        results['connect'] = await self.connect_all()
+        if not self.clients:
+            results['error'] = "no client could connect"
+            return results
+
+        readers = [asyncio.ensure_future(c.read_loop()) for c in self.clients]
+
+        # let the join notices settle so they dont count as load
+        await asyncio.sleep(args.settle)
+        results['server_connected'] = read_rss(args.server_pid)
+        for c in self.clients:
+            c.received = 0
+        # the history replay on join can carry benchmark messages of an
+        # earlier run against the same server, those dont count
+        self.latencies.clear()
+        self.bytes_in = 0
+        self.wire_bytes_in = 0
+        self.last_arrival = None
+        self.longest_pause = 0
+        metrics_before = scrape_metrics(args.host, args.metrics_port)
+
+        senders = self.clients[:args.senders]
+        start = time.perf_counter()
+        stop_at = start + args.duration
+        cpu_start = time.process_time()
+        server_cpu_start = read_cpu(args.server_pid)
+        load = [self.sender(c, 1.0 / args.rate, stop_at) for c in senders]
+        if args.churn:
+            load.append(self.churn(stop_at))
+        if self.restart is not None:
+            load.append(self.hot_restart(start + args.hot_restart))
+        await asyncio.gather(*load)
+        send_elapsed = time.perf_counter() - start
+
+        # give the last messages time to arrive
+        await asyncio.sleep(args.drain)
+        elapsed = time.perf_counter() - start
+        # across a restart the cpu and counters are two processes', we only
+        # see the new one
+        restarted = self.restart_seconds is not None
+        server_cpu = cpu_since(server_cpu_start, args.server_pid) if not restarted else None
+        bench_cpu = time.process_time() - cpu_start
+        results['server_after'] = read_rss(args.server_pid)
+        results['server_counters'] = (counter_deltas(
+            metrics_before, scrape_metrics(args.host, args.metrics_port))
+            if not restarted else None)
+
+        self.closing = True
+        for c in self.clients:
+            c.close()
+        for t in readers:
+            t.cancel()
+
+        # every message goes to everyone in the room except the sender
+        expected = self.sent * (len(self.clients) - 1)
+        delivered = len(self.latencies)
+        lat = sorted(self.latencies)
+        ms = lambda ns: None if ns is None else round(ns / 1e6, 3)
+        results['messages'] = {
+            'sent': self.sent,
+            'sent_per_sec': round(self.sent / send_elapsed, 1),
+            'expected_deliveries': expected,
+            'delivered': delivered,
+            'delivered_per_sec': round(delivered / elapsed, 1),
+            'delivery_ratio': round(delivered / expected, 4) if expected else None,
+            'bytes_in': self.bytes_in,
+            # what compression saves: bytes on the wire per message delivered
+            'wire_bytes_in': self.wire_bytes_in,
+            'wire_bytes_per_delivery': (round(self.wire_bytes_in / delivered, 1)
+                                        if delivered else None),
+            'wire_mb_per_sec': round(self.wire_bytes_in / elapsed / 1e6, 3),
+            # clients that got nothing at all - usually ones the server never
+            # accepted (listen backlog overflow) even though connect() worked
+            'silent_clients': sum(1 for c in self.clients if c.received == 0),
+            'disconnects': self.disconnects,
+        }
+        results['latency_ms'] = {
+            'p50': ms(percentile(lat, 50)),
+            'p99': ms(percentile(lat, 99)),
+            'p999': ms(percentile(lat, 99.9)),
+            'max': ms(lat[-1] if lat else None),
+        }
+        if self.restart is not None:
+            results['hot_restart'] = {
+                'at': args.hot_restart,
+                # from starting the new server until the old one is gone
+                'seconds': (round(self.restart_seconds, 3)
+                            if self.restart_seconds is not None else None),
+                'longest_pause_ms': ms(self.longest_pause),
+            }
+        if args.churn:
+            results['churn'] = {
+                'joins': self.churn_joins,
+                'failed': self.churn_failed,
+                'joins_per_sec': round(self.churn_joins / send_elapsed, 1),
+            }
+        results['bench_cpu_seconds'] = round(bench_cpu, 3)
+        # ...and what it costs, both ends burn cpu on it
+        results['server_cpu_seconds'] = round(server_cpu, 3) if server_cpu is not None else None
+        # per message delivered, what tls (or compression) adds to every one
+        if delivered:
+            results['cpu_us_per_delivery'] = {
+                'server': round(server_cpu / delivered * 1e6, 2) if server_cpu is not None else None,
+                'bench': round(bench_cpu / delivered * 1e6, 2),
+            }
+        return results
+
+
+def cpu_since(start, pid):
+    """cpu seconds pid used since read_cpu() said start, None if we cant tell"""
+    end = read_cpu(pid)
+    if start is None or end is None:
+        return None
+    return end - start
+
+
+def wait_for_port(host, port, timeout=10.0, tls=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            transport.connect(host, port, 0.5, tls).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def make_certificate(directory):
+    """a self-signed certificate for localhost in directory, (cert, key)"""
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    cmd = [OPENSSL, 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+           '-nodes', '-days', str(CERT_DAYS), '-subj', '/CN=localhost',
+           '-addext', f'subjectAltName=IP:{HOST},DNS:localhost', '-keyout', key, '-out', cert]
+    try:
+        subprocess.run(cmd, check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise SystemExit(f"couldnt make a certificate with {OPENSSL} ({e}), start the "
+                         f"server yourself and pass --cafile")
+    return cert, key
+
+
+def spawn_server(args, certificate=None, tls=None, handoff=None, successor=False):
+    """starts chat_server.py, with --tls-cert when certificate (cert, key) is
+    given. tls is the client context to check it is up with. handoff is the
+    --handoff path, successor=True for a server taking over from the one
+    there (the port is up already then, no waiting for it)"""
+    cmd = [sys.executable, SERVER_SCRIPT] + shlex.split(args.server_args)
+    if args.metrics_port:
+        cmd += ['--metrics-port', str(args.metrics_port)]
+    if args.unix:
+        cmd += ['--unix', args.unix]
+    if certificate:
+        cmd += ['--tls-cert', certificate[0], '--tls-key', certificate[1]]
+    if handoff:
+        cmd += ['--handoff', handoff]
+    # server output goes nowhere, printing every message would be the bottleneck
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if successor:
+        return proc
+    ready = wait_for_port(args.host, args.port, tls=tls)
+    if ready and args.unix:
+        ready = wait_for_port(transport.UNIX_PREFIX + args.unix, args.port)
+    if not ready:
+        proc.kill()
+        raise SystemExit("server didnt start listening in time")
+    return proc
+
+
+def stop_server(proc):
+    proc.send_signal(subprocess.signal.SIGINT)
+    try:
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def print_summary(r):
+    c, m, lat = r['connect'], r.get('messages', {}), r.get('latency_ms', {})
+    print(f"connected   {c['clients']} clients in {c['seconds']}s ({c['per_sec']}/s), {c['failed']} failed"
+          + (f", {c['resumed']} resumed tls" if c['resumed'] else ""))
+    if c['server_cpu_us_per_connect'] is not None:
+        print(f"connect cpu server {c['server_cpu_us_per_connect']} us per client")
+    if m:
+        print(f"sent        {m['sent']} messages ({m['sent_per_sec']}/s)")
+        print(f"delivered   {m['delivered']} of {m['expected_deliveries']} "
+              f"({m['delivered_per_sec']}/s, ratio {m['delivery_ratio']}), "
+              f"{m['silent_clients']} clients got nothing")
+        print(f"latency ms  p50 {lat['p50']}  p99 {lat['p99']}  p999 {lat['p999']}  max {lat['max']}")
+        print(f"bandwidth   {m['wire_bytes_in']} bytes received ({m['wire_mb_per_sec']} MB/s, "
+              f"{m['wire_bytes_per_delivery']} per message, {m['bytes_in']} uncompressed)")
+    if 'bench_cpu_seconds' in r:
+        server = r['server_cpu_seconds']
+        print(f"cpu         server {'?' if server is None else f'{server}s'}, "
+              f"bench {r['bench_cpu_seconds']}s")
+    if r.get('cpu_us_per_delivery'):
+        per = r['cpu_us_per_delivery']
+        print(f"per message server {per['server']} us, bench {per['bench']} us")
+    counters = r.get('server_counters')
+    if counters:
+        print(f"server      {int(counters['chat_frames_sent_total'])} frames in "
+              f"{int(counters['chat_send_calls_total'])} send calls "
+              f"({counters['frames_per_send_call']} per call), "
+              f"{int(counters['chat_frames_dropped_total'])} dropped, "
+              f"{int(counters['chat_compressed_frames_total'])} compressed")
+        print(f"contention  {int(counters['chat_registry_lock_wait_seconds_count'])} registry "
+              f"lock waits, mean {counters['lock_wait_mean_us']} us, "
+              f"broadcast mean {counters['broadcast_mean_us']} us")
+    if r.get('churn'):
+        ch = r['churn']
+        print(f"churn       {ch['joins']} joins+leaves ({ch['joins_per_sec']}/s), "
+              f"{ch['failed']} failed")
+    if r.get('hot_restart'):
+        hr = r['hot_restart']
+        print(f"hot restart at {hr['at']}s took {hr['seconds']}s, {m['disconnects']} clients "
+              f"disconnected, longest pause in delivery {hr['longest_pause_ms']} ms")
+    elif m.get('disconnects'):
+        print(f"disconnects {m['disconnects']} clients lost their connection")
+    for key in ('server_before', 'server_connected', 'server_after'):
+        if r.get(key):
+            print(f"{key:<18}rss {r[key]['rss_kb']} kB (peak {r[key]['peak_rss_kb']} kB)")
+
+
+def print_comparison(runs):
+    """--compare-transports/--compare-tls: the main numbers of the runs side by side"""
+    rows = [('connects/s', lambda r: r['connect']['per_sec']),
+            ('srv us/connect', lambda r: r['connect']['server_cpu_us_per_connect']),
+            ('latency p50 ms', lambda r: r['latency_ms']['p50']),
+            ('latency p99 ms', lambda r: r['latency_ms']['p99']),
+            ('delivered/s', lambda r: r['messages']['delivered_per_sec']),
+            ('server cpu s', lambda r: r['server_cpu_seconds']),
+            ('bench cpu s', lambda r: r['bench_cpu_seconds']),
+            ('srv us/msg', lambda r: r['cpu_us_per_delivery']['server']),
+            ('bench us/msg', lambda r: r['cpu_us_per_delivery']['bench'])]
+    names = list(runs)
+    print(f"\n{'':<16}" + "".join(f"{name:>12}" for name in names))
+    for label, get in rows:
+        try:
+            values = [get(runs[name]) for name in names]
+        except KeyError:
+            continue  # a run that didnt get that far
+        line = f"{label:<16}" + "".join(f"{v!s:>12}" for v in values)
+        first = values[0]
+        if first:  # how the other runs compare to the first one
+            line += "  " + "".join(f" {(v - first) / first * 100:+.0f}%" for v in values[1:]
+                                   if v is not None)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="chat server load generator")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--spawn', action='store_true',
+                        help="start chat_server.py ourselves (and stop it at the end)")
+    parser.add_argument('--server-args', default='',
+                        help="extra arguments for the spawned server, e.g. \"--engine asyncio\"")
+    parser.add_argument('--server-pid', type=int, default=None,
+                        help="pid of an already running server, for memory numbers")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="scrape the server's metrics endpoint on this port "
+                             "(with --spawn the server is started with it)")
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--senders', type=int, default=10,
+                        help="how many of the clients send messages")
+    parser.add_argument('--rate', type=float, default=20.0,
+                        help="messages per second per sender")
+    parser.add_argument('--message-size', type=int, default=0,
+                        help="pad every message with this many bytes of log-like text")
+    parser.add_argument('--compress', action='store_true',
+                        help="clients ask the server for compressed messages")
+    parser.add_argument('--churn', type=float, default=0,
+                        help="extra clients joining (and leaving again) per second while "
+                             "sending, to see if a join storm holds up delivery")
+    parser.add_argument('--duration', type=float, default=5.0, help="seconds of sending")
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help="seconds to wait after connecting before sending")
+    parser.add_argument('--drain', type=float, default=1.0,
+                        help="seconds to wait for messages still in flight at the end")
+    parser.add_argument('--connect-concurrency', type=int, default=200,
+                        help="max connects in progress at once")
+    parser.add_argument('--unix', default=None, metavar='PATH',
+                        help="connect over the server's unix socket at PATH instead of tcp "
+                             "(with --spawn the server is started with --unix PATH)")
+    parser.add_argument('--compare-transports', action='store_true',
+                        help="run twice against the same server, over tcp and then over "
+                             "the --unix socket, and compare")
+    parser.add_argument('--tls', action='store_true',
+                        help="connect with tls (with --spawn the server gets a self-signed "
+                             "certificate made for the run)")
+    parser.add_argument('--tls-resume', action='store_true',
+                        help="with --tls, the clients resume the session of a warm up "
+                             "connection instead of doing the full handshake")
+    parser.add_argument('--cafile', default=None,
+                        help="the certificate of a running tls server to trust "
+                             "(without it the bench trusts any)")
+    parser.add_argument('--compare-tls', action='store_true',
+                        help="run plain, with tls and with resumed tls and compare, the "
+                             "server is restarted in between (needs --spawn)")
+    parser.add_argument('--hot-restart', type=float, default=None, metavar='SECONDS',
+                        help="this many seconds into sending, start a second server that "
+                             "takes over from the first (chat_server.py --handoff), to see "
+                             "what the clients notice (needs --spawn)")
+    parser.add_argument('--out', help="write the results as JSON to this file")
+    args = parser.parse_args()
+    args.senders = min(args.senders, args.clients)
+    if args.compare_transports and not args.unix:
+        parser.error("--compare-transports needs --unix")
+    if args.compare_tls and not args.spawn:
+        parser.error("--compare-tls needs --spawn, plain and tls need a server each")
+    if args.compare_tls and args.compare_transports:
+        parser.error("one of --compare-tls and --compare-transports at a time")
+    if args.hot_restart is not None and (not args.spawn or args.compare_tls
+                                         or args.compare_transports):
+        parser.error("--hot-restart needs --spawn and a single run")
+    if args.tls_resume:
+        args.tls = True
+
+    raise_fd_limit()
+
+    # name -> (where the clients connect, tls: None, 'full' or 'resume')
+    unix = transport.UNIX_PREFIX + args.unix if args.unix else None
+    tls = ('resume' if args.tls_resume else 'full') if args.tls else None
+    if args.compare_transports:
+        plan = {'tcp': (args.host, tls), 'unix': (unix, None)}
+    elif args.compare_tls:
+        plan = {'plain': (args.host, None), 'tls': (args.host, 'full'),
+                'resumed': (args.host, 'resume')}
+    else:
+        plan = {'run': (unix or args.host, tls)}
+
+    certificate = None
+    work_dir = tempfile.TemporaryDirectory()  # the certificate, the handoff socket
+    any_tls = any(mode for _, mode in plan.values())
+    if args.spawn and any_tls:
+        certificate = make_certificate(work_dir.name)
+    handoff = (os.path.join(work_dir.name, 'handoff.sock')
+               if args.hot_restart is not None else None)
+    cafile = certificate[0] if certificate else args.cafile
+
+    def context():
+        # a fresh one per run, a session left over from the run before
+        # would make the full handshakes resume
+        return transport.client_context(cafile, verify=cafile is not None)
+
+    proc = None
+    proc_tls = None
+    runs = {}
+
+    def hot_restart():
+        nonlocal proc
+        old = proc
+        start = time.perf_counter()
+        proc = spawn_server(args, certificate if proc_tls else None, handoff=handoff,
+                            successor=True)
+        try:
+            old.wait(RESTART_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            old.kill()
+            return proc.pid, None
+        return proc.pid, time.perf_counter() - start
+
+    try:
+        for name, (host, mode) in plan.items():
+            client_tls = context() if mode else None
+            # --compare-tls switches between a plain and a tls server, the
+            # rest use one server for all runs
+            server_tls = bool(mode) if args.compare_tls else any_tls
+            if args.spawn and (proc is None or proc_tls != server_tls):
+                if proc is not None:
+                    stop_server(proc)
+                proc = spawn_server(args, certificate if server_tls else None,
+                                    context() if server_tls else None, handoff)
+                proc_tls = server_tls
+                args.server_pid = proc.pid
+            elif runs:
+                time.sleep(args.settle)  # let the server see the last clients leave
+            restart = hot_restart if args.hot_restart is not None else None
+            runs[name] = asyncio.run(Bench(args, host, client_tls, mode == 'resume',
+                                           restart).run())
+    finally:
+        if proc is not None:
+            stop_server(proc)
+        work_dir.cleanup()
+
+    if len(runs) > 1:
+        for name, r in runs.items():
+            print(f"--- {name} ({r['transport']}{', tls' if r['tls'] else ''})")
+            print_summary(r)
+        print_comparison(runs)
+        results = dict(runs)
+    else:
+        results = runs['run']
+        print_summary(results)
+    results['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,63 @@
 """
 Simple chat client - connects to the server and lets you send/receive messages
 Console based version (no GUI)
+
+    python chat_client.py                   (this one, a thread for receiving)
+    python chat_client.py --engine asyncio  (one event loop, reconnects on its own)
+    python chat_client.py --host unix:/tmp/chat.sock  (server on this machine, see transport.py)
+    python chat_client.py --tls --cafile cert.pem     (server started with --tls-cert)
+
+/send <path> shares a file with the room, /get <id> downloads one (see file_share.py).
 """
 
-import socket
-import threading
-import sys
+import argparse
+
+from chat_sdk import Client, file_command
+from transport import client_context, is_unix
 
 # connection settings - same as the server
 HOST = '127.0.0.1'
 PORT = 12345
-BUFFER_SIZE = 1024
 
 
-def receive_messages(sock):
-    """runs in background thread, keeps printing messages from server"""
-    while True:
-        try:
-            data = sock.recv(BUFFER_SIZE).decode('utf-8')
-            if not data:
-                print("\n[Disconnected from server]")
-                break
+def show(event):
+    """runs on the library's receive thread, prints messages from the server"""
+    shown = event.display()
+    if shown is None:
+        return
+    print(f"\n{shown[0]}")
+    print("You: ", end="", flush=True)  # reprint prompt so it looks clean
+
+
+def report(text):
+    """progress of a file transfer, from its thread"""
+    print(f"\n{text}")
+    print("You: ", end="", flush=True)
 
-            # print the message we got
-            print(f"\n{data}")
-            print("You: ", end="", flush=True)  # reprint prompt so it looks clean
 
-        except ConnectionResetError:
-            print("\n[Server closed the connection]")
-            break
-        except OSError:
-            # socket was closed, just exit quietly
-            break
-        except Exception as e:
-            print(f"\n[Error receiving: {e}]")
-            break
+def disconnected():
+    print("\n[Disconnected from server]")
 
 
 def main():
     """connects to server and lets you chat"""
+    parser = argparse.ArgumentParser(description="console chat client")
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread',
+                        help="asyncio = stdin and the socket on one event loop, reconnects "
+                             "by itself if the server goes away (default %(default)s)")
+    parser.add_argument('--host', default=HOST,
+                        help="server address, or unix:PATH for a server started with "
+                             "--unix PATH (default %(default)s)")
+    parser.add_argument('--port', type=int, default=PORT, help="(default %(default)s)")
+    parser.add_argument('--tls', action='store_true',
+                        help="talk tls, for a server started with --tls-cert")
+    parser.add_argument('--cafile',
+                        help="certificate to trust with --tls, e.g. the server's own "
+                             "self-signed one (default: the system's certificates)")
+    args = parser.parse_args()
+    host, port = args.host, args.port
+    # one context for the whole run, it keeps the session for the reconnects
+    tls = client_context(args.cafile) if args.tls or args.cafile else None
 
     print("=" * 40)
     print("  Simple Chat Client")
@@ -50,10 +69,19 @@ def main():
         print("Name cant be empty!")
         return
 
-    # try to connect
+    if args.engine == 'asyncio':
+        # only import it when asked for, like the server does
+        import async_chat_client
+        print("Type your messages below. Type 'bye' to exit.\n")
+        async_chat_client.run(host, port, username, tls)
+        return
+
+    # try to connect - the hello sends our name first, thats how the server
+    # knows who we are (and that we can take compressed messages, saves a lot
+    # on pasted logs). receiving happens on a background thread from here on
+    client = Client(username, host, port, on_message=show, on_close=disconnected, tls=tls)
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((HOST, PORT))
+        client.connect()
     except ConnectionRefusedError:
         print("Could not connect to server!")
         print("Make sure the server is running first.")
@@ -62,18 +90,12 @@ def main():
         print(f"Connection error: {e}")
         return
 
-    # send our name first - thats how the server knows who we are
-    sock.sendall(username.encode('utf-8'))
-
-    print(f"\nConnected to server at {HOST}:{PORT}")
+    print(f"\nConnected to server at {host if is_unix(host) else f'{host}:{port}'}"
+          + (" (tls)" if tls else ""))
     print(f"Your name: {username}")
     print("Type your messages below. Type 'bye' to exit.\n")
     print("-" * 40)
 
-    # start receiving messages in background
-    recv_thread = threading.Thread(target=receive_messages, args=(sock,), daemon=True)
-    recv_thread.start()
-
     # main loop - read input and send messages
     try:
         while True:
@@ -83,8 +105,14 @@ def main():
             if msg == "":
                 continue
 
+            transfer = file_command(msg)
+            if transfer is not None:
+                # over the file port, in the background so we can keep chatting
+                client.start_transfer(*transfer, report)
+                continue
+
             try:
-                sock.sendall(msg.encode('utf-8'))
+                client.send_line(msg)
             except:
                 print("[Failed to send message]")
                 break
@@ -102,7 +130,8 @@ def main():
 
     # cleanup
     try:
-        sock.close()
+        client.on_close = None  # we know, dont print it
+        client.close(bye=False)
     except:
         pass
 
@@ -0,0 +1,479 @@
+"""
+Client library for bots and anything else that talks to the chat server from code
+
+The interactive clients are built on this too. Sync, with a callback (it
+runs on a receive thread):
+
+    from chat_sdk import Client
+    with Client('bot', on_message=lambda ev: print(ev.display())).connect() as bot:
+        bot.send("hello")
+        bot.send_many(f"line {i}" for i in range(100))   # one write for all of them
+
+Sync, reading on your own thread:
+
+    bot = Client('bot').connect()
+    for ev in bot:                  # ends when the connection closes
+        if ev.type == CHAT and ev.text == 'ping':
+            bot.send('pong')
+
+asyncio, same thing (send() only buffers, await drain() to wait for the socket):
+
+    async with AsyncClient('bot') as bot:
+        bot.send("hello")
+        async for ev in bot:
+            ...
+
+Lots of identities from one process, all on one loop:
+
+    pool = ClientPool([f"bot{i}" for i in range(500)], on_message=handle)  # handle(bot, ev)
+    await pool.connect()
+    pool['bot7'].send("hi")
+    await pool.close()
+
+Files go over the file port (see file_share.py), share() uploads one and
+offers it in the room, fetch() downloads something somebody offered:
+
+    file_id = bot.share('report.pdf')       # blocks until it is uploaded
+    path = bot.fetch(file_id, 'downloads')  # AsyncClient: await bot.share(...)
+
+host can be a unix socket too, Client('bot', 'unix:/tmp/chat.sock') talks to
+a server started with --unix /tmp/chat.sock - quicker for bots on the same
+machine (see transport.py). For a server with --tls-cert pass
+tls=transport.client_context(cafile=...), and keep passing the same one to
+the clients you make after it: it remembers the last session, so a
+reconnect resumes it instead of doing the full handshake again.
+
+Pings are answered and sender ids are turned into names for you. Events only
+come for things worth showing (chat, files, direct messages, notices, joins and
+leaves, room changes, bye). Bots are rate limited by the server like everyone
+else (--message-rate), a burst above it gets dropped.
+"""
+
+import asyncio
+import socket
+import threading
+from collections import deque
+
+import file_share
+import transport
+from framing import RECV_SIZE, FrameDecoder, FrameError
+from protocol import (CHAT, COMMAND, COMPRESSION, FILE, JOINED, NAME, OFFER, PING, PONG_FRAME,
+                      ROOM, WELCOME, BYE_FRAME, Message, client_frame, decode_message, describe,
+                      encode_message, hello_frame, make_offer, parse_offer)
+
+HOST = '127.0.0.1'
+PORT = 12345
+CONNECT_TIMEOUT = 10.0
+DEFAULT_CONNECT_CONCURRENCY = 100   # ClientPool connects this many at once
+
+
+class Event:
+    """one message from the server"""
+
+    __slots__ = ('type', 'sender', 'name', 'seq', 'body')
+
+    def __init__(self, mtype, sender, name, seq, body):
+        self.type = mtype       # protocol.CHAT, NOTICE, ...
+        self.sender = sender    # sender id, 0 for the server
+        self.name = name        # the sender's name if we know it
+        self.seq = seq
+        self.body = body
+
+    @property
+    def text(self):
+        return str(self.body, 'utf-8', 'replace')
+
+    def display(self):
+        """(text, 'server' or 'normal') the way the interactive clients show it"""
+        # no entry at all for a name we dont know yet, describe() shows #id then
+        names = {self.sender: self.name} if self.name is not None else {}
+        return describe(Message(self.type, self.sender, self.seq, self.body), names)
+
+    def __repr__(self):
+        return f"Event({self.type}, sender={self.sender} {self.name!r}, seq={self.seq}, {self.body!r})"
+
+
+class Session:
+    """the protocol side of one connection, no socket stuff (the clients below do that)
+
+    keeps the id -> name table, our own id, and the room + last seq we saw
+    so a new connection can pick up from there
+    """
+
+    def __init__(self, name, room=None, since=None, compress=True):
+        self.name = name
+        self.id = None          # handed out by the server, set once we are in
+        self.room = room
+        self.last_seq = since
+        self.compress = compress
+        self.names = {}
+        self.offers = {}        # file id -> (file name, size) of the files we saw offered
+        self.decoder = FrameDecoder()
+
+    def hello(self):
+        return hello_frame(self.name, compress=COMPRESSION if self.compress else None,
+                           room=self.room, since=self.last_seq)
+
+    def receive(self, data):
+        """bytes from the socket -> (events, bytes to send back)"""
+        events = []
+        reply = b''
+        names = self.names
+        for frame in self.decoder.feed(data):
+            msg = decode_message(frame)
+            mtype = msg.type
+            if mtype == PING:
+                reply += PONG_FRAME
+                continue
+            if mtype == NAME or mtype == WELCOME:
+                names[msg.sender] = msg.text
+                if mtype == WELCOME:
+                    self.id = msg.sender
+                continue
+            if mtype == CHAT or mtype == FILE:
+                if msg.seq:
+                    self.last_seq = msg.seq
+                if mtype == FILE:
+                    file_id, file_name, size = parse_offer(msg.body)
+                    self.offers[file_id] = (file_name, size)
+            elif mtype == ROOM:
+                self.room, self.last_seq = msg.text, msg.seq
+            elif mtype == JOINED:
+                names[msg.sender] = msg.text.partition('\n')[0]
+            events.append(Event(mtype, msg.sender, names.get(msg.sender), msg.seq, msg.body))
+        return events, reply
+
+    def file_name(self, file_id):
+        """the name a file was offered under, the id if we didnt see the offer"""
+        return self.offers.get(file_id, (file_id,))[0]
+
+
+def file_command(line):
+    """('send', path) or ('get', file id) for a /send or /get line, None for anything else"""
+    command, _, arg = line.partition(' ')
+    arg = arg.strip()
+    if command in ('/send', '/get') and arg:
+        return command[1:], arg
+    return None
+
+
+def _transfer_failed(e):
+    return f"[File transfer failed: {e}]"
+
+
+class _Sending:
+    """the send side, the same for both clients. _write(bytes) does the work"""
+
+    def send(self, text):
+        """a chat message to our room"""
+        self._write(encode_message(CHAT, text))
+
+    def send_many(self, texts):
+        """lots of chat messages in one write (pipelined, no waiting in between)"""
+        self._write(b''.join(encode_message(CHAT, text) for text in texts))
+
+    def command(self, line):
+        """a command without the slash, e.g. command("join python")"""
+        self._write(encode_message(COMMAND, line))
+
+    def direct(self, to, text):
+        self.command(f"msg {to} {text}")
+
+    def send_line(self, line):
+        """what a user typed: 'bye', '/command' or a chat message"""
+        self._write(client_frame(line))
+
+    def _offer(self, stored):
+        file_id, name, size = stored
+        self.session.offers[file_id] = (name, size)  # the server doesnt echo it back to us
+        self._write(encode_message(OFFER, make_offer(file_id, name, size)))
+        return file_id
+
+    def _progress(self, label, report):
+        return file_share.progress_steps(lambda percent: report(f"[{label}: {percent}%]"))
+
+    @property
+    def id(self):
+        return self.session.id
+
+    @property
+    def room(self):
+        return self.session.room
+
+    @property
+    def last_seq(self):
+        return self.session.last_seq
+
+
+class Client(_Sending):
+    """blocking client. pass on_message to get events on a receive thread,
+    otherwise read them with recv() or by iterating over the client"""
+
+    def __init__(self, name, host=HOST, port=PORT, room=None, since=None, compress=True,
+                 on_message=None, on_close=None, file_port=None, tls=None):
+        self.host = host
+        self.port = port
+        self.tls = tls  # transport.client_context() for a server with --tls-cert
+        self.file_host = transport.tcp_host(host)  # the file port is always tcp
+        self.file_port = file_port or port + 1
+        self.session = Session(name, room, since, compress)
+        self.on_message = on_message
+        self.on_close = on_close
+        self.sock = None
+        self.lock = threading.Lock()  # the receive thread sends pongs
+        self.events = deque()
+
+    def connect(self):
+        self.sock = transport.connect(self.host, self.port, CONNECT_TIMEOUT, self.tls)
+        self.sock.settimeout(None)
+        self._write(self.session.hello())
+        if self.on_message is not None:
+            threading.Thread(target=self._receive_loop, daemon=True).start()
+        return self
+
+    def _write(self, data):
+        with self.lock:
+            self.sock.sendall(data)
+
+    def recv(self):
+        """next event, None once the connection is closed"""
+        while not self.events:
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                return None
+            events, reply = self.session.receive(data)
+            if reply:
+                self._write(reply)
+            self.events.extend(events)
+        return self.events.popleft()
+
+    def __iter__(self):
+        while True:
+            event = self.recv()
+            if event is None:
+                return
+            yield event
+
+    def _receive_loop(self):
+        try:
+            for event in self:
+                self.on_message(event)
+        except (OSError, ValueError, FrameError):
+            pass  # closed, reset, or garbage from the server
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+
+    def share(self, path, progress=None):
+        """uploads a file and offers it in our room, returns its file id.
+        blocks until it is uploaded, progress(done, total) is called on the way"""
+        return self._offer(file_share.upload(self.file_host, self.file_port, path, progress,
+                                             self.tls))
+
+    def fetch(self, file_id, directory='.', progress=None):
+        """downloads an offered file into directory, returns where it went"""
+        dest = file_share.save_path(directory, self.session.file_name(file_id))
+        file_share.download(self.file_host, self.file_port, file_id, dest, progress, self.tls)
+        return dest
+
+    def start_transfer(self, command, arg, report):
+        """runs a file_command() on a thread of its own, report(text) gets the
+        progress and how it went (on that thread)"""
+        threading.Thread(target=self._transfer, args=(command, arg, report), daemon=True).start()
+
+    def _transfer(self, command, arg, report):
+        try:
+            if command == 'send':
+                file_id = self.share(arg, self._progress(arg, report))
+                report(f"[Shared {arg}, the others can /get {file_id}]")
+            else:
+                progress = self._progress(self.session.file_name(arg), report)
+                report(f"[Saved {self.fetch(arg, progress=progress)}]")
+        except (OSError, ValueError, FrameError, file_share.TransferError) as e:
+            report(_transfer_failed(e))
+
+    def close(self, bye=True):
+        if self.sock is None:
+            return
+        if bye:
+            try:
+                self._write(BYE_FRAME)
+            except OSError:
+                pass
+        transport.remember_session(self.tls, self.sock)  # before shutdown() drops it
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # wakes up the receive thread
+        except OSError:
+            pass
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncClient(_Sending):
+    """asyncio client. on_message(event) (a plain function or a coroutine
+    function) gets every event from a reader task, otherwise use recv() or
+    async for"""
+
+    def __init__(self, name, host=HOST, port=PORT, room=None, since=None, compress=True,
+                 on_message=None, on_close=None, file_port=None, tls=None):
+        self.host = host
+        self.port = port
+        self.tls = tls  # transport.client_context() for a server with --tls-cert
+        self.file_host = transport.tcp_host(host)  # the file port is always tcp
+        self.file_port = file_port or port + 1
+        self.session = Session(name, room, since, compress)
+        self.on_message = on_message
+        self.on_close = on_close
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.events = deque()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            transport.open_connection(self.host, self.port, self.tls), CONNECT_TIMEOUT)
+        self.writer.write(self.session.hello())
+        if self.on_message is not None:
+            self.task = asyncio.ensure_future(self._receive_loop())
+        return self
+
+    def _write(self, data):
+        self.writer.write(data)
+
+    async def drain(self):
+        """waits until the kernel took what we sent (backpressure for fast senders)"""
+        await self.writer.drain()
+
+    async def recv(self):
+        while not self.events:
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                return None
+            events, reply = self.session.receive(data)
+            if reply:
+                self.writer.write(reply)
+            self.events.extend(events)
+        return self.events.popleft()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.recv()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    async def _receive_loop(self):
+        try:
+            async for event in self:
+                result = self.on_message(event)
+                if asyncio.iscoroutine(result):
+                    await result
+        except (OSError, ValueError, FrameError):
+            pass
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+
+    async def share(self, path, progress=None):
+        """Client.share(), the upload runs on a worker thread (so does progress)"""
+        return self._offer(await asyncio.to_thread(
+            file_share.upload, self.file_host, self.file_port, path, progress, self.tls))
+
+    async def fetch(self, file_id, directory='.', progress=None):
+        dest = file_share.save_path(directory, self.session.file_name(file_id))
+        await asyncio.to_thread(file_share.download, self.file_host, self.file_port, file_id,
+                                dest, progress, self.tls)
+        return dest
+
+    async def transfer(self, command, arg, report):
+        """Client.start_transfer() as a coroutine, wrap it in a task to not wait for it"""
+        try:
+            if command == 'send':
+                file_id = await self.share(arg, self._progress(arg, report))
+                report(f"[Shared {arg}, the others can /get {file_id}]")
+            else:
+                progress = self._progress(self.session.file_name(arg), report)
+                report(f"[Saved {await self.fetch(arg, progress=progress)}]")
+        except (OSError, ValueError, FrameError, file_share.TransferError) as e:
+            report(_transfer_failed(e))
+
+    async def close(self, bye=True):
+        if self.writer is None:
+            return
+        if bye and not self.writer.is_closing():
+            self.writer.write(BYE_FRAME)
+        transport.remember_session(self.tls, self.writer.get_extra_info('ssl_object'))
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class ClientPool:
+    """one AsyncClient per name, all on the running loop
+
+    on_message(client, event) gets the events of all of them, the other
+    options go to every AsyncClient
+    """
+
+    def __init__(self, names, host=HOST, port=PORT, on_message=None,
+                 concurrency=DEFAULT_CONNECT_CONCURRENCY, **options):
+        self.concurrency = concurrency
+        self.clients = {}
+        for name in names:
+            client = AsyncClient(name, host, port, **options)
+            if on_message is not None:
+                client.on_message = lambda event, client=client: on_message(client, event)
+            self.clients[name] = client
+
+    async def connect(self):
+        """connects everyone, a few at a time. returns the names that failed"""
+        sem = asyncio.Semaphore(self.concurrency)
+        failed = []
+
+        async def one(name, client):
+            async with sem:
+                try:
+                    await client.connect()
+                except (OSError, asyncio.TimeoutError):
+                    failed.append(name)
+
+        await asyncio.gather(*(one(name, client) for name, client in self.clients.items()))
+        for name in failed:
+            del self.clients[name]
+        return failed
+
+    def __getitem__(self, name):
+        return self.clients[name]
+
+    def __iter__(self):
+        return iter(self.clients.values())
+
+    def __len__(self):
+        return len(self.clients)
+
+    async def close(self, bye=True):
+        await asyncio.gather(*(client.close(bye) for client in self.clients.values()))
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -3,137 +3,682 @@ Simple chat server - accepts multiple clients and broadcasts messages
 Basic version using just the console (no GUI)
 """
 
+import argparse
 import socket
 import threading
+import time
+
+import chatlog
+import metrics
+from admission import (Admission, DEFAULT_BACKLOG, DEFAULT_MAX_CONNECTIONS, DEFAULT_MAX_PER_IP,
+                       DEFAULT_MESSAGE_BURST, DEFAULT_MESSAGE_RATE, Bouncer, over_limit)
+from file_share import DEFAULT_MAX_FILE_SIZE, DEFAULT_SPOOL, FileServer, Spool, offer_frame
+from framing import DEFAULT_COMPRESS_LEVEL, DEFAULT_COMPRESS_MIN_SIZE, FrameReader, encode_frame
+from heartbeat import DEFAULT_IDLE_TIMEOUT, DEFAULT_PING_INTERVAL, Reaper, enable_keepalive
+from history import DEFAULT_HISTORY_BYTES, DEFAULT_HISTORY_SIZE, DEFAULT_REPLAY, RoomHistory
+from message_store import DEFAULT_SEGMENT_BYTES, MessageStore
+from outbound import (ClientWriter, DEFAULT_FLUSH_BYTES, DEFAULT_FLUSH_DELAY,
+                      DEFAULT_MAX_QUEUE, DROP_OLDEST, POLICIES, compressed_copy)
+from protocol import (BYE, BYE_FRAME, CHAT, COMMAND, HELLO, JOINED, LEFT, NAMED, OFFER,
+                      PING_FRAME, PONG, WELCOME, BodyText, decode_message, encode_message,
+                      int_option, message_type, notice, parse_hello, relay_frame, sender_of,
+                      strip_body, wants_compression)
+from rooms import RoomIndex, handle_command, start_room
+from transport import accept_tls, close_unix, listen_unix, peer, peer_address, server_context
 
 # server settings
 HOST = '127.0.0.1'
 PORT = 12345
-BUFFER_SIZE = 1024
+BUFFER_SIZE = 65536  # bytes per recv() call, messages are framed so this is just a read size
+
+# slow consumer handling (see outbound.py), can be changed from the command line
+MAX_QUEUE = DEFAULT_MAX_QUEUE
+SLOW_POLICY = DROP_OLDEST
+# write coalescing, see outbound.py
+FLUSH_BYTES = DEFAULT_FLUSH_BYTES
+FLUSH_DELAY = DEFAULT_FLUSH_DELAY
+# compression for clients that ask for it (see framing.py)
+COMPRESS_MIN_SIZE = DEFAULT_COMPRESS_MIN_SIZE
+COMPRESS_LEVEL = DEFAULT_COMPRESS_LEVEL
+# admission control, see admission.py
+BACKLOG = DEFAULT_BACKLOG
+MAX_CONNECTIONS = DEFAULT_MAX_CONNECTIONS
+MAX_PER_IP = DEFAULT_MAX_PER_IP
+MESSAGE_RATE = DEFAULT_MESSAGE_RATE
+MESSAGE_BURST = DEFAULT_MESSAGE_BURST
+# quiet clients get pinged, silent ones get dropped (see heartbeat.py)
+PING_INTERVAL = DEFAULT_PING_INTERVAL
+IDLE_TIMEOUT = DEFAULT_IDLE_TIMEOUT
+# also listen on this unix socket path, for bots on the same machine (see transport.py)
+UNIX_PATH = None
+# TLS for the tcp port (and the file port), made once in main() from
+# --tls-cert/--tls-key, None = plaintext. see transport.py
+tls_context = None
+# file sharing on a port of its own, 0 = off (see file_share.py)
+FILE_PORT = PORT + 1
+SPOOL_DIR = DEFAULT_SPOOL
+MAX_FILE_SIZE = DEFAULT_MAX_FILE_SIZE
+# hot restart: the next server takes over from us through this unix socket (see handoff.py)
+HANDOFF_PATH = None
 
 # store all connected clients
-# using a dict so i can track names -> sockets
-clients = {}
-lock = threading.Lock()  # need this because multiple threads touch the clients dict
-
-
-def broadcast(message, skip_name=None):
-    """send a message to all connected clients (except the one we want to skip)"""
-    with lock:
-        for name in list(clients.keys()):
-            if name == skip_name:
-                continue
-            try:
-                clients[name].sendall(message.encode('utf-8'))
-            except:
-                # if sending fails, just skip - they probably disconnected
-                # the handle_client function will clean them up
-                print(f"  [!] couldnt send to {name}, skipping")
-
-
-def handle_client(conn, addr):
-    """handles one client connection in its own thread"""
+# names -> ClientWriter (which has the socket), plus which room everyone is in
+# (see rooms.py, it has its own lock because multiple threads touch it)
+clients = RoomIndex()
+
+# last messages of every room, replayed to people when they join (history.py)
+history = RoomHistory()
+
+# checks on every client's heartbeat, made in run_threaded()
+reaper = None
+# connection counts per address and the rate limits, made in run_threaded()
+admission = None
+bouncer = Bouncer()
+
+# optional durable log of the chat (message_store.py), None = memory only
+store = None
+
+# where uploaded files are kept, made in start_file_server(). None = no file sharing
+spool = None
+file_server = None
+
+# with --handoff, waits for the server that replaces us (handoff.Handover).
+# once it has started, the readers stop at their next message and hand over
+handover = None
+# cleared while the clients the last server handed us get back into their
+# rooms - none of them handles a message before all of them are in (the
+# ones not in yet would miss it)
+settled = threading.Event()
+settled.set()
+
+# when running as one of several worker processes (see sharded_server.py)
+# this is the bus to the other workers, otherwise None
+bus = None
+
+
+def broadcast(frame, skip_name=None, room=None, record=False):
+    """send a message (an encoded frame, see protocol.py) to everyone in room
+    (or everyone at all if room is None), except the one we want to skip.
+    record=True keeps it in the room history"""
+    if bus is not None:
+        # goes to every worker, us included, and comes back through fan_out()
+        bus.publish(frame, skip_name, room, record=record)
+    else:
+        fan_out(frame, skip_name, room, record)
+
+
+def fan_out(frame, skip_name=None, room=None, record=False):
+    """queue an encoded frame for the clients connected to this process
+
+    only looks at the members of the room, and just queues the frame for each
+    of them - the actual sending happens on each client's own writer thread
+    so a slow client cant hold everyone up
+    """
+    start = time.perf_counter()
+    seq = None
+    if record and room is not None:
+        seq, frame = history.record(room, frame)  # stamps the seq into the frame
+    targets = clients.members(room, skip=skip_name)
+    if message_type(frame) in NAMED:
+        # anyone who hasnt seen this sender before gets their name first
+        clients.senders.introduce(targets, sender_of(frame))
+    packed, saved = compressed_copy(frame, targets, COMPRESS_LEVEL, COMPRESS_MIN_SIZE)
+    if packed is frame:
+        for writer in targets:
+            writer.send(frame)
+    else:
+        for writer in targets:
+            writer.send(packed if writer.compress else frame)
+    metrics.MESSAGES_OUT.inc(len(targets))
+    metrics.BYTES_OUT.inc(len(frame) * len(targets) - saved)
+    metrics.BROADCAST_SECONDS.observe(time.perf_counter() - start)
+    # next stage, only a queue append - the disk work is on the store's own thread
+    if seq is not None and store is not None:
+        store.append(room, seq, frame)
+
+
+def direct(target, frame):
+    """private message to one client, False if they arent connected"""
+    writer = clients.get(target)
+    if writer is not None:
+        return deliver(writer, frame)
+    if bus is not None:
+        # might be on another worker, we cant tell from here
+        bus.publish(frame, to=target)
+        return True
+    return False
+
+
+def deliver(writer, frame):
+    """sends a DIRECT message, with the sender's name first if they need it"""
+    clients.senders.introduce((writer,), sender_of(frame))
+    return writer.send(frame)
+
+
+def close_store():
+    """last thing before a handover (see handoff.py), the new server opens the store next"""
+    if store is not None:
+        store.close()
+
+
+def share_file(writer, name, body):
+    """OFFER - the file is in the spool already, tell the room about it"""
+    frame = offer_frame(spool, body, writer.id) if spool is not None else None
+    if frame is None:
+        writer.send(notice("That file isnt on the server (or file sharing is off)."))
+        return
+    chatlog.info('file', "  {name} shares a file", name=name)
+    broadcast(frame, skip_name=name, room=clients.room(name), record=True)
+
+
+def handle_client(conn, addr, taken_over=None):
+    """handles one client connection in its own thread. taken_over is (what
+    we know about them, bytes read but not handled yet, an Event to set once
+    they are in their room or None if they still have to say hello) for a
+    client the last server handed us (see handoff.py)"""
     client_name = None
+    added = None
+    reader = FrameReader(conn, BUFFER_SIZE)
+    writer = ClientWriter(conn, max_queue=MAX_QUEUE, policy=SLOW_POLICY,
+                          flush_bytes=FLUSH_BYTES, flush_delay=FLUSH_DELAY)
+    # watched from the start, so a connection that never even says its name gets dropped too
+    reaper.watch(writer)
 
     try:
-        # first thing the client sends is their name
-        name_data = conn.recv(BUFFER_SIZE).decode('utf-8')
-        if not name_data:
-            conn.close()
-            return
+        if taken_over is not None:
+            known, unread, added = taken_over
+            reader.push(unread)
+            client_name = known.get('name')  # None if they hadnt said hello yet
+        joining = client_name is None
+
+        if joining:
+            # first thing the client sends is their name (plus maybe some options)
+            hello = reader.read_view()
+            if hello is not None and handover is not None and handover.started:
+                writer.close()  # never started, but the reaper has to see it is gone
+                handover.pass_new(conn, encode_frame(hello) + reader.unread())
+                return
+            hello = decode_message(hello) if hello else None
+            if hello is None or hello.type != HELLO:
+                writer.close()
+                conn.close()
+                return
 
-        client_name = name_data.strip()
-        # print(f"DEBUG: received name = '{client_name}'")
+            client_name, options = parse_hello(hello.text)
+            # print(f"DEBUG: received name = '{client_name}'")
+            if not client_name:
+                # a blank name counts as no hello (the cleanup couldnt remove "" again)
+                writer.close()
+                conn.close()
+                return
+            compress, room = wants_compression(options), start_room(options)  # the lobby, usually
+        else:
+            compress, room = known['compress'], known['room']
+        bucket = admission.bucket(time.monotonic())
 
-        with lock:
-            clients[client_name] = conn
+        writer.name = client_name
+        writer.id = clients.senders.assign(client_name)
+        writer.known.add(writer.id)
+        writer.compress = compress
+        writer.start()
+        if joining:
+            writer.send(encode_message(WELCOME, client_name, sender=writer.id))
+        clients.add(client_name, writer, room)
 
-        print(f"[+] {client_name} joined the chat (from {addr})")
+        # one the last server handed over is just back in their room - for
+        # them nothing happened, so no welcome, no history and no joined
+        if joining:
+            chatlog.info('join', "[+] {name} joined the chat (from {addr})", name=client_name,
+                         addr=addr)
 
-        # let everyone know someone new connected
-        broadcast(f"[Server] {client_name} has joined the chat!", skip_name=client_name)
+            # catch them up on what they missed (everything after since=, or the last few)
+            history.send_catch_up(writer, room, int_option(options, 'since'), clients.senders)
+
+            # let the room know someone new connected
+            broadcast(encode_message(JOINED, client_name, sender=writer.id),
+                      skip_name=client_name, room=room)
+        else:
+            added.set()
+            settled.wait()
 
         # main loop - keep receiving messages from this client
         while True:
-            data = conn.recv(BUFFER_SIZE).decode('utf-8')
-            if not data:
+            # a view into the reader's buffer, good until the next read - the
+            # only copy a chat message gets is into the frame that goes out
+            frame = reader.read_view()
+            if frame is None:
                 break  # client disconnected
-
-            msg = data.strip()
-            # print(f"DEBUG: {client_name} sent: '{msg}'")
+            if handover is not None and handover.started:
+                # the next server takes it from here: this frame and whatever
+                # else we read go along unhandled, and we leave without the
+                # usual cleanup (they havent left)
+                handover.park(writer, encode_frame(frame) + reader.unread())
+                return
+            now = writer.last_seen = time.monotonic()
+            msg = decode_message(frame)
+            if msg.type == PONG:
+                continue  # heartbeat
+            metrics.MESSAGES_IN.inc()
+            metrics.BYTES_IN.inc(len(frame))
+            # print(f"DEBUG: {client_name} sent: {msg}")
 
             # check if client wants to leave
-            if msg.lower() == 'bye':
-                print(f"[-] {client_name} said bye, disconnecting them")
-                # let the client know we got it
-                try:
-                    conn.sendall("[Server] Goodbye! You have left the chat.".encode('utf-8'))
-                except:
-                    pass
+            if msg.type == BYE:
+                chatlog.info('bye', "[-] {name} said bye, disconnecting them", name=client_name)
+                # let the client know we got it (the writer flushes it before we close)
+                writer.send(BYE_FRAME)
                 break
 
-            # normal message - broadcast to everyone
-            print(f"  {client_name}: {msg}")
-            broadcast(f"{client_name}: {msg}", skip_name=client_name)
+            if over_limit(bucket, writer, now):
+                continue  # too fast, dropped (they get told once)
+
+            if msg.type == COMMAND:
+                handle_command(clients, client_name, writer, msg.text, broadcast, direct, history)
+            elif msg.type == CHAT:
+                # normal message - goes to everyone in the same room. it is
+                # never decoded here, the log does that if it actually writes it
+                frame = relay_frame(CHAT, strip_body(msg.body), sender=writer.id)
+                chatlog.info('message', "  {name}: {text}", name=client_name, text=BodyText(frame))
+                broadcast(frame, skip_name=client_name, room=clients.room(client_name),
+                          record=True)
+            elif msg.type == OFFER:
+                share_file(writer, client_name, msg.body)
 
     except ConnectionResetError:
-        print(f"[!] {client_name or addr} connection was reset")
+        chatlog.warning('reset', "[!] {who} connection was reset", who=client_name or addr)
     except Exception as e:
-        print(f"[!] error with {client_name or addr}: {e}")
+        chatlog.error('error', "[!] error with {who}: {error}", who=client_name or addr, error=e)
+
+    if added is not None:
+        added.set()  # they never made it into their room, dont keep adopt() waiting
 
     # cleanup - remove client and close connection
     if client_name:
-        with lock:
-            if client_name in clients:
-                del clients[client_name]
-        broadcast(f"[Server] {client_name} has left the chat.")
-        print(f"[-] {client_name} removed from chat")
+        # returns None if someone reconnected with the same name in the meantime
+        room = clients.remove(client_name, writer)
+        if room is not None:
+            broadcast(encode_message(LEFT, client_name, sender=writer.id), room=room)
+        chatlog.info('leave', "[-] {name} removed from chat", name=client_name)
 
+    writer.close()
     try:
         conn.close()
     except:
         pass
 
 
-def main():
-    """starts the server and listens for connections"""
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def serve_client(conn, addr, tls=None, taken_over=None):
+    try:
+        if tls is not None:
+            # the handshake happens here on the client's thread, the accept
+            # loop has already gone back to taking the next connection
+            conn = accept_tls(tls, conn, addr)
+            if conn is None:
+                return
+        handle_client(conn, addr, taken_over)
+    finally:
+        admission.release(peer_address(addr))
 
-    # SO_REUSEADDR so we can restart quickly without "address already in use" error
-    # learned about this one the hard way lol
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-    server.bind((HOST, PORT))
-    server.listen(5)
+def start_file_server(reuse_port=False, sock=None):
+    """the file port's own threads (every engine uses these), returns the spool.
+    sock is the listening socket if we took it over (handoff.py)"""
+    global spool, file_server
+    if FILE_PORT:
+        spool = Spool(SPOOL_DIR, MAX_FILE_SIZE)
+        file_server = FileServer(spool, HOST, FILE_PORT, reuse_port=reuse_port,
+                                 tls=tls_context).start(sock)
+        print(f"File sharing on {HOST}:{FILE_PORT}, spooled in {SPOOL_DIR}")
+    return spool
 
-    print(f"Server started on {HOST}:{PORT}")
-    print("Waiting for connections...")
-    print("(press Ctrl+C to stop)\n")
 
+def accept_loop(server, tls=None):
+    """takes new clients off one listening socket, tcp or unix. tls is only
+    handed on, nothing slow happens on this thread"""
+    while True:
+        conn, addr = server.accept()
+        if handover is not None and handover.started:
+            handover.pass_new(conn)  # the new server has this socket too now
+            continue
+        start_client(conn, peer(addr), tls)
+
+
+def start_client(conn, addr, tls=None, taken_over=None):
+    """admission, then the client's own thread. False if they were turned away"""
+    reason = admission.admit(peer_address(addr))
+    if reason is not None:
+        chatlog.warning('rejected', "[!] turned away {addr}: {reason}", addr=addr,
+                        reason=reason)
+        bouncer.reject(conn, reason)
+        return False
+    enable_keepalive(conn)
+    if taken_over is None:
+        chatlog.info('connect', "[*] New connection from {addr}", addr=addr)
+
+    # start a new thread for each client so they dont block each other
+    t = threading.Thread(target=serve_client, args=(conn, addr, tls, taken_over), daemon=True)
+    t.start()
+    return True
+
+
+def adopt(conn, known, unread):
+    """a connection the last server handed us (handoff.py)"""
     try:
-        while True:
-            conn, addr = server.accept()
-            print(f"[*] New connection from {addr}")
+        addr = peer(conn.getpeername())
+    except OSError:
+        conn.close()  # gone in the meantime
+        return
+    if known.get('name') is None and not unread:
+        # it only got as far as accept() over there, so it is a new connection
+        # like any other (tls handshake and all)
+        start_client(conn, addr, None if conn.family == socket.AF_UNIX else tls_context)
+    elif known.get('name') is None:
+        # their hello came in during the handover, it is in unread. they join
+        # like anyone new, nobody has to wait for that
+        start_client(conn, addr, taken_over=(known, unread, None))
+    else:
+        import handoff  # only ever called with --handoff
+        added = threading.Event()
+        if start_client(conn, addr, taken_over=(known, unread, added)):
+            added.wait(handoff.ADOPT_TIMEOUT)
+
+
+def run_threaded(reuse_port=False, label="", metrics_port=None, unix_server=None,
+                 inherited=None):
+    """thread per client engine (the original one)
+
+    reuse_port is for the multi process mode, every worker binds the same port
+    (and gets the unix socket already listening, unix_server - there is no
+    reuse_port for those, the workers share the one the parent made)
+
+    inherited is what handoff.take_over() got from the server we replace:
+    its listening sockets are used instead of new ones, and its clients
+    carry on here
+    """
+    owns_unix = unix_server is None and UNIX_PATH is not None
+    global reaper, admission, handover
+
+    def inherit(name, address):
+        return inherited.listener(name, address) if inherited is not None else None
 
-            # start a new thread for each client so they dont block each other
-            t = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
-            t.start()
+    metrics.watch_clients(clients)
+    clients.lock_wait = metrics.LOCK_WAIT_SECONDS
+    reaper = Reaper(ping=lambda writer: writer.send(PING_FRAME),
+                    kick=lambda writer: writer.kick(),
+                    alive=lambda writer: not writer.closed,
+                    ping_interval=PING_INTERVAL, idle_timeout=IDLE_TIMEOUT).start()
+    admission = Admission(MAX_CONNECTIONS, MAX_PER_IP, MESSAGE_RATE, MESSAGE_BURST)
+    metrics_server = None
+    if metrics_port:
+        metrics_server = metrics.serve(metrics_port,
+                                       sock=inherit('metrics', ('127.0.0.1', metrics_port)))
+        print(f"Metrics on http://127.0.0.1:{metrics_port}/metrics")
+    start_file_server(reuse_port, inherit('file', (HOST, FILE_PORT)))
+    server = inherit('tcp', (HOST, PORT))
+    if server is None:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
+        # SO_REUSEADDR so we can restart quickly without "address already in use" error
+        # learned about this one the hard way lol
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        server.bind((HOST, PORT))
+        # the kernel queues up to BACKLOG connections until we accept() them, with
+        # the old listen(5) a burst of clients got refused (or just hung)
+        server.listen(BACKLOG)
+    if owns_unix:
+        unix_server = inherit('unix', UNIX_PATH) or listen_unix(UNIX_PATH, BACKLOG)
+
+    if inherited is not None:
+        for sock in inherited.listeners.values():
+            sock.close()  # the ones our settings dont have anymore
+        # back in their rooms before anyone new gets in
+        settled.clear()
+        inherited.follow(adopt)
+        settled.set()
+    if HANDOFF_PATH:
+        import handoff
+        listeners = {'tcp': server}
+        if owns_unix:
+            listeners['unix'] = unix_server
+        if file_server is not None:
+            listeners['file'] = file_server.sock
+        if metrics_server is not None:
+            listeners['metrics'] = metrics_server.socket
+        handover = handoff.Handover(HANDOFF_PATH, clients, history, listeners,
+                                    before_end=close_store).start()
+
+    print(f"Server started on {HOST}:{PORT}{label}{' (tls)' if tls_context else ''}")
+    if unix_server is not None:
+        # its own accept thread, the clients end up in the same registry
+        threading.Thread(target=accept_loop, args=(unix_server,), daemon=True).start()
+        print(f"Also listening on unix:{UNIX_PATH}")
+    if handover is not None:
+        print(f"Hot restart: the next server takes over through {HANDOFF_PATH}")
+    print("Waiting for connections...")
+    print("(press Ctrl+C to stop)\n")
+
+    try:
+        if handover is None:
+            accept_loop(server, tls_context)
+        else:
+            # accepting on a thread too, so this one can stop once the
+            # next server has everything
+            threading.Thread(target=accept_loop, args=(server, tls_context), daemon=True).start()
+            handover.done.wait()
     except KeyboardInterrupt:
         print("\n\nShutting down server...")
 
+    if handover is not None and handover.started:
+        # the sockets are the new server's now, so nothing gets closed or
+        # removed. only our file transfers still need finishing
+        if handover.seconds is None:
+            print("\nHanding over failed, stopping anyway")
+        else:
+            print(f"\nHanded {handover.handed} clients over to the new server "
+                  f"in {handover.seconds * 1000:.1f} ms")
+        if file_server is not None and not file_server.drain(handoff.DRAIN_TIMEOUT):
+            print("Some file transfers didnt finish in time, they get cut off")
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        chatlog.LOGGER.close()
+        print("Server stopped.")
+        return
+    if handover is not None:
+        handover.close()
+
     # close everything
-    with lock:
-        for name in clients:
-            try:
-                clients[name].close()
-            except:
-                pass
-        clients.clear()
+    for writer in clients.all_connections():
+        try:
+            writer.sock.close()
+        except:
+            pass
+    clients.clear()
 
     server.close()
+    if owns_unix:
+        close_unix(unix_server, UNIX_PATH)
+    chatlog.LOGGER.close()  # write out whatever is still queued first
     print("Server stopped.")
 
 
+def main():
+    """starts the server and listens for connections"""
+    parser = argparse.ArgumentParser(description="console chat server")
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread',
+                        help="thread = one thread per client (default), "
+                             "asyncio = all clients on one event loop")
+    parser.add_argument('--max-queue', type=int, default=DEFAULT_MAX_QUEUE,
+                        help="max frames waiting to be sent to one client (default %(default)s)")
+    parser.add_argument('--slow-policy', choices=POLICIES, default=DROP_OLDEST,
+                        help="what to do when a client's queue is full (default %(default)s)")
+    parser.add_argument('--flush-bytes', type=int, default=DEFAULT_FLUSH_BYTES,
+                        help="send a client's batched messages once this many bytes "
+                             "are waiting (default %(default)s)")
+    parser.add_argument('--flush-delay', type=float, default=DEFAULT_FLUSH_DELAY,
+                        help="max seconds to wait for more messages before sending a "
+                             "batch, 0 = send right away (default %(default)s)")
+    parser.add_argument('--compress-min-size', type=int, default=DEFAULT_COMPRESS_MIN_SIZE,
+                        help="compress broadcasts at least this big for clients that "
+                             "ask for it (default %(default)s)")
+    parser.add_argument('--compress-level', type=int, choices=range(1, 10),
+                        default=DEFAULT_COMPRESS_LEVEL, metavar='1-9',
+                        help="zlib level, 1 = fastest (default %(default)s)")
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG,
+                        help="connections the kernel queues until we accept them "
+                             "(default %(default)s)")
+    parser.add_argument('--max-connections', type=int, default=DEFAULT_MAX_CONNECTIONS,
+                        help="clients at once, 0 = no limit (default %(default)s, per worker)")
+    parser.add_argument('--max-per-ip', type=int, default=DEFAULT_MAX_PER_IP,
+                        help="clients at once from one address, 0 = no limit "
+                             "(default %(default)s, per worker)")
+    parser.add_argument('--message-rate', type=float, default=DEFAULT_MESSAGE_RATE,
+                        help="messages per second one client can send, 0 = no limit "
+                             "(default %(default)s)")
+    parser.add_argument('--message-burst', type=int, default=DEFAULT_MESSAGE_BURST,
+                        help="how many messages a client can send at once above the rate "
+                             "(default %(default)s)")
+    parser.add_argument('--ping-interval', type=float, default=DEFAULT_PING_INTERVAL,
+                        help="ping clients that were quiet this many seconds (default %(default)s)")
+    parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help="drop clients that sent nothing, not even a pong, for this "
+                             "many seconds (default %(default)s)")
+    parser.add_argument('--history-size', type=int, default=DEFAULT_HISTORY_SIZE,
+                        help="messages kept per room for catch-up (default %(default)s)")
+    parser.add_argument('--history-bytes', type=int, default=DEFAULT_HISTORY_BYTES,
+                        help="max bytes of history per room (default %(default)s)")
+    parser.add_argument('--replay', type=int, default=DEFAULT_REPLAY,
+                        help="how many recent messages a joining client gets (default %(default)s)")
+    parser.add_argument('--store', default=None, metavar='DIR',
+                        help="keep every chat message on disk in DIR and reload the "
+                             "history from it on startup")
+    parser.add_argument('--store-segment-bytes', type=int, default=DEFAULT_SEGMENT_BYTES,
+                        help="start a new store segment file at this size (default %(default)s)")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="serve prometheus metrics on this port (worker i uses port+i)")
+    parser.add_argument('--unix', default=None, metavar='PATH',
+                        help="also listen on a unix socket at PATH, clients on the same "
+                             "machine connect with --host unix:PATH (faster than tcp)")
+    parser.add_argument('--tls-cert', default=None, metavar='PEM',
+                        help="speak tls on the tcp and file ports with this certificate "
+                             "(the unix socket stays plain)")
+    parser.add_argument('--tls-key', default=None, metavar='PEM',
+                        help="the certificate's private key, if it isnt in --tls-cert")
+    parser.add_argument('--file-port', type=int, default=PORT + 1,
+                        help="port for file uploads and downloads, 0 = no file sharing "
+                             "(default %(default)s)")
+    parser.add_argument('--spool', default=DEFAULT_SPOOL, metavar='DIR',
+                        help="where uploaded files are kept (default %(default)s)")
+    parser.add_argument('--max-file-size', type=int, default=DEFAULT_MAX_FILE_SIZE,
+                        help="biggest file that can be uploaded, in bytes (default %(default)s)")
+    parser.add_argument('--log-level', choices=list(chatlog.LEVELS), default='info',
+                        help="least important log level shown (default %(default)s)")
+    parser.add_argument('--log-sample', type=chatlog.parse_sample, action='append', default=[],
+                        metavar='EVENT=RATE',
+                        help="only log this fraction of an event, e.g. message=0.01 "
+                             "or message=0 to turn chat messages off (can repeat)")
+    parser.add_argument('--log-file', default=None,
+                        help="also write logs as json lines to this file (rotated)")
+    parser.add_argument('--log-max-bytes', type=int, default=chatlog.DEFAULT_MAX_BYTES,
+                        help="rotate the log file at this size (default %(default)s)")
+    parser.add_argument('--log-backups', type=int, default=chatlog.DEFAULT_BACKUPS,
+                        help="how many rotated log files to keep (default %(default)s)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes sharing the port "
+                             "(linux/bsd only, thread engine only, default %(default)s)")
+    parser.add_argument('--handoff', default=None, metavar='PATH',
+                        help="hot restart: take over from the server waiting on PATH if "
+                             "there is one, then wait there for the next (see handoff.py)")
+    args = parser.parse_args()
+    if args.workers > 1 and args.engine != 'thread':
+        parser.error("--workers only works with the thread engine")
+    if args.idle_timeout <= args.ping_interval:
+        parser.error("--idle-timeout has to be longer than --ping-interval")
+    if args.tls_key and not args.tls_cert:
+        parser.error("--tls-key needs --tls-cert")
+    if args.handoff and (args.engine != 'thread' or args.workers > 1):
+        parser.error("--handoff only works with the thread engine and one worker")
+
+    global MAX_QUEUE, SLOW_POLICY, FLUSH_BYTES, FLUSH_DELAY, history, store
+    global COMPRESS_MIN_SIZE, COMPRESS_LEVEL
+    global PING_INTERVAL, IDLE_TIMEOUT
+    global BACKLOG, MAX_CONNECTIONS, MAX_PER_IP, MESSAGE_RATE, MESSAGE_BURST
+    global FILE_PORT, SPOOL_DIR, MAX_FILE_SIZE, UNIX_PATH, tls_context, HANDOFF_PATH
+    MAX_QUEUE = args.max_queue
+    SLOW_POLICY = args.slow_policy
+    FLUSH_BYTES = args.flush_bytes
+    FLUSH_DELAY = args.flush_delay
+    COMPRESS_MIN_SIZE = args.compress_min_size
+    COMPRESS_LEVEL = args.compress_level
+    PING_INTERVAL = args.ping_interval
+    IDLE_TIMEOUT = args.idle_timeout
+    BACKLOG = args.backlog
+    MAX_CONNECTIONS = args.max_connections
+    MAX_PER_IP = args.max_per_ip
+    MESSAGE_RATE = args.message_rate
+    MESSAGE_BURST = args.message_burst
+    FILE_PORT = args.file_port
+    UNIX_PATH = args.unix
+    HANDOFF_PATH = args.handoff
+    if args.tls_cert:
+        # loaded once here, every connection (and every worker) shares it
+        tls_context = server_context(args.tls_cert, args.tls_key)
+    SPOOL_DIR = args.spool
+    MAX_FILE_SIZE = args.max_file_size
+    history = RoomHistory(args.history_size, args.history_bytes, args.replay)
+    chatlog.configure(level=args.log_level, sample=args.log_sample, file=args.log_file,
+                      max_bytes=args.log_max_bytes, backups=args.log_backups)
+    inherited = None
+    if HANDOFF_PATH:
+        import handoff
+        inherited = handoff.take_over(HANDOFF_PATH)
+    if inherited is not None:
+        # the old server's history is newer than the store's (and the same
+        # otherwise), so no load_history() then
+        inherited.restore(history, clients.senders)
+        print(f"Took over {len(inherited.clients)} clients from the old server "
+              f"in {inherited.info.get('ms')} ms")
+    if args.store:
+        store = MessageStore(args.store, args.store_segment_bytes).open()
+        if inherited is None:
+            count = store.load_history(history, clients.senders)
+            print(f"Loaded {count} messages from {args.store}")
+        # new ids are written down too, or their messages would lose their
+        # names on the next restart
+        clients.senders.on_new = store.remember_name
+
+    if args.engine == 'asyncio':
+        # only import it when asked for so the basic version stays simple
+        import async_chat_server
+        async_chat_server.run(HOST, PORT, unix_path=UNIX_PATH, tls=tls_context,
+                              max_queue=MAX_QUEUE, policy=SLOW_POLICY,
+                              flush_bytes=FLUSH_BYTES, flush_delay=FLUSH_DELAY,
+                              compress_min_size=COMPRESS_MIN_SIZE,
+                              compress_level=COMPRESS_LEVEL,
+                              ping_interval=PING_INTERVAL, idle_timeout=IDLE_TIMEOUT,
+                              backlog=BACKLOG,
+                              admission=Admission(MAX_CONNECTIONS, MAX_PER_IP,
+                                                  MESSAGE_RATE, MESSAGE_BURST),
+                              metrics_port=args.metrics_port, history=history,
+                              senders=clients.senders,
+                              store=store.start() if store else None,
+                              spool=start_file_server())
+    elif args.workers > 1:
+        import sharded_server
+        sharded_server.run(args.workers, metrics_port=args.metrics_port)
+    else:
+        if store:
+            store.start()
+        run_threaded(metrics_port=args.metrics_port, inherited=inherited)
+    if store:
+        store.close()
+
+
 if __name__ == "__main__":
-    main()
+    # run main() in the importable chat_server module, not in __main__, so the
+    # settings it changes are the ones sharded_server (which does
+    # "import chat_server") sees too
+    import chat_server
+    chat_server.main()
@@ -0,0 +1,262 @@
+"""
+Logging for the chat servers that never blocks a client thread (or the loop)
+
+Calling info()/debug()/... just checks the level, maybe samples, and puts a
+small tuple on a queue - no formatting and no writing. A background thread
+picks up everything that piled up, formats it and writes it out in one go,
+so a slow terminal or a full pipe only slows down the log thread. If it falls
+too far behind, new records are dropped (and counted) instead of waiting.
+
+    chatlog.info('join', "[+] {name} joined the chat (from {addr})",
+                 name=name, addr=addr)
+
+The first argument is the event name, the message is a template that is
+filled in from the fields on the log thread (a message without fields is
+used as is, so it is fine to pass text with braces in it). The fields also
+go into the JSON-lines file as they are.
+
+Per message logging can be sampled or turned off without touching the rest:
+
+    python chat_server.py --log-sample message=0.01   # 1 in 100 chat messages
+    python chat_server.py --log-level warning         # only problems
+    python chat_server.py --log-file chat.jsonl       # + rotating json lines file
+"""
+
+import atexit
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+
+import metrics
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {v: k for k, v in LEVELS.items()}
+
+MAX_PENDING = 100000        # records waiting for the log thread before we start dropping
+FLUSH_INTERVAL = 0.05       # the log thread writes at least this often
+BATCH_WAKEUP = 1000         # ...or as soon as this many records are waiting
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUPS = 5
+
+
+def _render(template, fields):
+    if not fields:
+        return template
+    try:
+        return template.format(**fields)
+    except (KeyError, IndexError, ValueError):
+        return f"{template} {fields}"
+
+
+class ConsoleSink:
+    """plain text lines, like the old print() output"""
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def write(self, records):
+        stream = self.stream or sys.stdout
+        stream.write(''.join(text + '\n' for _, _, _, text, _ in records))
+        stream.flush()
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink:
+    """one json object per line, rotated to path.1, path.2, ... at max_bytes"""
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = None
+        self.size = 0
+
+    def _open(self):
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.size = self.file.tell()
+
+    def _rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def write(self, records):
+        if self.file is None:
+            self._open()
+        lines = []
+        for ts, level, event, text, fields in records:
+            entry = {'ts': round(ts, 6), 'level': LEVEL_NAMES.get(level, level),
+                     'event': event, 'msg': text}
+            if fields:
+                entry.update(fields)
+            lines.append(json.dumps(entry, default=str, ensure_ascii=False) + '\n')
+        data = ''.join(lines)
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+        if self.max_bytes and self.size >= self.max_bytes:
+            self._rotate()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Logger:
+    def __init__(self, level=INFO, sinks=None, sample=None):
+        self.level = level
+        self.sinks = [ConsoleSink()] if sinks is None else list(sinks)
+        self.sample = dict(sample or {})  # event -> fraction of records kept
+        self.pending = deque()
+        self.dropped = 0
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()  # only for starting/stopping the thread
+        self.thread = None
+        self.stopping = False
+
+    def log(self, level, event, msg, **fields):
+        if level < self.level:
+            return
+        rate = self.sample.get(event)
+        if rate is not None and (rate <= 0 or random.random() >= rate):
+            return
+        if self.thread is None:
+            self.start()
+        if len(self.pending) >= MAX_PENDING:
+            self.dropped += 1
+            metrics.LOG_DROPPED.inc()
+            return
+        # deque.append is thread safe, no lock needed
+        self.pending.append((time.time(), level, event, msg, fields))
+        if len(self.pending) >= BATCH_WAKEUP:
+            self.wakeup.set()
+
+    def debug(self, event, msg, **fields):
+        self.log(DEBUG, event, msg, **fields)
+
+    def info(self, event, msg, **fields):
+        self.log(INFO, event, msg, **fields)
+
+    def warning(self, event, msg, **fields):
+        self.log(WARNING, event, msg, **fields)
+
+    def error(self, event, msg, **fields):
+        self.log(ERROR, event, msg, **fields)
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.stopping = False
+                self.thread = threading.Thread(target=self._run, name="chatlog", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while not self.stopping:
+            self.wakeup.wait(FLUSH_INTERVAL)
+            self.wakeup.clear()
+            self._write_pending()
+        self._write_pending()
+
+    def _write_pending(self):
+        if not self.pending:
+            return
+        records = []
+        pop = self.pending.popleft
+        try:
+            while True:
+                ts, level, event, msg, fields = pop()
+                records.append((ts, level, event, _render(msg, fields), fields))
+        except IndexError:
+            pass
+        for sink in self.sinks:
+            try:
+                sink.write(records)
+            except Exception as e:
+                # nowhere better to complain, but dont kill the log thread
+                sys.stderr.write(f"chatlog: {type(sink).__name__} failed: {e}\n")
+
+    def close(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+            if thread is not None:
+                self.stopping = True
+                self.wakeup.set()
+                thread.join()
+        self._write_pending()
+        for sink in self.sinks:
+            sink.close()
+
+    def _after_fork(self):
+        # the log thread didnt come along into the child, start a fresh one on
+        # the next log() and dont write the parent's leftovers twice
+        self.thread = None
+        self.lock = threading.Lock()
+        self.pending.clear()
+
+
+LOGGER = Logger()
+debug = LOGGER.debug
+info = LOGGER.info
+warning = LOGGER.warning
+error = LOGGER.error
+
+atexit.register(LOGGER.close)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=LOGGER._after_fork)
+
+
+def configure(level=None, sample=None, console=True, file=None,
+              max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS, sinks=()):
+    """sets up the shared LOGGER, call it before the server starts logging"""
+    LOGGER.close()
+    if level is not None:
+        LOGGER.level = parse_level(level) if isinstance(level, str) else level
+    if sample is not None:
+        LOGGER.sample = dict(sample)
+    new_sinks = [ConsoleSink()] if console else []
+    if file:
+        new_sinks.append(JsonLinesSink(file, max_bytes, backups))
+    new_sinks.extend(sinks)
+    LOGGER.sinks = new_sinks
+
+
+def log_to_worker_files(index):
+    """in multi process mode every worker gets its own file (chat.jsonl.w0, ...)
+    so they dont rotate each other's files away"""
+    for sink in LOGGER.sinks:
+        if isinstance(sink, JsonLinesSink):
+            sink.close()
+            sink.path = f"{sink.path}.w{index}"
+
+
+def parse_level(text):
+    try:
+        return LEVELS[text.lower()]
+    except KeyError:
+        raise ValueError(f"unknown log level {text!r}, use one of {', '.join(LEVELS)}")
+
+
+def parse_sample(text):
+    """'message=0.01' -> ('message', 0.01), for argparse"""
+    event, sep, rate = text.partition('=')
+    if not sep:
+        raise ValueError(f"expected event=rate, got {text!r}")
+    return event.strip(), float(rate)
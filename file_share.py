@@ -0,0 +1,381 @@
+"""
+File sharing - big files go next to the chat, not through it
+
+Pasting a 5MB log as a chat message makes it go through every chat
+connection in the room, in front of everyone's messages. Instead:
+
+    /send ./build.log     the client uploads the file over a separate file
+                          connection, then offers it in the room (OFFER)
+    /get 3fa9c2...        anyone who saw the offer (FILE) downloads it, again
+                          over a file connection of its own
+
+The server listens for file connections on a second port (--file-port, the
+chat port + 1 by default). A file connection starts with one message (see
+protocol.py) and is closed after one transfer:
+
+    UPLOAD   name + size, then exactly size raw bytes  ->  STORED with the file id
+    DOWNLOAD file id                                   ->  SENDING with the size, then the bytes
+
+Uploads are streamed into the spool directory (--spool) with recv_into() on
+one buffer, so a file is never held in memory as a whole. Downloads go out
+with sendfile in chunks (os.sendfile underneath), the kernel copies from the
+page cache to the socket and the bytes never come into python at all. Every
+transfer has its own thread, none of them are chat threads, and recv and
+sendfile let go of the GIL while they wait - a 1GB download doesnt hold
+up anybody's messages.
+
+With --tls-cert the file port speaks tls too (handshake on the transfer's
+own thread). The kernel cant encrypt for us, so then sendfile quietly turns
+into send() calls of the encrypted chunks - encryption over zero copy.
+
+File ids are random, so only people who saw the offer can fetch a file.
+Spooled files are deleted FILE_TTL after the upload.
+"""
+
+import os
+import secrets
+import socket
+import tempfile
+import threading
+import time
+
+import chatlog
+import metrics
+import transport
+from framing import HEADER, HEADER_SIZE, MAX_FRAME, FrameError
+from protocol import (DOWNLOAD, FILE, SENDING, STORED, UPLOAD, decode_message, encode_message,
+                      ProtocolError, make_offer, notice, parse_offer)
+
+DEFAULT_SPOOL = os.path.join(tempfile.gettempdir(), 'chat-spool')
+DEFAULT_MAX_FILE_SIZE = 100 * 1024 * 1024
+DEFAULT_MAX_TRANSFERS = 32      # at once, past that new ones are told to try again
+FILE_TTL = 24 * 3600            # seconds a spooled file is kept
+ID_BYTES = 16                   # file ids are this many random bytes, in hex
+MAX_NAME = 200
+
+CHUNK = 1 << 20                 # sendfile this much at a time (and report progress)
+RECV_BUFFER = 256 * 1024        # uploads and downloads are read into a buffer this big
+TRANSFER_TIMEOUT = 30.0         # seconds without any progress before a transfer is dropped
+
+
+class TransferError(Exception):
+    """the server said no, or the transfer broke off"""
+
+
+def recv_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        k = sock.recv_into(view[got:])
+        if not k:
+            raise ConnectionError("connection closed in the middle of a message")
+        got += k
+    return buf
+
+
+def read_message(sock):
+    """one message, reading exactly its bytes - whatever comes after it (the
+    raw file) stays in the socket"""
+    (length,) = HEADER.unpack(recv_exact(sock, HEADER_SIZE))
+    if length > MAX_FRAME:
+        raise FrameError(f"frame too big ({length} bytes)")  # compressed ones too, not used here
+    return decode_message(bytes(recv_exact(sock, length)))
+
+
+def clean_name(name):
+    """just the file name, no directories, so a download cant land somewhere else"""
+    name = os.path.basename(name.replace('\\', '/')).strip()
+    name = ''.join(c for c in name if c.isprintable())[:MAX_NAME]
+    return name if name not in ('', '.', '..') else 'file'
+
+
+def valid_id(file_id):
+    return len(file_id) == ID_BYTES * 2 and all(c in '0123456789abcdef' for c in file_id)
+
+
+class Spool:
+    """the directory uploads are kept in, one file per id"""
+
+    def __init__(self, path=DEFAULT_SPOOL, max_size=DEFAULT_MAX_FILE_SIZE, ttl=FILE_TTL):
+        self.dir = path
+        self.max_size = max_size
+        self.ttl = ttl
+        os.makedirs(path, exist_ok=True)
+
+    def path(self, file_id):
+        return os.path.join(self.dir, file_id)
+
+    def new(self):
+        """(new file id, path to write the upload to until it is complete)"""
+        file_id = secrets.token_hex(ID_BYTES)
+        return file_id, self.path(file_id) + '.part'
+
+    def size(self, file_id):
+        """size of a stored file, None if there is no such file"""
+        if not valid_id(file_id):
+            return None
+        try:
+            return os.path.getsize(self.path(file_id))
+        except OSError:
+            return None
+
+    def sweep(self):
+        """deletes what is older than ttl (and uploads that never finished)"""
+        cutoff = time.time() - self.ttl
+        try:
+            entries = list(os.scandir(self.dir))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass  # another worker got it first
+
+
+def offer_frame(spool, body, sender):
+    """the FILE message for the room from a client's OFFER, None if that file
+    isnt in the spool (or the size doesnt match, or the offer is garbage)"""
+    try:
+        file_id, name, size = parse_offer(body)
+    except ProtocolError:
+        return None
+    if spool.size(file_id) != size:
+        return None
+    return encode_message(FILE, make_offer(file_id, clean_name(name), size), sender=sender)
+
+
+class FileServer:
+    """accepts file connections, one thread per transfer"""
+
+    def __init__(self, spool, host, port, max_transfers=DEFAULT_MAX_TRANSFERS, reuse_port=False,
+                 tls=None):
+        self.spool = spool
+        self.tls = tls  # transport.server_context() or None
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.slots = threading.BoundedSemaphore(max_transfers)
+        self.sock = None
+        # transfers going on, exact (unlike the metrics gauge) - drain() waits on it
+        self.active = 0
+        self.idle = threading.Condition()
+
+    def start(self, sock=None):
+        """sock is a listening socket to use instead of making one (handoff.py)"""
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind((self.host, self.port))
+            sock.listen(64)
+        self.sock = sock
+        self.spool.sweep()
+        threading.Thread(target=self._accept_loop, name="file-server", daemon=True).start()
+        return self
+
+    def drain(self, timeout):
+        """waits until no transfer is going on, False if timeout ran out first"""
+        with self.idle:
+            return self.idle.wait_for(lambda: self.active == 0, timeout)
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return  # closed
+            if not self.slots.acquire(blocking=False):
+                try:
+                    if self.tls is None:  # no handshake just to say no
+                        conn.sendall(notice("Too many file transfers right now, try again later."))
+                except OSError:
+                    pass
+                finally:
+                    conn.close()
+                continue
+            with self.idle:
+                self.active += 1  # here, not in the thread, so drain() cant miss it
+            threading.Thread(target=self._serve, args=(conn, addr), daemon=True).start()
+
+    def _serve(self, conn, addr):
+        metrics.FILE_TRANSFERS.inc()
+        try:
+            if self.tls is not None:
+                conn = transport.accept_tls(self.tls, conn, addr)
+                if conn is None:
+                    return  # closed already
+            conn.settimeout(TRANSFER_TIMEOUT)
+            msg = read_message(conn)
+            if msg.type == UPLOAD:
+                self._upload(conn, addr, msg.text)
+            elif msg.type == DOWNLOAD:
+                self._download(conn, addr, msg.text)
+            else:
+                conn.sendall(notice("This is the file port, the chat is on the other one."))
+        except (OSError, ValueError, FrameError) as e:
+            chatlog.warning('file', "[!] file transfer with {addr} failed: {error}", addr=addr,
+                            error=e)
+        finally:
+            if conn is not None:
+                conn.close()
+            metrics.FILE_TRANSFERS.dec()
+            self.slots.release()
+            with self.idle:
+                self.active -= 1
+                self.idle.notify_all()
+
+    def _upload(self, conn, addr, header):
+        name, _, size = header.partition('\n')
+        size = int(size)
+        if not 0 <= size <= self.spool.max_size:
+            conn.sendall(notice(f"Files can be at most {self.spool.max_size} bytes."))
+            return
+        self.spool.sweep()
+        file_id, part = self.spool.new()
+        buf = bytearray(min(RECV_BUFFER, max(size, 1)))
+        view = memoryview(buf)
+        left = size
+        try:
+            with open(part, 'wb') as f:
+                while left:
+                    n = conn.recv_into(view[:min(left, len(buf))])
+                    if not n:
+                        raise ConnectionError(f"upload cut off, {left} bytes missing")
+                    f.write(view[:n])
+                    left -= n
+                    metrics.FILE_BYTES_IN.inc(n)
+            os.replace(part, self.spool.path(file_id))
+        except BaseException:
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+            raise
+        metrics.FILE_UPLOADS.inc()
+        chatlog.info('file', "[+] {addr} uploaded {name} ({size} bytes) as {id}", addr=addr,
+                     name=clean_name(name), size=size, id=file_id)
+        conn.sendall(encode_message(STORED, file_id))
+
+    def _download(self, conn, addr, file_id):
+        if not valid_id(file_id):
+            conn.sendall(notice("No such file."))
+            return
+        try:
+            f = open(self.spool.path(file_id), 'rb')
+        except OSError:
+            conn.sendall(notice("No such file (they are deleted after a day)."))
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            conn.sendall(encode_message(SENDING, str(size)))
+            offset = 0
+            while offset < size:
+                # os.sendfile underneath, and it waits for a full socket
+                # buffer with our timeout (plain os.sendfile on a socket with
+                # a timeout would just fail with EAGAIN). send() for tls
+                sent = conn.sendfile(f, offset, min(CHUNK, size - offset))
+                if not sent:
+                    raise ConnectionError("download cut off")
+                offset += sent
+                metrics.FILE_BYTES_OUT.inc(sent)
+        metrics.FILE_DOWNLOADS.inc()
+        chatlog.info('file', "[*] {addr} downloaded {id}", addr=addr, id=file_id)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+
+
+# --- client side (blocking, the clients run these on a thread of their own) ---
+
+def upload(host, port, path, progress=None, tls=None):
+    """sends a file to the server's file port, returns (file id, name, size).
+    progress(done, total) is called as it goes"""
+    size = os.path.getsize(path)
+    name = clean_name(path)
+    with transport.connect(host, port, TRANSFER_TIMEOUT, tls) as sock, open(path, 'rb') as f:
+        sock.sendall(encode_message(UPLOAD, f"{name}\n{size}"))
+        sent = 0
+        try:
+            while sent < size:
+                # zero copy on the way up too
+                n = sock.sendfile(f, sent, min(CHUNK, size - sent))
+                if not n:
+                    raise TransferError("file got shorter while sending it")
+                sent += n
+                if progress is not None:
+                    progress(sent, size)
+        except OSError:
+            # the server hung up on us, it probably said why first (too big, too busy)
+            raise TransferError(refusal(sock)) from None
+        msg = read_message(sock)
+    if msg.type != STORED:
+        raise TransferError(msg.text)
+    return msg.text, name, size
+
+
+def refusal(sock):
+    try:
+        return read_message(sock).text
+    except (OSError, ValueError, FrameError):
+        return "the server closed the connection"
+
+
+def save_path(directory, name):
+    """where to save a download called name, without overwriting anything"""
+    base, ext = os.path.splitext(clean_name(name))
+    path = os.path.join(directory, base + ext)
+    n = 1
+    while os.path.exists(path):
+        path = os.path.join(directory, f"{base} ({n}){ext}")
+        n += 1
+    return path
+
+
+def download(host, port, file_id, dest, progress=None, tls=None):
+    """fetches a file into dest (a .part file until it is complete), returns its size"""
+    with transport.connect(host, port, TRANSFER_TIMEOUT, tls) as sock:
+        sock.sendall(encode_message(DOWNLOAD, file_id))
+        msg = read_message(sock)
+        if msg.type != SENDING:
+            raise TransferError(msg.text)
+        size = int(msg.text)
+        buf = bytearray(RECV_BUFFER)
+        view = memoryview(buf)
+        got = 0
+        part = dest + '.part'
+        try:
+            with open(part, 'wb') as f:
+                while got < size:
+                    n = sock.recv_into(view[:min(size - got, len(buf))])
+                    if not n:
+                        raise TransferError(f"download cut off after {got} of {size} bytes")
+                    f.write(view[:n])
+                    got += n
+                    if progress is not None:
+                        progress(got, size)
+            os.replace(part, dest)
+        except BaseException:
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+            raise
+    return size
+
+
+def progress_steps(report, step=10):
+    """a progress(done, total) callback that calls report(percent) every step
+    percent, instead of once per chunk"""
+    last = [0]
+
+    def progress(done, total):
+        percent = 100 if not total else done * 100 // total
+        if percent >= last[0] + step or (percent == 100 and last[0] != 100):
+            last[0] = percent
+            report(percent)
+    return progress
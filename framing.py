@@ -0,0 +1,231 @@
+"""
+Message framing shared by the server and the clients
+
+TCP is a byte stream, not a message stream - two sendall() calls can show up
+in one recv(), or one message can be split across two recv() calls (and a
+multi-byte utf-8 character can get cut in half at the split). So every
+message goes over the socket as a frame:
+
+    [4 byte big-endian payload length][payload bytes]
+
+and readers push whatever recv() returned into a FrameDecoder, which hands
+back only complete payloads.
+
+Payloads can also be zlib compressed, then the top bit of the length is set
+(lengths never get near 2GB anyway). The decoder unpacks those on its own, so
+readers dont have to care. Servers only compress for clients that asked for
+it with compress=zlib in their hello (see protocol.py).
+"""
+
+import struct
+import zlib
+
+HEADER = struct.Struct('!I')
+HEADER_SIZE = HEADER.size
+
+# biggest payload we accept, anything larger is a broken or hostile peer
+MAX_FRAME = 1 << 20  # 1 MB
+
+# default read size for FrameReader
+RECV_SIZE = 65536
+
+# top bit of the length: the payload is zlib compressed
+COMPRESSED = 0x80000000
+# payloads smaller than this arent worth compressing (a few bytes saved for a
+# whole zlib call on both ends)
+DEFAULT_COMPRESS_MIN_SIZE = 512
+DEFAULT_COMPRESS_LEVEL = 6
+
+
+class FrameError(Exception):
+    """the other side sent something that isnt a valid frame"""
+
+
+def encode_frame(payload):
+    """turns a str or bytes payload into one frame ready for sendall()"""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if len(payload) > MAX_FRAME:
+        raise FrameError(f"frame too big ({len(payload)} bytes)")
+    return HEADER.pack(len(payload)) + payload
+
+
+def send_frame(sock, payload):
+    """encode + sendall in one go"""
+    sock.sendall(encode_frame(payload))
+
+
+def compress_frame(frame, level=DEFAULT_COMPRESS_LEVEL,
+                   min_size=DEFAULT_COMPRESS_MIN_SIZE):
+    """compressed copy of an encoded frame, or the frame itself if it is
+    small or doesnt get any smaller"""
+    if len(frame) - HEADER_SIZE < min_size:
+        return frame
+    packed = zlib.compress(memoryview(frame)[HEADER_SIZE:], level)
+    if len(packed) + HEADER_SIZE >= len(frame):
+        return frame
+    return HEADER.pack(len(packed) | COMPRESSED) + packed
+
+
+def _inflate(data, max_frame):
+    # max_length stops a tiny "zip bomb" frame from blowing up to gigabytes
+    d = zlib.decompressobj()
+    try:
+        payload = d.decompress(data, max_frame)
+    except zlib.error as e:
+        raise FrameError(f"bad compressed frame: {e}")
+    if d.unconsumed_tail or not d.eof:
+        raise FrameError("compressed frame too big or cut off")
+    return payload
+
+
+class FrameDecoder:
+    """incremental decoder - give it raw bytes, get back complete payloads
+
+    the bytes live in one preallocated bytearray. feed() copies data into it,
+    or a reader can skip that copy too: recv_into(decoder.buffer()) and then
+    received(n). consumed bytes are only moved out of the way when the free
+    space at the end runs out, so a recv() with 50 small messages in it
+    doesnt cost 50 buffer shifts.
+
+    payloads come back as bytes, or with copy=False as memoryviews straight
+    into the buffer. those are only good until the next buffer()/feed() call
+    (the space gets reused), whoever keeps one longer has to copy it
+    """
+
+    def __init__(self, max_frame=MAX_FRAME, size=RECV_SIZE):
+        self.buf = bytearray(size)
+        self.size = size
+        self.start = 0  # first byte not handed out yet
+        self.end = 0    # end of what we have
+        self.need = 0   # bytes the frame we are waiting on takes up in total
+        self.max_frame = max_frame
+
+    def _reserve(self, n):
+        """makes room for n more bytes after end"""
+        buf = self.buf
+        if len(buf) - self.end >= n:
+            return
+        pending = self.end - self.start
+        if pending + n > len(buf) or (not pending and len(buf) > self.size):
+            # too small (a big frame), or big and empty again: a new buffer.
+            # never resized in place, payload views might still point at it
+            new = bytearray(max(pending + n, self.size))
+            new[:pending] = memoryview(buf)[self.start:self.end]
+            self.buf = new
+        elif pending:
+            buf[:pending] = buf[self.start:self.end]  # same length, so no resize
+        self.start, self.end = 0, pending
+
+    def buffer(self):
+        """writable memoryview of the free space, for sock.recv_into()"""
+        self._reserve(max(self.need - (self.end - self.start), self.size // 4, 1))
+        return memoryview(self.buf)[self.end:]
+
+    def received(self, n, copy=True):
+        """recv_into() put n bytes into buffer(), returns the complete payloads"""
+        self.end += n
+        return self._parse(copy)
+
+    def feed(self, data, copy=True):
+        """add bytes from the socket, returns a list of payloads"""
+        n = len(data)
+        self._reserve(n)
+        self.buf[self.end:self.end + n] = data
+        self.end += n
+        return self._parse(copy)
+
+    def _parse(self, copy):
+        buf = self.buf
+        view = memoryview(buf)
+        frames = []
+        pos = self.start
+        end = self.end
+        self.need = 0
+        while end - pos >= HEADER_SIZE:
+            (length,) = HEADER.unpack_from(buf, pos)
+            compressed = length & COMPRESSED
+            length &= ~COMPRESSED
+            if length > self.max_frame:
+                raise FrameError(f"frame too big ({length} bytes)")
+            if end - pos - HEADER_SIZE < length:
+                self.need = HEADER_SIZE + length  # rest of this frame hasnt arrived yet
+                break
+            start = pos + HEADER_SIZE
+            if compressed:
+                frames.append(_inflate(view[start:start + length], self.max_frame))
+            elif copy:
+                frames.append(bytes(view[start:start + length]))
+            else:
+                frames.append(view[start:start + length])
+            pos = start + length
+
+        if pos == end:
+            pos = end = self.end = 0  # all used up, the next read starts at the front
+        self.start = pos
+        return frames
+
+    def pending(self):
+        """how many bytes are sitting in the buffer waiting for the rest of a frame"""
+        return self.end - self.start
+
+    def unparsed(self):
+        """those bytes (the start of a frame that isnt complete yet)"""
+        return bytes(memoryview(self.buf)[self.start:self.end])
+
+
+class FrameReader:
+    """blocking reader for a socket, gives back one message at a time
+
+    reads with recv_into() straight into the decoder's buffer. one read can
+    return lots of frames, the extra ones are kept in a list and handed out
+    on the next calls without touching the socket
+    """
+
+    def __init__(self, sock, recv_size=RECV_SIZE):
+        self.sock = sock
+        self.decoder = FrameDecoder(size=recv_size)
+        self.ready = []
+        self.next_index = 0
+
+    def read_view(self):
+        """the next payload as a memoryview into the receive buffer, no copy
+        at all. only good until the next read, None if the connection closed"""
+        while self.next_index >= len(self.ready):
+            self.ready = []
+            n = self.sock.recv_into(self.decoder.buffer())
+            if not n:
+                return None
+            self.ready = self.decoder.received(n, copy=False)
+            self.next_index = 0
+
+        frame = self.ready[self.next_index]
+        self.next_index += 1
+        return frame
+
+    def push(self, data):
+        """bytes read off this socket by someone else (the server we took it
+        over from, see handoff.py), handed out before anything new is read"""
+        self.ready = self.ready[self.next_index:] + self.decoder.feed(data, copy=False)
+        self.next_index = 0
+
+    def unread(self):
+        """what was read off the socket but not handed out yet, framed again
+        (plus the start of a frame still coming in) - for handing the
+        connection to another process"""
+        rest = b''.join(encode_frame(frame) for frame in self.ready[self.next_index:])
+        return rest + self.decoder.unparsed()
+
+    def read_frame(self):
+        """returns the next payload as bytes, or None if the connection closed"""
+        frame = self.read_view()
+        if frame is None:
+            return None
+        return bytes(frame)
+
+    def read_text(self):
+        """same as read_frame() but decoded to str"""
+        frame = self.read_view()
+        if frame is None:
+            return None
+        return str(frame, 'utf-8')
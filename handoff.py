@@ -0,0 +1,327 @@
+"""
+Hot restart - a new server takes over from the running one without anybody
+getting disconnected
+
+    python chat_server.py --handoff /tmp/chat.handoff     (first start)
+    python chat_server.py --handoff /tmp/chat.handoff     (new build, same command)
+
+A server started with --handoff listens on that unix socket for the one
+that replaces it. A new server with the same --handoff first connects there,
+and if somebody answers it takes over instead of starting from nothing:
+
+1. the old server hands over its listening sockets (chat, unix, file port,
+   metrics). they are passed as file descriptors (SCM_RIGHTS), so it is the
+   very same socket - connections waiting in the backlog stay there and the
+   new server accepts them, nobody gets "connection refused"
+2. the old server pings every client and each reader thread stops at the
+   next message that comes in (the pong at the latest), without handling
+   it. what it already read but didnt handle yet goes along with the socket
+   so no message gets lost or handled twice. the writers send out what
+   they had queued first
+3. then the sender names, the room history and one record per client (its
+   socket, name, room and those unread bytes). the new server puts them in
+   its rooms as they are - no hello, no join notices, no history replay, the
+   clients dont notice a thing
+4. the old server stops, once its file transfers are done
+
+Reading and writing on a client stop for a few milliseconds (one ping round
+trip plus sending the state), nobody reconnects. Clients that dont answer
+the ping in time (PARK_TIMEOUT), whose queue doesnt get out in time, or
+that talk tls (the encryption state lives in the old process and cant be
+passed on) are disconnected instead and simply reconnect.
+
+Thread engine and single process only (chat_server.py checks that).
+"""
+
+import json
+import socket
+import ssl
+import struct
+import threading
+import time
+
+import chatlog
+from file_share import recv_exact
+from framing import HEADER
+from protocol import PING_FRAME, SEQ, SEQ_OFFSET, decode_message
+from transport import close_unix, listen_unix
+
+# record = [kind][meta length][blob length] + meta (json) + blob, file
+# descriptors ride along with the first byte
+RECORD = struct.Struct('!BII')
+LISTENERS = ord('L')    # meta: names of the listening sockets, in the order of the fds
+NAMES = ord('N')        # blob: every sender's NAME frame
+HISTORY = ord('H')      # meta: room, blob: its history frames, oldest first
+CLIENT = ord('C')       # meta: name and room (no name = hasnt said hello yet), blob: unread bytes, 1 fd
+END = ord('E')          # everything is there, meta: some numbers for the log
+
+MAX_FDS = 8             # per record, the most is one per listener
+
+PARK_TIMEOUT = 2.0      # seconds the readers get to stop at a message boundary
+FLUSH_TIMEOUT = 1.0     # seconds a writer gets to send what it has queued
+DRAIN_TIMEOUT = 60.0    # seconds the old server waits for its file transfers
+ADOPT_TIMEOUT = 1.0     # seconds the new server waits for one client to be back in its room
+
+
+def send_record(sock, kind, meta=None, blob=b'', fds=()):
+    meta = json.dumps(meta or {}).encode('utf-8')
+    data = RECORD.pack(kind, len(meta), len(blob)) + meta + blob
+    if not fds:
+        sock.sendall(data)
+        return
+    sent = socket.send_fds(sock, [data], list(fds))
+    if sent < len(data):
+        sock.sendall(memoryview(data)[sent:])
+
+
+def recv_record(sock):
+    """(kind, meta, blob, sockets), None once the other side closed"""
+    header, fds, _, _ = socket.recv_fds(sock, RECORD.size, MAX_FDS)
+    if not header:
+        return None
+    if len(header) < RECORD.size:
+        header += recv_exact(sock, RECORD.size - len(header))
+    kind, meta_len, blob_len = RECORD.unpack(header)
+    meta = json.loads(recv_exact(sock, meta_len)) if meta_len else {}
+    blob = bytes(recv_exact(sock, blob_len)) if blob_len else b''
+    return kind, meta, blob, [socket.socket(fileno=fd) for fd in fds]
+
+
+def split_frames(blob):
+    """encoded frames back to back -> list of them (history and NAME frames)"""
+    frames = []
+    pos = 0
+    while pos < len(blob):
+        (length,) = HEADER.unpack_from(blob, pos)
+        end = pos + HEADER.size + length
+        frames.append(blob[pos:end])
+        pos = end
+    return frames
+
+
+# --- the old server ---
+
+class Handover:
+    """waits on path for the next server and gives it everything
+
+    listeners is name -> listening socket. the readers and accept loops ask
+    started (a plain attribute, they look at it for every message) and call
+    park() or pass_new() once it is True. before_end() runs once every
+    client is quiet, right before the last record (closing the message store
+    so the new server can open it). done is set once it is all over
+    """
+
+    def __init__(self, path, clients, history, listeners, before_end=None):
+        self.path = path
+        self.clients = clients      # rooms.RoomIndex
+        self.history = history      # history.RoomHistory
+        self.listeners = listeners
+        self.before_end = before_end
+        self.started = False
+        self.done = threading.Event()
+        self.parked = {}            # writer -> bytes its reader read but didnt handle
+        self.cond = threading.Condition()
+        self.send_lock = threading.Lock()  # the accept loops pass connections too
+        self.conn = None
+        self.ctl = None
+        self.handed = 0
+        self.seconds = None
+
+    def start(self):
+        self.ctl = listen_unix(self.path, 1)
+        threading.Thread(target=self._run, name="handoff", daemon=True).start()
+        return self
+
+    def close(self):
+        """normal shutdown, nobody took over"""
+        if self.conn is None:
+            close_unix(self.ctl, self.path)
+
+    def park(self, writer, unread):
+        """a reader thread stops here (and then returns without cleaning up),
+        unread is what it read off the socket and didnt handle"""
+        with self.cond:
+            self.parked[writer] = unread
+            self.cond.notify()
+
+    def pass_new(self, conn, unread=b''):
+        """a connection that has no name yet goes to the new server straight
+        away - one accepted after we started, or one whose hello came in late"""
+        try:
+            if isinstance(conn, ssl.SSLSocket):
+                return  # cant go along, it reconnects
+            with self.send_lock:
+                send_record(self.conn, CLIENT, blob=unread, fds=[conn.fileno()])
+        except OSError:
+            pass  # the new server is gone, so is this one then
+        finally:
+            conn.close()
+
+    def _run(self):
+        try:
+            self.conn, _ = self.ctl.accept()
+        except OSError:
+            return  # closed, we are shutting down
+        # the next server listens on path after us, so only close ours (dont unlink it)
+        self.ctl.close()
+        start = time.perf_counter()
+        chatlog.info('handoff', "[*] a new server is taking over, handing everything to it")
+        self.started = True
+        try:
+            names = list(self.listeners)
+            with self.send_lock:
+                send_record(self.conn, LISTENERS, {'names': names},
+                            fds=[self.listeners[name].fileno() for name in names])
+            self._quiet_down()
+            writers, dropped = self._flush()
+            if self.before_end is not None:
+                self.before_end()
+            with self.send_lock:
+                self._send_state(writers)
+                self.seconds = time.perf_counter() - start
+                send_record(self.conn, END, {'clients': len(writers), 'dropped': dropped,
+                                             'ms': round(self.seconds * 1000, 1)})
+            self.handed = len(writers)
+        except OSError as e:
+            chatlog.error('handoff', "[!] handing over failed: {error}", error=e)
+        finally:
+            self.done.set()
+
+    def _quiet_down(self):
+        """pings everyone and waits until every reader has parked (or PARK_TIMEOUT)"""
+        for writer in self.clients.all_connections():
+            writer.send(PING_FRAME)
+        deadline = time.monotonic() + PARK_TIMEOUT
+        with self.cond:
+            # people leaving in the meantime drop out of all_connections()
+            while not all(w in self.parked for w in self.clients.all_connections()):
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self.cond.wait(min(left, 0.01))
+
+    def _flush(self):
+        """lets every writer send its queue and stop, returns (writers to hand
+        over, how many get disconnected instead)"""
+        writers = []
+        dropped = 0
+        for writer in self.clients.all_connections():
+            writer.close(FLUSH_TIMEOUT)
+            with self.cond:
+                parked = writer in self.parked
+            if parked and not writer.thread.is_alive() and not isinstance(writer.sock, ssl.SSLSocket):
+                writers.append(writer)
+                continue
+            # they reconnect, the old reader (if it is still reading) does the leave
+            dropped += 1
+            try:
+                writer.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        return writers, dropped
+
+    def _send_state(self, writers):
+        senders = self.clients.senders
+        with senders.lock:
+            names = b''.join(senders.frames.values())
+        send_record(self.conn, NAMES, blob=names)
+        with self.history.lock:
+            rooms = [(room, b''.join(frame for _, frame in hist.entries))
+                     for room, hist in self.history.rooms.items()]
+        for room, frames in rooms:  # oldest first, so the new server keeps the same order
+            send_record(self.conn, HISTORY, {'room': room}, blob=frames)
+        for writer in writers:
+            meta = {'name': writer.name, 'room': self.clients.room(writer.name),
+                    'compress': writer.compress}
+            send_record(self.conn, CLIENT, meta, blob=self.parked[writer],
+                        fds=[writer.sock.fileno()])
+
+
+# --- the new server ---
+
+class Inherited:
+    """what take_over() got from the old server"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.listeners = {}     # name -> listening socket
+        self.names = []         # (sender id, name)
+        self.rooms = []         # (room, [frame, ...]), least recently used first
+        self.clients = []       # (socket, meta, unread bytes)
+        self.info = {}          # the END record's numbers
+        self.seconds = None
+
+    def _receive(self):
+        start = time.perf_counter()
+        while True:
+            record = recv_record(self.conn)
+            if record is None:
+                raise ConnectionError("the old server went away in the middle of handing over")
+            kind, meta, blob, socks = record
+            if kind == LISTENERS:
+                self.listeners = dict(zip(meta['names'], socks))
+            elif kind == NAMES:
+                for frame in split_frames(blob):
+                    msg = decode_message(memoryview(frame)[HEADER.size:])
+                    self.names.append((msg.sender, msg.text))
+            elif kind == HISTORY:
+                self.rooms.append((meta['room'], split_frames(blob)))
+            elif kind == CLIENT:
+                self.clients.append((socks[0], meta, blob))
+            elif kind == END:
+                self.info = meta
+                self.seconds = time.perf_counter() - start
+                return self
+
+    def listener(self, name, address):
+        """the old server's listening socket if it is on address, otherwise
+        None (and it is closed, the settings changed)"""
+        sock = self.listeners.pop(name, None)
+        if sock is None:
+            return None
+        if sock.getsockname() == address:
+            return sock
+        sock.close()
+        return None
+
+    def restore(self, history, senders):
+        """puts the names and room history into ours"""
+        for sender, name in self.names:
+            senders.learn(sender, name)
+        for room, frames in self.rooms:
+            for frame in frames:
+                history.restore(room, SEQ.unpack_from(frame, SEQ_OFFSET)[0], frame)
+
+    def follow(self, adopt):
+        """adopt(socket, meta, unread) for every client, then keeps listening
+        for connections the old server still accepted until it is gone"""
+        for client in self.clients:
+            adopt(*client)
+        self.clients = []
+
+        def late():
+            while True:
+                try:
+                    record = recv_record(self.conn)
+                except OSError:
+                    record = None
+                if record is None:
+                    self.conn.close()
+                    return
+                kind, meta, blob, socks = record
+                if kind == CLIENT:
+                    adopt(socks[0], meta, blob)
+
+        threading.Thread(target=late, name="handoff-late", daemon=True).start()
+
+
+def take_over(path):
+    """connects to the server on path and takes over from it. None if there
+    is nobody (then this is a normal start)"""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        conn.close()
+        return None
+    return Inherited(conn)._receive()
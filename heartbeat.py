@@ -0,0 +1,121 @@
+"""
+Finding and dropping dead connections
+
+A laptop that goes to sleep doesnt close its connection, so without this the
+server would keep its thread, socket and name around forever. Two things:
+
+- heartbeats: a client we havent heard from for ping_interval seconds gets a
+  PING message (see protocol.py) and answers with a pong. anything a
+  client sends counts, so only quiet clients get pinged at all.
+- reaping: a client that sent nothing at all for idle_timeout seconds gets
+  its socket shut down, which makes the server do the normal leave.
+
+Every connection just stores when we last heard from it (conn.last_seen, one
+assignment per message). One Reaper keeps a heap of when each connection
+should be looked at next, so there is one timer for the whole server instead
+of one per socket, and a check costs O(log n).
+
+TCP keepalive is turned on for every client socket too, so the kernel also
+notices peers that vanished completely.
+"""
+
+import heapq
+import itertools
+import socket
+import threading
+import time
+
+import metrics
+
+DEFAULT_PING_INTERVAL = 30.0    # seconds of silence before we ping
+DEFAULT_IDLE_TIMEOUT = 90.0     # seconds of silence before we give up on them
+
+KEEPALIVE_IDLE = 60             # tcp keepalive: start probing after this many idle seconds
+KEEPALIVE_INTERVAL = 10         # then probe this often
+KEEPALIVE_COUNT = 5             # and give up after this many failed probes
+
+
+def enable_keepalive(sock):
+    """turns on tcp keepalive with shorter times than the os default (2 hours)"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+        elif hasattr(socket, 'TCP_KEEPALIVE'):  # macos calls it this
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, KEEPALIVE_IDLE)
+        if hasattr(socket, 'TCP_KEEPINTVL'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+        if hasattr(socket, 'TCP_KEEPCNT'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+    except OSError:
+        pass  # not a tcp socket, or the os doesnt let us - the heartbeat still works
+
+
+class Reaper:
+    """one heap of (when to look next, conn) for every connection
+
+    ping(conn), kick(conn) and alive(conn) are supplied by the server, conn
+    needs a last_seen attribute (time.monotonic()) the server keeps updated
+    """
+
+    def __init__(self, ping, kick, alive, ping_interval=DEFAULT_PING_INTERVAL,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        if idle_timeout <= ping_interval:
+            raise ValueError("idle timeout has to be longer than the ping interval")
+        self.ping = ping
+        self.kick = kick
+        self.alive = alive
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.heap = []
+        self.order = itertools.count()  # tie breaker, conns dont compare
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def watch(self, conn):
+        """start keeping an eye on conn (it is dropped from the heap once dead)"""
+        conn.last_seen = time.monotonic()
+        self._push(conn.last_seen + self.ping_interval, conn)
+
+    def _push(self, due, conn):
+        with self.lock:
+            heapq.heappush(self.heap, (due, next(self.order), conn))
+            first = self.heap[0][2] is conn
+        if first:
+            self.wakeup.set()  # sooner than whatever the thread is waiting for
+
+    def expire(self, now=None):
+        """checks everything that is due, returns seconds until the next check"""
+        if now is None:
+            now = time.monotonic()
+        while True:
+            with self.lock:
+                if not self.heap:
+                    return None
+                due, _, conn = self.heap[0]
+                if due > now:
+                    return due - now
+                heapq.heappop(self.heap)
+            if not self.alive(conn):
+                continue  # already gone, just forget it
+            idle = now - conn.last_seen
+            if idle >= self.idle_timeout:
+                metrics.IDLE_KICKS.inc()
+                self.kick(conn)
+            elif idle >= self.ping_interval:
+                metrics.PINGS_SENT.inc()
+                self.ping(conn)
+                self._push(conn.last_seen + self.idle_timeout, conn)
+            else:
+                self._push(conn.last_seen + self.ping_interval, conn)
+
+    def run(self):
+        """for the threaded servers, runs expire() forever on its own thread"""
+        while True:
+            wait = self.expire()
+            self.wakeup.wait(wait)
+            self.wakeup.clear()
+
+    def start(self):
+        threading.Thread(target=self.run, name="reaper", daemon=True).start()
+        return self
@@ -0,0 +1,143 @@
+"""
+Recent message history, so people joining a room get some context
+
+Every room keeps a ring buffer of its last messages as already-encoded
+frames (so replaying them costs no encoding at all), bounded both by number
+of messages and by total bytes. Each message gets a sequence number per room.
+
+When someone joins a room they get the last N messages in one write. A client
+that reconnects can send since=<seq> in its hello (see protocol.py) and only
+gets the messages after that one instead of the usual last N.
+
+The seq goes into the message itself too (record() stamps it in), so the
+clients know which number they are at.
+"""
+
+import bisect
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
+
+from protocol import ROOM, encode_message, sender_of, stamp_seq
+
+DEFAULT_HISTORY_SIZE = 500              # messages kept per room
+DEFAULT_HISTORY_BYTES = 1024 * 1024     # and at most this many bytes per room
+DEFAULT_REPLAY = 20                     # how many a new client gets
+MAX_ROOMS = 1000                        # rooms with history, least recently used go first
+
+
+class MessageHistory:
+    """ring buffer of (seq, frame) for one room"""
+
+    def __init__(self, max_messages=DEFAULT_HISTORY_SIZE, max_bytes=DEFAULT_HISTORY_BYTES):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.entries = deque()
+        self.seqs = deque()  # the entries' seqs on their own, for since() to bisect on
+        self.bytes = 0
+        self.last_seq = 0
+
+    def append(self, frame, seq=None):
+        """adds a frame, seq is only given when restoring (see message_store.py)
+
+        returns (seq, frame), a new message comes back with its seq stamped in
+        """
+        if seq is not None and seq <= self.last_seq:
+            # client threads can hand messages to the store a tiny bit out of
+            # order, put it back where it belongs (always near the end)
+            i = len(self.entries)
+            while i and self.entries[i - 1][0] > seq:
+                i -= 1
+            self.entries.insert(i, (seq, frame))
+            self.seqs.insert(i, seq)
+        elif seq is None:
+            self.last_seq += 1
+            frame = stamp_seq(frame, self.last_seq)
+            self.entries.append((self.last_seq, frame))
+            self.seqs.append(self.last_seq)
+        else:
+            self.last_seq = seq
+            self.entries.append((seq, frame))
+            self.seqs.append(seq)
+        self.bytes += len(frame)
+        while self.entries and (len(self.entries) > self.max_messages or self.bytes > self.max_bytes):
+            _, old = self.entries.popleft()
+            self.seqs.popleft()
+            self.bytes -= len(old)
+        return self.last_seq, frame
+
+    def last(self, n):
+        """frames of the last n messages, oldest first"""
+        if n <= 0:
+            return []
+        start = max(0, len(self.entries) - n)
+        return [frame for _, frame in islice(self.entries, start, None)]
+
+    def since(self, seq):
+        """frames of every message after seq that is still in the buffer"""
+        # bisect on the seqs instead of counting from the first one, restored
+        # messages (see append()) dont have to be consecutive
+        start = bisect.bisect_right(self.seqs, seq)
+        return [frame for _, frame in islice(self.entries, start, None)]
+
+
+class RoomHistory:
+    """one MessageHistory per room, made the first time a room gets a message
+
+    histories outlive their room being empty (thats when context is most
+    useful), but only the MAX_ROOMS most recently active rooms keep one
+    """
+
+    def __init__(self, max_messages=DEFAULT_HISTORY_SIZE, max_bytes=DEFAULT_HISTORY_BYTES,
+                 replay=DEFAULT_REPLAY):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self.rooms = OrderedDict()
+        self.lock = threading.Lock()
+
+    def record(self, room, frame):
+        """stores a frame, returns (its sequence number in the room, the frame
+        with that number in it) - send that one, not the one passed in"""
+        return self.restore(room, None, frame)
+
+    def restore(self, room, seq, frame):
+        """record() with a known seq, for filling up from the message store"""
+        with self.lock:
+            hist = self.rooms.get(room)
+            if hist is None:
+                hist = self.rooms[room] = MessageHistory(self.max_messages, self.max_bytes)
+                if len(self.rooms) > MAX_ROOMS:
+                    self.rooms.popitem(last=False)
+            else:
+                self.rooms.move_to_end(room)
+            return hist.append(frame, seq)
+
+    def catch_up(self, room, since=None):
+        """(frames, last seq) for someone joining room
+
+        since=None means the usual last N, otherwise everything after since
+        """
+        with self.lock:
+            hist = self.rooms.get(room)
+            if hist is None:
+                return [], 0
+            if since is None or since > hist.last_seq:
+                # a since above the newest seq is from before the room's history
+                # was dropped (MAX_ROOMS) and started over at 1, it means
+                # nothing here anymore - they get the usual last N
+                frames = hist.last(self.replay)
+            else:
+                frames = hist.since(since)
+            return frames, hist.last_seq
+
+    def send_catch_up(self, conn, room, since=None, senders=None):
+        """replays room's history to conn plus a note with the latest seq, as one write
+
+        senders (rooms.Senders) adds the names of whoever wrote those messages
+        """
+        frames, last_seq = self.catch_up(room, since)
+        names = b''
+        if senders is not None and frames:
+            names = senders.introductions(conn, dict.fromkeys(sender_of(f) for f in frames))
+        conn.send(names + b''.join(frames) + encode_message(ROOM, room, seq=last_seq))
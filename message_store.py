@@ -0,0 +1,276 @@
+"""
+Durable message log, so a restart doesnt lose the chat
+
+    python chat_server.py --store ./chatlog-data
+
+Every recorded chat message is appended to a log made of segment files
+(<first offset>.seg, a new one every --store-segment-bytes). A record is
+
+    [body length][crc32 of body][offset][room seq][room name length]  + body
+    body = room name + the client frame exactly as it went out
+
+Appending never blocks the broadcast: fan-out hands the already encoded frame
+to append(), which just puts it on a queue. A writer thread takes whatever
+piled up, writes it with one write() and then does one fsync for the whole
+batch (group commit) - while that fsync runs the next batch piles up.
+
+Reading goes through mmap: records() hands back memoryviews into the mapped
+segment, nothing is copied until the caller wants to keep it. Each segment
+has a sparse offset -> file position index (every INDEX_EVERY records) so
+reading from an offset jumps close to it and scans the rest.
+
+On startup the segments are scanned, a half written record at the end (crash
+during write) is cut off, and load_history() fills RoomHistory back up.
+
+Messages only carry sender ids (see protocol.py), so the NAME message of
+every id goes into the log too, as a record with an empty room name.
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+
+import chatlog
+import metrics
+from protocol import FRAME, is_current, sender_of
+
+RECORD = struct.Struct('!IIQQH')   # body length, crc32, offset, room seq, room name length
+SEGMENT_SUFFIX = '.seg'
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+DEFAULT_COMMIT_DELAY = 0.002    # wait this long for more records before writing a batch
+INDEX_EVERY = 64                # index one record in this many
+NAMES_ROOM = ''                 # room of the sender id -> name records
+
+
+class Segment:
+    def __init__(self, path, base):
+        self.path = path
+        self.base = base        # offset of the first record
+        self.next = base        # offset the next record would get
+        self.size = 0           # bytes of complete records
+        self.index_offsets = []
+        self.index_positions = []
+
+    def note(self, offset, pos):
+        if (offset - self.base) % INDEX_EVERY == 0:
+            self.index_offsets.append(offset)
+            self.index_positions.append(pos)
+
+    def position_of(self, offset):
+        """file position of the nearest indexed record at or before offset"""
+        i = bisect.bisect_right(self.index_offsets, offset) - 1
+        return self.index_positions[i] if i >= 0 else 0
+
+    def scan(self):
+        """rebuilds the index from the file, returns where the valid records end"""
+        self.index_offsets.clear()
+        self.index_positions.clear()
+        self.next = self.base
+        with open(self.path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            if file_size == 0:
+                return 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                pos = 0
+                while pos + RECORD.size <= file_size:
+                    length, crc, offset, _, _ = RECORD.unpack_from(mm, pos)
+                    end = pos + RECORD.size + length
+                    if end > file_size or offset != self.next:
+                        break
+                    if zlib.crc32(mm[pos + RECORD.size:end]) != crc:
+                        break
+                    self.note(offset, pos)
+                    self.next = offset + 1
+                    pos = end
+        self.size = pos
+        return pos
+
+
+class MessageStore:
+    def __init__(self, path, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 commit_delay=DEFAULT_COMMIT_DELAY):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.commit_delay = commit_delay
+        self.segments = []
+        self.pending = deque()
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()    # segments list + active segment size
+        self.fd = None
+        self.thread = None
+        self.stopping = False
+
+    # --- startup ---
+
+    def open(self):
+        """finds the segments, cuts off a torn last record, builds the indexes"""
+        os.makedirs(self.path, exist_ok=True)
+        bases = sorted(int(n[:-len(SEGMENT_SUFFIX)]) for n in os.listdir(self.path)
+                       if n.endswith(SEGMENT_SUFFIX) and n[:-len(SEGMENT_SUFFIX)].isdigit())
+        for base in bases:
+            seg = Segment(self._segment_path(base), base)
+            valid = seg.scan()
+            if os.path.getsize(seg.path) != valid:
+                chatlog.warning('store', "[!] {path} has a broken record at {pos}, cutting it off",
+                                path=seg.path, pos=valid)
+                os.truncate(seg.path, valid)
+            if self.segments and seg.base != self.segments[-1].next:
+                chatlog.warning('store', "[!] gap in the message store before {path}",
+                                path=seg.path)
+            self.segments.append(seg)
+        if not self.segments:
+            self.segments.append(Segment(self._segment_path(0), 0))
+        self.fd = os.open(self.segments[-1].path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        return self
+
+    def start(self):
+        """starts the writer thread, only the process that appends needs it"""
+        self.thread = threading.Thread(target=self._run, name="message-store", daemon=True)
+        self.thread.start()
+        return self
+
+    def _segment_path(self, base):
+        return os.path.join(self.path, f"{base:020d}{SEGMENT_SUFFIX}")
+
+    @property
+    def next_offset(self):
+        return self.segments[-1].next
+
+    # --- writing ---
+
+    def append(self, room, seq, frame):
+        """queues a record, never blocks (called right after fan-out)"""
+        self.pending.append((room, seq, frame))
+        if len(self.pending) == 1:
+            self.wakeup.set()
+
+    def remember_name(self, frame):
+        """keeps a NAME message, so ids in old messages still have a name after a restart"""
+        self.append(NAMES_ROOM, 0, frame)
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            if self.commit_delay and not self.stopping:
+                time.sleep(self.commit_delay)  # let a few more records pile up
+            self._commit()
+            if self.stopping and not self.pending:
+                return
+
+    def _commit(self):
+        """writes everything pending with one write and one fsync"""
+        if not self.pending:
+            return
+        seg = self.segments[-1]
+        chunks = []
+        positions = []
+        pos = seg.size
+        offset = seg.next
+        pop = self.pending.popleft
+        while self.pending:
+            room, seq, frame = pop()
+            name = room.encode('utf-8')
+            body = name + frame
+            chunks.append(RECORD.pack(len(body), zlib.crc32(body), offset, seq, len(name)))
+            chunks.append(body)
+            positions.append(pos)
+            pos += RECORD.size + len(body)
+            offset += 1
+        try:
+            os.write(self.fd, b''.join(chunks))
+            start = time.perf_counter()
+            os.fsync(self.fd)
+            metrics.STORE_FSYNC_SECONDS.observe(time.perf_counter() - start)
+        except OSError as e:
+            # dont leave half a batch in the file, the next one would land after it
+            try:
+                os.ftruncate(self.fd, seg.size)
+            except OSError:
+                pass  # open() cuts it off next time then
+            chatlog.error('store', "[!] couldnt write the message store, lost {n} messages: "
+                                   "{error}", n=len(positions), error=e)
+            return
+        with self.lock:
+            for i, record_pos in enumerate(positions):
+                seg.note(seg.next + i, record_pos)
+            seg.size = pos
+            seg.next = offset
+        metrics.STORE_RECORDS.inc(len(positions))
+        if seg.size >= self.segment_bytes:
+            self._roll()
+
+    def _roll(self):
+        """starts a new segment, the old one is never written again"""
+        base = self.segments[-1].next
+        fd = os.open(self._segment_path(base), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        os.close(self.fd)
+        self.fd = fd
+        with self.lock:
+            self.segments.append(Segment(self._segment_path(base), base))
+
+    def close(self):
+        if self.thread is not None:
+            self.stopping = True
+            self.wakeup.set()
+            self.thread.join()
+            self.thread = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    # --- reading ---
+
+    def records(self, since=0):
+        """yields (offset, seq, room, frame) for every record from offset since on
+
+        frame is a memoryview into the mmapped segment, only valid until the
+        next record is asked for - copy it (bytes(frame)) to keep it
+        """
+        with self.lock:
+            segments = [(seg, seg.size) for seg in self.segments if seg.next > since]
+        for seg, size in segments:
+            if size == 0:
+                continue
+            with open(seg.path, 'rb') as f, \
+                    mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+                    pos = seg.position_of(since) if since > seg.base else 0
+                    while pos < size:
+                        length, _, offset, seq, room_len = RECORD.unpack_from(mm, pos)
+                        body = pos + RECORD.size
+                        pos = body + length
+                        if offset < since:
+                            continue
+                        room = bytes(view[body:body + room_len]).decode('utf-8')
+                        frame = view[body + room_len:pos]
+                        try:
+                            yield offset, seq, room, frame
+                        finally:
+                            frame.release()
+                finally:
+                    view.release()
+
+    def load_history(self, history, senders=None):
+        """puts everything in the log back into a RoomHistory (it keeps the newest),
+        and the sender names into senders (rooms.Senders)"""
+        count = 0
+        old = 0
+        for _, seq, room, frame in self.records():
+            if not is_current(frame):
+                old += 1  # from before the binary protocol, clients couldnt read it
+            elif room == NAMES_ROOM:
+                if senders is not None:
+                    senders.learn(sender_of(frame), bytes(frame[FRAME.size:]).decode('utf-8'))
+            else:
+                history.restore(room, seq, bytes(frame))
+                count += 1
+        if old:
+            chatlog.warning('store', "[!] skipped {n} messages in an old format", n=old)
+        return count
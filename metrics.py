@@ -0,0 +1,248 @@
+"""
+Tiny metrics library for the chat servers
+
+Counters, gauges and histograms that are cheap to update (an add, or a
+bisect for histograms - no string formatting, no locks) and a small HTTP
+endpoint that renders them in the Prometheus text format:
+
+    python chat_server.py --metrics-port 9100
+    curl http://127.0.0.1:9100/metrics
+
+Gauges can also be computed when someone scrapes (func=...), that is how
+active connections and per client queue depth work, so the hot path doesnt
+pay for them at all.
+
+Updates arent locked, so under heavy threading a counter can very
+occasionally lose an increment. That is fine for metrics and much cheaper
+than a lock per message.
+"""
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds, from 10us up to 1s - broadcast and lock wait times live at the low end
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        yield self.name, None, self.value
+
+
+class Gauge:
+    """a value that goes up and down, or func() computed at scrape time"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, func=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def samples(self):
+        yield self.name, None, self.func() if self.func else self.value
+
+
+class LabeledGauge:
+    """one gauge per label value, func() returns (label value, number) pairs"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, label, func=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.func = func
+
+    def samples(self):
+        if self.func is None:
+            return
+        for label_value, value in self.func():
+            yield self.name, {self.label: label_value}, value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        total = 0
+        for bound, n in zip(self.bounds, self.counts):
+            total += n
+            yield self.name + '_bucket', {'le': repr(bound)}, total
+        yield self.name + '_bucket', {'le': '+Inf'}, total + self.counts[-1]
+        yield self.name + '_sum', None, self.sum
+        yield self.name + '_count', None, self.count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def gauge(self, name, help, func=None):
+        return self.register(Gauge(name, help, func))
+
+    def labeled_gauge(self, name, help, label, func=None):
+        return self.register(LabeledGauge(name, help, label, func))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self):
+        """everything in the prometheus text format"""
+        lines = []
+        for m in self.metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for name, labels, value in m.samples():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def serve(port, host='127.0.0.1', registry=REGISTRY, sock=None):
+    """starts the /metrics http endpoint on a background thread. sock is a
+    listening socket to use instead of binding port (see handoff.py)"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/metrics', '/'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # dont spam the server console with scrapes
+
+    server = ThreadingHTTPServer((host, port), Handler, bind_and_activate=sock is None)
+    if sock is not None:
+        server.socket.close()
+        server.socket = sock
+    server.daemon_threads = True
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    return server
+
+
+# --- the chat server's metrics, shared by every engine ---
+
+MESSAGES_IN = REGISTRY.counter('chat_messages_in_total', "Messages received from clients")
+BYTES_IN = REGISTRY.counter('chat_bytes_in_total', "Payload bytes received from clients")
+MESSAGES_OUT = REGISTRY.counter('chat_messages_out_total', "Frames queued for clients")
+BYTES_OUT = REGISTRY.counter('chat_bytes_out_total', "Bytes queued for clients")
+SEND_CALLS = REGISTRY.counter('chat_send_calls_total',
+                              "Send syscalls (or transport writes) made for clients")
+FRAMES_SENT = REGISTRY.counter('chat_frames_sent_total', "Frames actually written to sockets")
+FRAMES_DROPPED = REGISTRY.counter('chat_frames_dropped_total',
+                                  "Frames dropped because a client's queue was full")
+SLOW_KICKS = REGISTRY.counter('chat_slow_disconnects_total',
+                              "Clients disconnected for not keeping up")
+BROADCAST_SECONDS = REGISTRY.histogram('chat_broadcast_seconds', "Time spent in one broadcast")
+LOCK_WAIT_SECONDS = REGISTRY.histogram('chat_registry_lock_wait_seconds',
+                                       "Time joins, leaves and room switches waited for the client "
+                                       "registry lock (broadcasts dont take it)")
+PINGS_SENT = REGISTRY.counter('chat_pings_sent_total', "Heartbeat pings sent to quiet clients")
+IDLE_KICKS = REGISTRY.counter('chat_idle_disconnects_total',
+                              "Clients disconnected for not answering heartbeats")
+REJECTED_FULL = REGISTRY.counter('chat_rejected_server_full_total',
+                                 "Connections turned away because the server was full")
+REJECTED_PER_IP = REGISTRY.counter('chat_rejected_per_ip_total',
+                                   "Connections turned away by the per address limit")
+RATE_LIMITED = REGISTRY.counter('chat_rate_limited_messages_total',
+                                "Messages dropped because a client went over its rate limit")
+LIMIT_MAX_CONNECTIONS = REGISTRY.gauge('chat_limit_max_connections',
+                                       "Configured connection limit (0 = none)")
+LIMIT_MAX_PER_IP = REGISTRY.gauge('chat_limit_max_connections_per_ip',
+                                  "Configured connections per address limit (0 = none)")
+LIMIT_MESSAGE_RATE = REGISTRY.gauge('chat_limit_message_rate',
+                                    "Configured messages per second per client (0 = none)")
+LIMIT_MESSAGE_BURST = REGISTRY.gauge('chat_limit_message_burst',
+                                     "Configured message burst per client")
+LOG_DROPPED = REGISTRY.counter('chat_log_records_dropped_total',
+                               "Log records dropped because the log thread fell behind")
+STORE_RECORDS = REGISTRY.counter('chat_store_records_total',
+                                 "Messages written to the durable message store")
+STORE_FSYNC_SECONDS = REGISTRY.histogram('chat_store_fsync_seconds',
+                                         "Time one group commit fsync took")
+COMPRESSED_FRAMES = REGISTRY.counter('chat_compressed_frames_total',
+                                     "Broadcasts compressed (once each, however many got them)")
+COMPRESSION_SAVED_BYTES = REGISTRY.counter('chat_compression_saved_bytes_total',
+                                           "Bytes not sent thanks to compression")
+COMPRESS_SECONDS = REGISTRY.histogram('chat_compress_seconds', "Time compressing one broadcast")
+FILE_UPLOADS = REGISTRY.counter('chat_file_uploads_total', "Files uploaded to the spool")
+FILE_DOWNLOADS = REGISTRY.counter('chat_file_downloads_total', "Files sent to clients")
+FILE_BYTES_IN = REGISTRY.counter('chat_file_bytes_in_total', "File bytes received")
+FILE_BYTES_OUT = REGISTRY.counter('chat_file_bytes_out_total', "File bytes sent (sendfile)")
+FILE_TRANSFERS = REGISTRY.gauge('chat_file_transfers', "Uploads and downloads going on right now")
+TLS_HANDSHAKES = REGISTRY.counter('chat_tls_handshakes_total', "TLS handshakes completed")
+TLS_RESUMED = REGISTRY.counter('chat_tls_resumed_total',
+                               "TLS handshakes that resumed a session (no certificate exchange)")
+TLS_FAILURES = REGISTRY.counter('chat_tls_handshake_failures_total',
+                                "TLS handshakes that failed or timed out (thread engines)")
+TLS_HANDSHAKE_SECONDS = REGISTRY.histogram('chat_tls_handshake_seconds',
+                                           "Time one TLS handshake took (thread engines)")
+ACTIVE_CONNECTIONS = REGISTRY.gauge('chat_active_connections', "Clients currently connected")
+QUEUE_DEPTH = REGISTRY.labeled_gauge('chat_client_queue_depth',
+                                     "Frames waiting to be sent, per client", 'client')
+
+
+def watch_clients(clients):
+    """point the scrape-time gauges at a server's RoomIndex"""
+    ACTIVE_CONNECTIONS.func = lambda: len(clients)
+    QUEUE_DEPTH.func = lambda: ((conn.name, conn.depth()) for conn in clients.all_connections())
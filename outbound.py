@@ -0,0 +1,219 @@
+"""
+Per client outbound queues for the threaded servers
+
+broadcast() used to call sendall() on every client while holding the lock,
+so one client that stopped reading (full tcp buffer) blocked every other
+sender. Now each client gets a ClientWriter: a small bounded queue of
+already-encoded frames plus its own writer thread that does the sendall().
+broadcast() just encodes once and appends the same bytes to every queue.
+
+If a client cant keep up and its queue fills, the slow consumer policy kicks in:
+  drop-oldest - throw away the oldest queued frame (they miss some messages)
+  disconnect  - kick them, the normal leave message goes out
+
+The writer also coalesces: when it wakes up it takes everything that is
+queued (waiting up to flush_delay for more if there is only a little) and
+sends it with one sendmsg() call, so a burst of 100 broadcasts costs a
+handful of syscalls per client instead of 100.
+
+TLS sockets cant do sendmsg(), for them the batch is joined and goes out
+with one sendall() - one write, so still only a few tls records per batch.
+
+Clients that asked for compression get big broadcasts compressed. That
+happens once per broadcast (compressed_copy()), everyone who wants it gets
+the same compressed bytes.
+"""
+
+import socket
+import ssl
+import threading
+import time
+from collections import deque
+
+import metrics
+from framing import DEFAULT_COMPRESS_LEVEL, DEFAULT_COMPRESS_MIN_SIZE, compress_frame
+
+DROP_OLDEST = 'drop-oldest'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, DISCONNECT)
+
+DEFAULT_MAX_QUEUE = 1000  # frames, not bytes
+
+# write coalescing - flush as soon as this many bytes are waiting...
+DEFAULT_FLUSH_BYTES = 64 * 1024
+# ...otherwise wait at most this long (seconds) for more frames to batch up
+DEFAULT_FLUSH_DELAY = 0.0005
+
+# sendmsg() takes at most IOV_MAX buffers (1024 on linux), stay well under it
+MAX_BATCH = 512
+
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')  # not on windows
+
+
+def compressed_copy(frame, targets, level=DEFAULT_COMPRESS_LEVEL,
+                    min_size=DEFAULT_COMPRESS_MIN_SIZE):
+    """(frame to send to the targets with .compress set, bytes saved overall)
+
+    small frames, or ones nobody wants compressed, come back as they are
+    """
+    if len(frame) < min_size or not any(t.compress for t in targets):
+        return frame, 0
+    start = time.perf_counter()
+    packed = compress_frame(frame, level, min_size)
+    metrics.COMPRESS_SECONDS.observe(time.perf_counter() - start)
+    if packed is frame:
+        return frame, 0  # didnt get smaller
+    saved = (len(frame) - len(packed)) * sum(1 for t in targets if t.compress)
+    metrics.COMPRESSED_FRAMES.inc()
+    metrics.COMPRESSION_SAVED_BYTES.inc(saved)
+    return packed, saved
+
+
+class ClientWriter:
+    """owns the sending side of one client socket"""
+
+    def __init__(self, sock, name=None, max_queue=DEFAULT_MAX_QUEUE, policy=DROP_OLDEST,
+                 flush_bytes=DEFAULT_FLUSH_BYTES, flush_delay=DEFAULT_FLUSH_DELAY,
+                 metered=True):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown slow consumer policy: {policy}")
+        self.sock = sock
+        self.gather = HAVE_SENDMSG and not isinstance(sock, ssl.SSLSocket)
+        self.name = name
+        self.max_queue = max_queue
+        self.policy = policy
+        self.flush_bytes = flush_bytes
+        self.flush_delay = flush_delay
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.cond = threading.Condition()  # per client, never the global lock
+        self.closed = False
+        self.dropped = 0
+        self.metered = metered  # internal links (the worker bus) stay out of the metrics
+        self.last_seen = time.monotonic()  # last time the client sent us anything, see heartbeat.py
+        self.compress = False  # client asked for compressed broadcasts in its hello
+        self.id = 0            # sender id, handed out at join (see rooms.Senders)
+        self.known = set()     # sender ids this client already got the name of
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def send(self, frame):
+        """queue one encoded frame, never blocks on the network
+
+        returns False if the frame wasnt queued (writer closed or client kicked)
+        """
+        with self.cond:
+            if self.closed:
+                return False
+            if len(self.queue) >= self.max_queue:
+                if self.policy == DISCONNECT:
+                    self._kick(metrics.SLOW_KICKS if self.metered else None)
+                    return False
+                self.queued_bytes -= len(self.queue.popleft())
+                self.dropped += 1
+                metrics.FRAMES_DROPPED.inc()
+            self.queue.append(frame)
+            self.queued_bytes += len(frame)
+            # the writer only needs waking for the first frame or once a batch is full
+            if len(self.queue) == 1 or self.queued_bytes >= self.flush_bytes:
+                self.cond.notify()
+        return True
+
+    def depth(self):
+        return len(self.queue)
+
+    def close(self, timeout=1.0):
+        """stop accepting frames, let the writer flush what is queued
+
+        waits at most timeout seconds so a stuck client cant hang whoever
+        is cleaning up
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.thread.is_alive() and threading.current_thread() is not self.thread:
+            self.thread.join(timeout)
+
+    def kick(self):
+        """disconnect the client without flushing, the reader does the leave"""
+        with self.cond:
+            if not self.closed:
+                self._kick(counter=None)
+
+    def _kick(self, counter=metrics.SLOW_KICKS):
+        # called with self.cond held. shutting the socket down wakes up the
+        # reader thread (recv returns nothing) which then does the normal leave
+        if counter is not None:
+            counter.inc()
+        self.closed = True
+        self.queue.clear()
+        self.queued_bytes = 0
+        self.cond.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    return  # closed and everything flushed
+
+                # not much waiting yet - give the senders a moment to add more
+                # so it all goes out in one syscall
+                if self.flush_delay and not self.closed and self.queued_bytes < self.flush_bytes:
+                    deadline = time.monotonic() + self.flush_delay
+                    while self.queued_bytes < self.flush_bytes and not self.closed:
+                        left = deadline - time.monotonic()
+                        if left <= 0:
+                            break
+                        self.cond.wait(left)
+
+                n = min(len(self.queue), MAX_BATCH)
+                batch = [self.queue.popleft() for _ in range(n)]
+                self.queued_bytes -= sum(map(len, batch))
+
+            try:
+                self._send_batch(batch)
+            except OSError:
+                # they went away, the reader side will notice and clean up
+                with self.cond:
+                    self.closed = True
+                    self.queue.clear()
+                    self.queued_bytes = 0
+                return
+
+    def _send_batch(self, batch):
+        if self.metered:
+            # so we can see how well coalescing works
+            metrics.FRAMES_SENT.inc(len(batch))
+            metrics.SEND_CALLS.inc()
+        if len(batch) == 1:
+            self.sock.sendall(batch[0])
+            return
+        if not self.gather:
+            self.sock.sendall(b''.join(batch))
+            return
+
+        # scatter-gather, the kernel reads straight out of each frame
+        while True:
+            sent = self.sock.sendmsg(batch)
+            # partial write (socket buffer filled up): skip what went out and
+            # go again with the rest, still without joining anything
+            i = 0
+            while i < len(batch) and sent >= len(batch[i]):
+                sent -= len(batch[i])
+                i += 1
+            if i == len(batch):
+                return
+            batch = batch[i:]
+            if sent:
+                batch[0] = memoryview(batch[0])[sent:]
+            if self.metered:
+                metrics.SEND_CALLS.inc()
@@ -0,0 +1,296 @@
+"""
+The chat protocol, shared by the servers, the clients and the benchmark
+
+Every frame (see framing.py) holds one message:
+
+    [version][type][sender id][seq] + body
+     1 byte   1     4 bytes    8       utf-8 text (can be empty)
+
+The type says what the body is, nobody has to look for "[Server]" or "bye"
+in the text anymore. Senders are small numbers the server hands out when
+someone joins, chat messages only carry that number. The server tells each
+client the name behind a number (NAME) once, right before the first message
+from it, and the clients keep a table. seq is the room's message number for
+chat messages (see history.py), 0 for everything else.
+
+The first message a client sends is its HELLO. The body is the name and
+maybe some options on extra lines:
+
+    alice
+    since=42
+    room=python
+    compress=zlib
+
+parse_hello() splits that up, make_hello() builds it. since=<seq> asks for
+the messages after that one, room= to start in that room instead of the
+lobby (both together is how a client picks up where it was after a
+reconnect), compress=zlib for compressed broadcasts (see framing.py, the
+FrameDecoder unpacks them by itself).
+
+Files dont go through the chat connection, they go over a connection of
+their own to the file port (see file_share.py). The chat only carries the
+offer: OFFER from the uploader, FILE to the room.
+
+Heartbeats: the server sends PING to a client that has been quiet for a
+while and the client answers PONG, clients dont show them. See heartbeat.py.
+"""
+
+import struct
+from collections import namedtuple
+
+from framing import HEADER_SIZE as LENGTH_SIZE
+
+VERSION = 1
+
+HEADER = struct.Struct('!BBIQ')     # version, type, sender id, seq
+HEADER_SIZE = HEADER.size
+# the framing length + HEADER, so a whole frame is packed in one go
+FRAME = struct.Struct('!IBBIQ')
+SEQ = struct.Struct('!Q')
+SEQ_OFFSET = LENGTH_SIZE + 6    # where seq sits in an encoded frame
+
+# client -> server
+HELLO = 1       # body: name + options
+CHAT = 2        # body: text (the server sends it on with sender and seq filled in)
+COMMAND = 3     # body: a /command without the slash, e.g. "join python"
+BYE = 4         # leaving (the server answers with BYE too)
+PONG = 5
+OFFER = 6       # body: file id + "\n" + file name + "\n" + size, after uploading it
+# client -> server on a file connection (see file_share.py)
+UPLOAD = 7      # body: file name + "\n" + size, the file's bytes follow
+DOWNLOAD = 8    # body: file id
+
+# server -> client
+NOTICE = 16     # body: text from the server, seq is set when it is about history
+WELCOME = 17    # sender: your id, body: your name
+NAME = 18       # sender: an id, body: the name behind it
+JOINED = 19     # sender joined, body: name, or name + "\n" + room for a room switch
+LEFT = 20       # sender left, body: name, or name + "\n" + room they went to
+DIRECT = 21     # body: private message from sender
+PING = 22
+ROOM = 23       # you are in room (body) now, seq: its latest message (after the replay)
+FILE = 24       # sender offers a file, body: like OFFER
+# server -> client on a file connection
+STORED = 25     # upload is in, body: its file id
+SENDING = 26    # body: size, that many bytes of the file follow
+
+# these only carry the sender id, the client needs the NAME before them
+NAMED = frozenset((CHAT, FILE))
+
+SERVER = 0      # sender id of messages that dont come from a client
+COMPRESSION = 'zlib'  # the only kind there is so far
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class Message(namedtuple('Message', 'type sender seq body')):
+    __slots__ = ()
+
+    @property
+    def text(self):
+        # body can be a memoryview (see decode_message), str() takes both
+        return str(self.body, 'utf-8', 'replace')
+
+
+# Message(...) goes through namedtuple's python level __new__, this skips it
+# (decode_message runs for every message in and out)
+_new_message = tuple.__new__
+
+
+def encode_message(mtype, body=b'', sender=SERVER, seq=0):
+    """one message as a ready to send frame"""
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return FRAME.pack(HEADER_SIZE + len(body), VERSION, mtype, sender, seq) + body
+
+
+def decode_message(payload):
+    """a frame's payload (what FrameDecoder hands back) -> Message
+
+    the body is a slice of the payload, so for a memoryview payload it is a
+    view too (nothing copied, and only good as long as the payload is)
+    """
+    if len(payload) < HEADER_SIZE:
+        raise ProtocolError(f"message too short ({len(payload)} bytes)")
+    version, mtype, sender, seq = HEADER.unpack_from(payload)
+    if version != VERSION:
+        raise ProtocolError(f"unknown protocol version {version}")
+    return _new_message(Message, (mtype, sender, seq, payload[HEADER_SIZE:]))
+
+
+def relay_frame(mtype, body, sender=SERVER, seq=0):
+    """encode_message for a body that is still in a receive buffer (a
+    memoryview): builds the frame in one bytearray, copying the body into it
+    once and never decoding it. stamp_seq() fills in seq in place later"""
+    return bytearray(FRAME.pack(HEADER_SIZE + len(body), VERSION, mtype, sender, seq)) + body
+
+
+WHITESPACE = b' \t\n\r\x0b\x0c'
+
+
+def strip_body(body):
+    """body without whitespace at either end, as a slice (no copy for a memoryview)"""
+    start, end = 0, len(body)
+    if not end or (body[0] not in WHITESPACE and body[-1] not in WHITESPACE):
+        return body  # the usual case
+    while start < end and body[start] in WHITESPACE:
+        start += 1
+    while end > start and body[end - 1] in WHITESPACE:
+        end -= 1
+    return body[start:end]
+
+
+class BodyText:
+    """the text of an encoded frame, only decoded if something turns it into a
+    str - handed to the log so chat messages are decoded on the log thread,
+    and not at all when message logging is off or sampled away"""
+
+    __slots__ = ('frame',)
+
+    def __init__(self, frame):
+        self.frame = frame
+
+    def __str__(self):
+        return str(memoryview(self.frame)[FRAME.size:], 'utf-8', 'replace')
+
+
+def message_type(frame):
+    """type of an encoded frame, without decoding it"""
+    return frame[LENGTH_SIZE + 1]
+
+
+def sender_of(frame):
+    return int.from_bytes(frame[LENGTH_SIZE + 2:SEQ_OFFSET], 'big')
+
+
+def is_current(frame):
+    """False for frames from before this protocol (old message store data)"""
+    return len(frame) >= FRAME.size and frame[LENGTH_SIZE] == VERSION
+
+
+def stamp_seq(frame, seq):
+    """the frame with its seq field set (history.py numbers messages as they go by)
+
+    a bytearray (see relay_frame) is stamped in place, bytes get copied
+    """
+    if isinstance(frame, bytearray):
+        SEQ.pack_into(frame, SEQ_OFFSET, seq)
+        return frame
+    return frame[:SEQ_OFFSET] + SEQ.pack(seq) + frame[SEQ_OFFSET + SEQ.size:]
+
+
+def notice(text, seq=0):
+    return encode_message(NOTICE, text, seq=seq)
+
+
+PING_FRAME = encode_message(PING)
+PONG_FRAME = encode_message(PONG)
+BYE_FRAME = encode_message(BYE)
+
+
+def parse_hello(text):
+    """returns (name, {option: value})"""
+    name, *lines = text.split('\n')
+    options = {}
+    for line in lines:
+        key, sep, value = line.partition('=')
+        if sep:
+            options[key.strip().lower()] = value.strip()
+    return name.strip(), options
+
+
+def make_hello(name, **options):
+    lines = [name] + [f"{key}={value}" for key, value in options.items() if value is not None]
+    return '\n'.join(lines)
+
+
+def hello_frame(name, **options):
+    return encode_message(HELLO, make_hello(name, **options))
+
+
+def wants_compression(options):
+    return options.get('compress', '').lower() == COMPRESSION
+
+
+def int_option(options, key):
+    """an integer option, None if it is missing or not a number"""
+    try:
+        return int(options[key])
+    except (KeyError, ValueError):
+        return None
+
+
+def make_offer(file_id, name, size):
+    return f"{file_id}\n{name}\n{size}"
+
+
+def parse_offer(body):
+    """(file id, file name, size) from an OFFER or FILE body"""
+    try:
+        file_id, name, size = str(body, 'utf-8', 'replace').split('\n')
+        return file_id, name, int(size)
+    except ValueError:
+        raise ProtocolError("bad file offer")
+
+
+def human_size(size):
+    for unit in ('bytes', 'KB', 'MB'):
+        if size < 1024:
+            return f"{size} {unit}" if unit == 'bytes' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+# --- client side ---
+
+def client_frame(line):
+    """what the user typed -> the message to send"""
+    if line.lower() == 'bye':
+        return BYE_FRAME
+    if line.startswith('/'):
+        return encode_message(COMMAND, line[1:])
+    return encode_message(CHAT, line)
+
+
+def _name_and_room(body):
+    name, _, room = str(body, 'utf-8', 'replace').partition('\n')
+    return name, room
+
+
+def describe(msg, names):
+    """(text to show, 'server' or 'normal') for a message from the server, or
+    None if there is nothing to show. keeps names (id -> name) up to date"""
+    mtype = msg.type
+    if mtype == CHAT:
+        return f"{names.get(msg.sender, f'#{msg.sender}')}: {msg.text}", 'normal'
+    if mtype == NOTICE:
+        return f"[Server] {msg.text}", 'server'
+    if mtype == NAME:
+        names[msg.sender] = msg.text
+        return None
+    if mtype == JOINED:
+        name, room = _name_and_room(msg.body)
+        names[msg.sender] = name
+        where = f"#{room}" if room else "the chat"
+        return f"[Server] {name} has joined {where}!", 'server'
+    if mtype == LEFT:
+        name, room = _name_and_room(msg.body)
+        if room:
+            return f"[Server] {name} went to #{room}.", 'server'
+        return f"[Server] {name} has left the chat.", 'server'
+    if mtype == DIRECT:
+        return f"[DM from {names.get(msg.sender, f'#{msg.sender}')}] {msg.text}", 'normal'
+    if mtype == WELCOME:
+        names[msg.sender] = msg.text
+        return None
+    if mtype == ROOM:
+        return f"[Server] You are in #{msg.text}, latest message is #{msg.seq}.", 'server'
+    if mtype == FILE:
+        file_id, name, size = parse_offer(msg.body)
+        who = names.get(msg.sender, f'#{msg.sender}')
+        return f"[File] {who} shares {name} ({human_size(size)}) - /get {file_id}", 'server'
+    if mtype == BYE:
+        return "[Server] Goodbye! You have left the chat.", 'server'
+    return None  # PING is answered by the caller, anything newer is ignored
@@ -0,0 +1,319 @@
+"""
+Chat rooms - shared by both server engines and the GUI server
+
+Everyone starts in #lobby. Commands (typed as normal messages):
+    /join <room>        switch to another room (made on the fly)
+    /leave              go back to the lobby
+    /rooms              list rooms and how many people are in each
+    /who                list the people in your room
+    /msg <name> <text>  private message
+
+The server keeps a room -> members index next to the name -> connection
+map, and updates both when someone joins, leaves or switches rooms, so a
+message only costs as much as the size of its room. Broadcasts read a
+snapshot of the room that only joins and leaves replace (copy on write),
+so they dont take a lock.
+
+It also gives every name a small sender id (Senders), messages only carry
+that (see protocol.py). Every connection remembers which ids it already
+knows the name of (conn.known) and gets a NAME message the first time
+something from a new id comes its way.
+"""
+
+import threading
+import time
+
+from protocol import DIRECT, JOINED, LEFT, NAME, encode_message, notice
+
+DEFAULT_ROOM = 'lobby'
+MAX_ROOM_NAME = 32
+
+EMPTY = ((), ())  # snapshot of a room nobody is in
+
+HELP = "Commands: /join <room>, /leave, /rooms, /who, /msg <name> <text>"
+
+
+class RoomIndex:
+    """name -> connection map plus room -> members index
+
+    a connection is anything with a send(frame) method (ClientWriter in the
+    threaded servers, ChatProtocol in the asyncio one).
+
+    joins, leaves and room switches take the lock and, once the dicts are
+    updated, put a new snapshot of that room (tuples of names and
+    connections) in self.snapshots. members() - what every broadcast calls -
+    just reads the current snapshot and takes no lock at all, so broadcasts
+    never wait for each other or for a join storm, and a join only copies
+    its own room. the snapshot of everybody (room=None, rarely needed) is
+    made on first use after a change.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()  # for the writers, members() doesnt touch it
+        self.senders = Senders()
+        self.clients = {}   # name -> connection
+        self.rooms = {}     # room -> {name: connection}
+        self.room_of = {}   # name -> room
+        self.snapshots = {}  # room -> (names, connections), replaced never changed
+        self.everyone = None  # the same for all clients, None = make it again
+        # optional metrics.Histogram, the writers record how long they waited for the lock
+        self.lock_wait = None
+
+    def __len__(self):
+        return len(self.clients)
+
+    def _acquire(self):
+        if self.lock_wait is None:
+            self.lock.acquire()
+        else:
+            start = time.perf_counter()
+            self.lock.acquire()
+            self.lock_wait.observe(time.perf_counter() - start)
+
+    def _publish(self, room):
+        """new snapshot of room for the readers, called with the lock held"""
+        members = self.rooms.get(room)
+        if members:
+            self.snapshots[room] = (tuple(members), tuple(members.values()))
+        else:
+            self.snapshots.pop(room, None)
+        self.everyone = None
+
+    def add(self, name, conn, room=DEFAULT_ROOM):
+        self._acquire()
+        try:
+            old = self.clients.get(name)
+            if old is not None:
+                # same name connected again, the new connection takes over the slot
+                self._publish(self._remove_locked(name))
+            self.clients[name] = conn
+            self.room_of[name] = room
+            self.rooms.setdefault(room, {})[name] = conn
+            self._publish(room)
+        finally:
+            self.lock.release()
+
+    def remove(self, name, conn):
+        """removes name if it still belongs to conn, returns the room they were in"""
+        self._acquire()
+        try:
+            if self.clients.get(name) is not conn:
+                return None
+            room = self._remove_locked(name)
+            self._publish(room)
+            return room
+        finally:
+            self.lock.release()
+
+    def _remove_locked(self, name):
+        del self.clients[name]
+        room = self.room_of.pop(name)
+        members = self.rooms[room]
+        del members[name]
+        if not members and room != DEFAULT_ROOM:
+            del self.rooms[room]  # last one out, room goes away
+        return room
+
+    def move(self, name, room):
+        """moves name to room, returns the old room"""
+        self._acquire()
+        try:
+            old = self.room_of[name]
+            if old == room:
+                return old
+            conn = self.rooms[old].pop(name)
+            if not self.rooms[old] and old != DEFAULT_ROOM:
+                del self.rooms[old]
+            self.rooms.setdefault(room, {})[name] = conn
+            self.room_of[name] = room
+            self._publish(old)
+            self._publish(room)
+            return old
+        finally:
+            self.lock.release()
+
+    def get(self, name):
+        return self.clients.get(name)
+
+    def room(self, name):
+        return self.room_of.get(name)
+
+    def _everyone(self):
+        everyone = self.everyone
+        if everyone is None:
+            with self.lock:
+                everyone = self.everyone = (tuple(self.clients), tuple(self.clients.values()))
+        return everyone
+
+    def members(self, room, skip=None):
+        """connections in room (everyone if room is None), minus skip
+
+        a tuple straight from the current snapshot, no lock. someone joining
+        right now is in the next one
+        """
+        names, conns = self._everyone() if room is None else self.snapshots.get(room, EMPTY)
+        if skip is None:
+            return conns
+        try:
+            i = names.index(skip)
+        except ValueError:
+            return conns
+        return conns[:i] + conns[i + 1:]
+
+    def names(self, room):
+        return sorted(self.snapshots.get(room, EMPTY)[0])
+
+    def room_counts(self):
+        with self.lock:
+            return sorted((room, len(members)) for room, members in self.rooms.items())
+
+    def all_connections(self):
+        return self._everyone()[1]
+
+    def clear(self):
+        with self.lock:
+            self.clients.clear()
+            self.rooms.clear()
+            self.room_of.clear()
+            self.snapshots.clear()
+            self.everyone = None
+
+
+class Senders:
+    """sender id <-> name, ids are handed out at join
+
+    an id is kept for as long as the server runs (messages in the history
+    still point at it), and the same name gets the same id back when it
+    reconnects
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.names = {}     # id -> name
+        self.ids = {}       # name -> id
+        self.frames = {}    # id -> ready to send NAME message
+        self.next_id = 1
+        self.step = 1
+        self.on_new = None  # called with the NAME frame of every new id (message store)
+
+    def partition(self, index, count):
+        """worker index of count only hands out ids index+1, index+1+count, ...
+        so two workers never give out the same one"""
+        self.step = count
+        self.next_id = index + 1
+        highest = max(self.names, default=0)
+        while self.next_id <= highest:
+            self.next_id += count
+
+    def assign(self, name):
+        with self.lock:
+            sender = self.ids.get(name)
+            if sender is not None:
+                return sender
+            sender = self.next_id
+            self.next_id += self.step
+            frame = self._add(sender, name)
+        if self.on_new is not None:
+            self.on_new(frame)
+        return sender
+
+    def learn(self, sender, name):
+        """an id handed out somewhere else (another worker, an earlier run)"""
+        with self.lock:
+            if self.names.get(sender) == name:
+                return
+            frame = self._add(sender, name)
+            while self.next_id <= sender:
+                self.next_id += self.step
+        if self.on_new is not None:
+            self.on_new(frame)
+
+    def _add(self, sender, name):
+        frame = encode_message(NAME, name, sender=sender)
+        self.names[sender] = name
+        self.ids[name] = sender
+        self.frames[sender] = frame
+        return frame
+
+    def name(self, sender):
+        return self.names.get(sender)
+
+    def introduce(self, conns, sender):
+        """sends sender's name to the conns that dont know it yet"""
+        frame = self.frames.get(sender)
+        if frame is None:
+            return
+        for conn in conns:
+            if sender not in conn.known:
+                conn.send(frame)
+                conn.known.add(sender)
+
+    def introductions(self, conn, senders):
+        """NAME frames for the senders conn doesnt know yet, all in one bytes"""
+        frames = []
+        for sender in senders:
+            if sender not in conn.known and sender in self.frames:
+                frames.append(self.frames[sender])
+                conn.known.add(sender)
+        return b''.join(frames)
+
+
+def valid_room_name(room):
+    return 0 < len(room) <= MAX_ROOM_NAME and room.isprintable() and ' ' not in room
+
+
+def start_room(options):
+    """the room asked for with room= in the hello, the lobby if none (or a bad one)"""
+    room = options.get('room', '').lstrip('#')
+    return room if valid_room_name(room) else DEFAULT_ROOM
+
+
+def handle_command(registry, name, conn, line, broadcast, direct, history=None):
+    """runs one command from name (a COMMAND message, "join python")
+
+    broadcast(frame, skip, room=None) and direct(target, frame) are the
+    server's own send functions (skip is the name to leave out), direct
+    returns False if target isnt connected. if history (a RoomHistory) is
+    given, switching rooms replays the new room's recent messages
+    """
+    cmd, _, arg = line.strip().partition(' ')
+    cmd = cmd.lower()
+    arg = arg.strip()
+
+    def reply(text):
+        conn.send(notice(text))
+
+    if cmd == 'join' or cmd == 'leave':
+        room = arg.lstrip('#') if cmd == 'join' else DEFAULT_ROOM
+        if not valid_room_name(room):
+            reply(f"Room names can be up to {MAX_ROOM_NAME} characters, no spaces.")
+            return
+        old = registry.move(name, room)
+        if old == room:
+            reply(f"You are already in #{room}.")
+            return
+        moved = f"{name}\n{room}"
+        broadcast(encode_message(LEFT, moved, sender=conn.id), None, room=old)
+        broadcast(encode_message(JOINED, moved, sender=conn.id), name, room=room)
+        if history is not None:
+            history.send_catch_up(conn, room, senders=registry.senders)
+        reply(f"You are now in #{room} ({len(registry.names(room))} here).")
+
+    elif cmd == 'rooms':
+        rooms = ", ".join(f"#{room} ({n})" for room, n in registry.room_counts())
+        reply(f"Rooms: {rooms}")
+
+    elif cmd == 'who':
+        room = registry.room(name)
+        reply(f"In #{room}: {', '.join(registry.names(room))}")
+
+    elif cmd == 'msg':
+        target, _, text = arg.partition(' ')
+        text = text.strip()
+        if not target or not text:
+            reply("Usage: /msg <name> <text>")
+        elif not direct(target, encode_message(DIRECT, text, sender=conn.id)):
+            reply(f"{target} isnt connected.")
+
+    else:
+        reply(f"Unknown command /{cmd}. {HELP}")
@@ -0,0 +1,229 @@
+"""
+Multi process mode for chat_server.py - uses more than one core
+
+    python chat_server.py --workers 4
+
+The parent forks N worker processes. Every worker opens its own listening
+socket on the same port with SO_REUSEPORT, so the kernel spreads new
+connections between them, and runs the normal threaded server for its own
+clients.
+
+Broadcasts go over a local bus: each worker has a unix socketpair to the
+parent, the parent (the hub) reads bus messages from all of them and writes
+each one to every worker - including the one it came from. Workers only fan
+out what comes back from the hub, so the hub decides one global order and
+every client on every worker sees the messages and the join/leave notices in
+exactly that order (nobody can see "bob has left" before "bob has joined").
+
+With --unix the parent makes the unix socket before forking and all workers
+accept on that one (SO_REUSEPORT is a tcp/udp thing), the kernel hands each
+connection to whichever worker is waiting in accept() first.
+
+Rooms work across workers (the room goes along with each bus message), but
+/rooms and /who only know about the clients on the worker you landed on.
+
+Sender ids (see rooms.Senders) are split between the workers, worker i hands
+out i+1, i+1+N, ... so they never clash, and every worker learns the names
+from the JOINED messages going by on the bus.
+
+linux/bsd only (needs os.fork and SO_REUSEPORT)
+"""
+
+import os
+import selectors
+import socket
+import struct
+import sys
+import threading
+
+import chat_server
+import chatlog
+from framing import HEADER_SIZE, FrameDecoder, FrameReader, encode_frame
+from outbound import DISCONNECT, ClientWriter
+from protocol import JOINED, decode_message, message_type
+from transport import close_unix, listen_unix
+
+# bus message = [flags][skip name][room][direct message target][client frame],
+# the three strings each with a 2 byte length in front, all wrapped in a frame
+STR_LEN = struct.Struct('!H')
+FLAG_RECORD = 0x01  # goes into the room history
+
+# the bus must never drop messages, so its queues are very big, and a side
+# that still falls this far behind is cut off the bus (loudly) instead of
+# quietly losing some - the workers would see different chats otherwise
+BUS_QUEUE = 100000
+
+
+def _pack_str(text):
+    data = (text or '').encode('utf-8')
+    return STR_LEN.pack(len(data)) + data
+
+
+def _unpack_str(payload, pos):
+    (n,) = STR_LEN.unpack_from(payload, pos)
+    pos += STR_LEN.size
+    return payload[pos:pos + n].decode('utf-8') or None, pos + n
+
+
+def encode_bus_message(frame, skip_name=None, room=None, to=None, record=False):
+    flags = bytes([FLAG_RECORD if record else 0])
+    return encode_frame(flags + _pack_str(skip_name) + _pack_str(room) + _pack_str(to) + frame)
+
+
+def decode_bus_message(payload):
+    """returns (client frame, skip name, room, to, record), the strings can be None"""
+    record = bool(payload[0] & FLAG_RECORD)
+    skip_name, pos = _unpack_str(payload, 1)
+    room, pos = _unpack_str(payload, pos)
+    to, pos = _unpack_str(payload, pos)
+    return payload[pos:], skip_name, room, to, record
+
+
+class BusClient:
+    """worker side of the bus, plugged into chat_server.bus"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        # ClientWriter gives us a queue + writer thread for free, so publishing
+        # never blocks a client thread on the hub
+        self.writer = ClientWriter(sock, name="bus", max_queue=BUS_QUEUE, policy=DISCONNECT,
+                                   metered=False).start()
+        self.cut_off = False
+
+    def publish(self, frame, skip_name=None, room=None, to=None, record=False):
+        if not self.writer.send(encode_bus_message(frame, skip_name, room, to, record)):
+            if not self.cut_off:
+                self.cut_off = True
+                chatlog.error('bus', "[!] the hub fell {n} messages behind, cut off the bus",
+                              n=BUS_QUEUE)
+
+    def receive_loop(self):
+        """runs in a thread, hands everything the hub sends to the local clients"""
+        reader = FrameReader(self.sock)
+        while True:
+            try:
+                payload = reader.read_frame()
+            except OSError:
+                payload = None
+            if payload is None:
+                chatlog.error('bus', "[!] lost the connection to the hub, only local clients "
+                                     "will get messages")
+                chat_server.bus = None
+                return
+            frame, skip_name, room, to, record = decode_bus_message(payload)
+            if to is not None:
+                # private message, only the worker that has them delivers it
+                writer = chat_server.clients.get(to)
+                if writer is not None:
+                    chat_server.deliver(writer, frame)
+            else:
+                if message_type(frame) == JOINED:
+                    # someone joined on some worker, remember the name behind the id
+                    msg = decode_message(frame[HEADER_SIZE:])
+                    chat_server.clients.senders.learn(msg.sender, msg.text.partition('\n')[0])
+                # every worker records into its own history, and they all see the
+                # same messages in the same order, so the seqs match everywhere
+                chat_server.fan_out(frame, skip_name, room, record)
+
+
+def worker_main(index, workers, sock, metrics_port=None, unix_server=None):
+    chatlog.log_to_worker_files(index)
+    senders = chat_server.clients.senders
+    senders.partition(index, workers)
+    if chat_server.store is not None:
+        # every worker sees the same messages in the same order, so one of them
+        # writing the store is enough (and two would trample each other)
+        if index == 0:
+            chat_server.store.start()
+        else:
+            chat_server.store.close()
+            chat_server.store = None
+            senders.on_new = None
+    chat_server.bus = BusClient(sock)
+    t = threading.Thread(target=chat_server.bus.receive_loop, daemon=True)
+    t.start()
+    chat_server.run_threaded(reuse_port=True, label=f" (worker {index}, pid {os.getpid()})",
+                             metrics_port=metrics_port + index if metrics_port else None,
+                             unix_server=unix_server)
+
+
+def run_hub(socks):
+    """parent process - relays every bus message to every worker"""
+    sel = selectors.DefaultSelector()
+    writers = {}
+    for sock in socks:
+        writers[sock] = ClientWriter(sock, name="worker", max_queue=BUS_QUEUE,
+                                      policy=DISCONNECT, metered=False).start()
+        sel.register(sock, selectors.EVENT_READ, FrameDecoder())
+
+    while writers:
+        for key, _ in sel.select():
+            sock = key.fileobj
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                # worker exited
+                sel.unregister(sock)
+                writers.pop(sock).close()
+                sock.close()
+                continue
+
+            for payload in key.data.feed(data):
+                frame = encode_frame(payload)
+                for worker_sock, writer in list(writers.items()):
+                    if not writer.send(frame):
+                        # it hung up on the worker, that one only serves its
+                        # own clients from now on (see BusClient.receive_loop)
+                        chatlog.error('bus', "[!] a worker fell {n} messages behind, cut it "
+                                             "off the bus", n=BUS_QUEUE)
+                        sel.unregister(worker_sock)
+                        writers.pop(worker_sock)
+                        worker_sock.close()
+
+
+def run(workers, metrics_port=None):
+    if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(os, 'fork'):
+        print("multi process mode needs SO_REUSEPORT and fork (linux/bsd)")
+        return
+
+    # make all the socketpairs before forking, the parent keeps one end of each
+    pairs = [socket.socketpair() for _ in range(workers)]
+    unix_server = None
+    if chat_server.UNIX_PATH:
+        unix_server = listen_unix(chat_server.UNIX_PATH, chat_server.BACKLOG)
+    pids = []
+    for i, (parent_end, child_end) in enumerate(pairs):
+        pid = os.fork()
+        if pid == 0:
+            for p, c in pairs:
+                p.close()
+                if c is not child_end:
+                    c.close()
+            try:
+                worker_main(i, workers, child_end, metrics_port, unix_server)
+            finally:
+                if chat_server.store is not None:
+                    chat_server.store.close()
+                chatlog.LOGGER.close()
+                sys.stdout.flush()  # os._exit skips the normal flush (and atexit)
+                os._exit(0)
+        pids.append(pid)
+
+    for _, child_end in pairs:
+        child_end.close()
+
+    print(f"Started {workers} workers on {chat_server.HOST}:{chat_server.PORT}: {pids}")
+    try:
+        run_hub([p for p, _ in pairs])
+    except KeyboardInterrupt:
+        pass  # ctrl+c goes to the workers too, they shut down on their own
+
+    for pid in pids:
+        try:
+            os.waitpid(pid, 0)
+        except (ChildProcessError, KeyboardInterrupt):
+            pass
+    if unix_server is not None:
+        close_unix(unix_server, chat_server.UNIX_PATH)
@@ -1,17 +1,34 @@
 """
 Chat client - connects to the server and lets you send/receive messages
+
+/send <path> shares a file with the room, /get <id> downloads one into the
+current directory (see file_share.py).
 """
 
-import socket
-import threading
+import time
 import tkinter as tk
 from tkinter import scrolledtext, messagebox
 import queue
 
-# connection settings
+from chat_sdk import Client, file_command
+from transport import client_context
+
+# connection settings, HOST can also be 'unix:/tmp/chat.sock' for a server
+# on this machine started with --unix (see transport.py)
 HOST = '127.0.0.1'
 PORT = 12345
-BUFFER_SIZE = 1024
+# True for a server started with --tls-cert, TLS_CAFILE is the certificate
+# to trust if it is a self-signed one
+TLS = False
+TLS_CAFILE = None
+
+# the chat window only keeps this many lines, older ones get removed
+SCROLLBACK = 5000
+# when messages pour in, redraw at most this often (everything that arrived
+# in between goes in with one insert). when its quiet they show up right away
+MIN_RENDER_INTERVAL = 0.03
+# backup poll in case the wakeup event from the recv thread doesnt work
+FALLBACK_POLL_MS = 250
 
 
 class ChatClient:
@@ -21,14 +38,23 @@ class ChatClient:
         self.master.geometry("500x500")
         self.master.configure(bg="#f0f0f0")
 
-        self.sock = None
+        self.client = None
+        # made once, it keeps the tls session so connecting again is quicker
+        self.tls = client_context(TLS_CAFILE) if TLS else None
         self.connected = False
         self.username = None
         self.msg_queue = queue.Queue()
+        # True while a wakeup is on its way to the gui thread, so the recv
+        # thread sends one per batch instead of one per message
+        self.wake_pending = False
+        self.render_scheduled = False
+        self.last_render = 0.0
 
         self.build_gui()
 
-        self.master.after(100, self.check_incoming)
+        # recv thread -> gui thread wakeup (event_generate is ok from other threads)
+        self.master.bind("<<Incoming>>", lambda e: self.check_incoming())
+        self.master.after(FALLBACK_POLL_MS, self.poll_incoming)
         self.master.protocol("WM_DELETE_WINDOW", self.on_close)
 
     def build_gui(self):
@@ -91,12 +117,12 @@ class ChatClient:
             return
 
         try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect((HOST, PORT))
+            # sends our name first so the server knows who we are, then the
+            # library's thread receives in the background
             self.connected = True
-
-            # send our name first so the server knows who we are
-            self.sock.sendall(self.username.encode('utf-8'))
+            self.client = Client(self.username, HOST, PORT, on_message=self.on_event,
+                                 on_close=self.on_disconnect, tls=self.tls)
+            self.client.connect()
 
             self.status_label.config(text=f"Connected as {self.username}", fg="green")
             self.connect_btn.config(state='disabled')
@@ -106,10 +132,6 @@ class ChatClient:
             self.show_msg(f"Your name: {self.username}", "server")
             self.show_msg("---", "server")
 
-            # background thread to receive messages
-            t = threading.Thread(target=self.recv_loop, daemon=True)
-            t.start()
-
         except ConnectionRefusedError:
             messagebox.showerror("Connection Error",
                                  "Could not connect to server.\nMake sure the server is running!")
@@ -118,32 +140,26 @@ class ChatClient:
             messagebox.showerror("Error", f"Connection failed: {e}")
             self.cleanup()
 
-    def recv_loop(self):
-        """receives messages from server in background thread"""
-        while self.connected:
+    def on_event(self, event):
+        """recv thread - a message from the server"""
+        # print(f"DEBUG got: {event}")
+        shown = event.display()
+        if shown is not None:
+            self.incoming(*shown)  # (text, "server" or "normal")
+
+    def on_disconnect(self):
+        if self.connected:  # not when we hung up ourselves
+            self.incoming("__DC__", "")
+
+    def incoming(self, msg, tag):
+        """recv thread side - queue it and wake the gui if it isnt already coming"""
+        self.msg_queue.put((msg, tag))
+        if not self.wake_pending:
+            self.wake_pending = True
             try:
-                data = self.sock.recv(BUFFER_SIZE).decode('utf-8')
-                if not data:
-                    self.msg_queue.put(("__DC__", ""))
-                    break
-
-                # print(f"DEBUG got: {data}")
-
-                if data.startswith("[Server]"):
-                    self.msg_queue.put((data, "server"))
-                else:
-                    self.msg_queue.put((data, "normal"))
-
-            except ConnectionResetError:
-                self.msg_queue.put(("__DC__", ""))
-                break
-            except OSError:
-                break
-            except Exception as e:
-                # print(f"DEBUG recv error: {e}")
-                if self.connected:
-                    self.msg_queue.put((f"Error: {e}", "server"))
-                break
+                self.master.event_generate("<<Incoming>>", when="tail")
+            except (RuntimeError, tk.TclError):
+                pass  # window is closing, or tcl without threads - the poll picks it up
 
     def send_msg(self, event=None):
         if not self.connected:
@@ -153,52 +169,99 @@ class ChatClient:
         if message == "":
             return
 
+        transfer = file_command(message)
+        if transfer is not None:
+            # on a thread of its own so the window doesnt freeze, the progress
+            # comes in like messages do
+            self.client.start_transfer(*transfer, lambda text: self.incoming(text, "server"))
+            self.msg_entry.delete(0, tk.END)
+            return
+
         try:
-            self.sock.sendall(message.encode('utf-8'))
+            self.client.send_line(message)
             self.show_msg(f"You: {message}", "normal")
             self.msg_entry.delete(0, tk.END)
         except:
             self.show_msg("Failed to send message :(", "server")
 
     def show_msg(self, text, tag="normal"):
+        self.render([(text, tag)])
+
+    def render(self, lines):
+        """adds (text, tag) lines to the chat with one insert and one scroll"""
+        if not lines:
+            return
+        if len(lines) > SCROLLBACK:
+            lines = lines[-SCROLLBACK:]  # the rest would be trimmed right away anyway
+        # only follow new messages if the user hasnt scrolled up to read something
+        at_bottom = self.chat_area.yview()[1] >= 1.0
+        args = []
+        for text, tag in lines:
+            args.append(text + "\n")
+            args.append(tag)
         self.chat_area.config(state='normal')
-        self.chat_area.insert(tk.END, text + "\n", tag)
-        self.chat_area.see(tk.END)
+        self.chat_area.insert(tk.END, *args)
+        # line count includes the empty last line, hence the -1
+        extra = int(self.chat_area.index('end-1c').split('.')[0]) - 1 - SCROLLBACK
+        if extra > 0:
+            self.chat_area.delete('1.0', f'{extra + 1}.0')
         self.chat_area.config(state='disabled')
+        if at_bottom:
+            self.chat_area.see(tk.END)
 
     def check_incoming(self):
-        """check for new messages from the recv thread"""
-        while not self.msg_queue.empty():
+        """gui thread - takes everything the recv thread queued and shows it in one go"""
+        self.wake_pending = False
+        wait = self.last_render + MIN_RENDER_INTERVAL - time.monotonic()
+        if wait > 0:
+            # just drew, let more pile up instead of redrawing for every message
+            if not self.render_scheduled:
+                self.render_scheduled = True
+                self.master.after(int(wait * 1000) + 1, self.scheduled_render)
+            return
+        self.last_render = time.monotonic()
+
+        lines = []
+        while True:
             try:
                 msg, tag = self.msg_queue.get_nowait()
-
-                if msg == "__DC__":
-                    self.show_msg("Disconnected from server.", "server")
-                    self.connected = False
-                    self.status_label.config(text="Disconnected", fg="red")
-                    self.connect_btn.config(state='normal')
-                    self.name_entry.config(state='normal')
-                else:
-                    self.show_msg(msg, tag)
             except queue.Empty:
                 break
-
-        self.master.after(100, self.check_incoming)
+            if msg == "__DC__":
+                self.render(lines)
+                lines = []
+                self.show_msg("Disconnected from server.", "server")
+                self.connected = False
+                self.status_label.config(text="Disconnected", fg="red")
+                self.connect_btn.config(state='normal')
+                self.name_entry.config(state='normal')
+            else:
+                lines.append((msg, tag))
+        self.render(lines)
+
+    def scheduled_render(self):
+        self.render_scheduled = False
+        self.check_incoming()
+
+    def poll_incoming(self):
+        if not self.msg_queue.empty():
+            self.check_incoming()
+        self.master.after(FALLBACK_POLL_MS, self.poll_incoming)
 
     def cleanup(self):
         self.connected = False
-        if self.sock:
+        if self.client:
             try:
-                self.sock.close()
+                self.client.close(bye=False)
             except:
                 pass
-            self.sock = None
+            self.client = None
 
     def on_close(self):
         self.connected = False
-        if self.sock:
+        if self.client:
             try:
-                self.sock.close()
+                self.client.close(bye=False)
             except:
                 pass
         self.master.destroy()
@@ -4,17 +4,122 @@ Multi-client chat server with GUI broadcasts messages to all connected clients
 
 import socket
 import threading
+import time
 import tkinter as tk
 from tkinter import scrolledtext
 import queue
+from collections import deque
+
+import chatlog
+import metrics
+from admission import (Admission, DEFAULT_BACKLOG, DEFAULT_MAX_CONNECTIONS, DEFAULT_MAX_PER_IP,
+                       DEFAULT_MESSAGE_BURST, DEFAULT_MESSAGE_RATE, Bouncer, over_limit)
+from file_share import DEFAULT_MAX_FILE_SIZE, DEFAULT_SPOOL, FileServer, Spool, offer_frame
+from framing import DEFAULT_COMPRESS_LEVEL, DEFAULT_COMPRESS_MIN_SIZE, FrameReader
+from heartbeat import DEFAULT_IDLE_TIMEOUT, DEFAULT_PING_INTERVAL, Reaper, enable_keepalive
+from history import DEFAULT_HISTORY_BYTES, DEFAULT_HISTORY_SIZE, DEFAULT_REPLAY, RoomHistory
+from outbound import (ClientWriter, DEFAULT_FLUSH_BYTES, DEFAULT_FLUSH_DELAY,
+                      DEFAULT_MAX_QUEUE, DROP_OLDEST, compressed_copy)
+from protocol import (BYE, BYE_FRAME, CHAT, COMMAND, HELLO, JOINED, LEFT, NAMED, OFFER,
+                      PING_FRAME, PONG, WELCOME, BodyText, decode_message, encode_message,
+                      int_option, message_type, notice, parse_hello, relay_frame, sender_of,
+                      wants_compression)
+from rooms import RoomIndex, handle_command, start_room
+from transport import accept_tls, close_unix, listen_unix, peer, peer_address, server_context
 
 # server config
 HOST = '127.0.0.1'
 PORT = 12345
-BUFFER_SIZE = 1024
+BUFFER_SIZE = 65536
+
+# this is just how much we read per recv() now, messages are framed
+# (see framing.py) so big messages just take a few reads
+
+# each client gets its own send queue (see outbound.py), this is how many
+# messages can pile up for one client and what happens when it is full
+MAX_QUEUE = DEFAULT_MAX_QUEUE
+SLOW_POLICY = DROP_OLDEST  # or DISCONNECT
+# messages for one client are batched into one send, see outbound.py
+FLUSH_BYTES = DEFAULT_FLUSH_BYTES
+FLUSH_DELAY = DEFAULT_FLUSH_DELAY
+# clients can ask for big messages to come compressed, see framing.py
+COMPRESS_MIN_SIZE = DEFAULT_COMPRESS_MIN_SIZE
+COMPRESS_LEVEL = DEFAULT_COMPRESS_LEVEL
+# who gets in and how fast they can send, see admission.py (0 = no limit)
+BACKLOG = DEFAULT_BACKLOG
+MAX_CONNECTIONS = DEFAULT_MAX_CONNECTIONS
+MAX_PER_IP = DEFAULT_MAX_PER_IP
+MESSAGE_RATE = DEFAULT_MESSAGE_RATE
+MESSAGE_BURST = DEFAULT_MESSAGE_BURST
+# quiet clients get pinged, clients that stay silent get dropped, see heartbeat.py
+PING_INTERVAL = DEFAULT_PING_INTERVAL
+IDLE_TIMEOUT = DEFAULT_IDLE_TIMEOUT
+
+# set to a path (e.g. "/tmp/chat.sock") to also listen on a unix socket, for
+# clients on the same machine - they connect to "unix:/tmp/chat.sock", see transport.py
+UNIX_PATH = None
+
+# set to certificate (and key) files to speak tls on the tcp and file ports, see transport.py
+TLS_CERT = None
+TLS_KEY = None  # None if the key is in TLS_CERT
+
+# files are shared over a second port (see file_share.py), 0 = no file sharing
+FILE_PORT = PORT + 1
+SPOOL_DIR = DEFAULT_SPOOL
+MAX_FILE_SIZE = DEFAULT_MAX_FILE_SIZE
+
+# every room remembers its last messages and new people get the last few, see history.py
+HISTORY_SIZE = DEFAULT_HISTORY_SIZE
+HISTORY_BYTES = DEFAULT_HISTORY_BYTES
+REPLAY = DEFAULT_REPLAY
+
+# logging goes through chatlog.py (written on a background thread, not by the
+# client threads). LOG_SAMPLE = {'message': 0.01} logs 1 in 100 chat messages,
+# LOG_FILE = "server.jsonl" also writes a rotating json lines file
+LOG_LEVEL = 'info'
+LOG_SAMPLE = {}
+LOG_FILE = None
+
+# set to a port number (e.g. 9100) to serve prometheus metrics, see metrics.py
+METRICS_PORT = None
+
+# the log window keeps at most this many lines. if more than that come in
+# between two screen updates the rest is skipped and a summary line says so
+LOG_LINES = 2000
+
+# things the client threads tell the gui about, msg_queue holds (event, value)
+EVENT_CLIENT_COUNT = 'client_count'
+
+
+class GuiLogSink:
+    """chatlog sink for the log window
+
+    only remembers the newest LOG_LINES lines until the gui picks them up,
+    anything older is counted instead so memory stays flat however busy it gets
+    """
+
+    def __init__(self, max_lines=LOG_LINES):
+        self.lines = deque(maxlen=max_lines)
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def write(self, records):
+        with self.lock:
+            overflow = len(self.lines) + len(records) - self.lines.maxlen
+            if overflow > 0:
+                self.dropped += overflow
+            self.lines.extend(text for _, _, _, text, _ in records)
 
-# 1024 seems fine for chat messages, but if you want to allow larger messages you can increase this
-# BUFFER_SIZE = 2048
+    def take(self):
+        """returns (lines, how many were skipped) and starts over"""
+        with self.lock:
+            lines = list(self.lines)
+            self.lines.clear()
+            dropped, self.dropped = self.dropped, 0
+        return lines, dropped
+
+    def close(self):
+        pass
 
 
 class ChatServer:
@@ -24,16 +129,33 @@ class ChatServer:
         self.master.geometry("500x450")
         self.master.configure(bg="#f0f0f0")
 
-        self.clients = {}  # name -> (socket, address)
-        self.lock = threading.Lock()
+        self.clients = RoomIndex()  # name -> ClientWriter, plus who is in which room
+        self.clients.lock_wait = metrics.LOCK_WAIT_SECONDS
+        metrics.watch_clients(self.clients)
+        self.history = RoomHistory(HISTORY_SIZE, HISTORY_BYTES, REPLAY)
+        self.reaper = Reaper(ping=lambda writer: writer.send(PING_FRAME),
+                             kick=lambda writer: writer.kick(),
+                             alive=lambda writer: not writer.closed,
+                             ping_interval=PING_INTERVAL, idle_timeout=IDLE_TIMEOUT).start()
+        self.admission = Admission(MAX_CONNECTIONS, MAX_PER_IP, MESSAGE_RATE, MESSAGE_BURST)
+        self.bouncer = Bouncer()
         self.server_socket = None
+        self.unix_socket = None
+        self.tls = None  # made once in start_server() if TLS_CERT is set
+        self.spool = None  # uploads, made in start_server() if FILE_PORT is set
         self.running = False
-        self.msg_queue = queue.Queue()
+        self.msg_queue = queue.Queue()  # (event, value), see EVENT_*
+        self.event_handlers = {EVENT_CLIENT_COUNT: self.show_client_count}
+        # the log window is just another place chatlog writes to
+        self.log_sink = GuiLogSink(LOG_LINES)
+        self.last_check = time.monotonic()
+        chatlog.configure(level=LOG_LEVEL, sample=LOG_SAMPLE, console=False, file=LOG_FILE,
+                          sinks=[self.log_sink])
 
         self.setup_gui()
         self.start_server()
 
-        # check queue every 100ms for new messages to display
+        # check every 100ms for new log lines and events
         self.master.after(100, self.check_queue)
         self.master.protocol("WM_DELETE_WINDOW", self.on_closing)
 
@@ -54,6 +176,7 @@ class ChatServer:
             self.master, wrap=tk.WORD, width=55, height=20,
             state='disabled', font=("Consolas", 9))
         self.log_area.pack(padx=10, pady=10)
+        self.log_area.tag_config("skipped", foreground="#b36b00")
 
         # client count
         self.clients_label = tk.Label(self.master, text="Connected clients: 0",
@@ -65,36 +188,63 @@ class ChatServer:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.server_socket.bind((HOST, PORT))
-            self.server_socket.listen(5)
+            self.server_socket.listen(BACKLOG)
             self.server_socket.settimeout(1.0)  # so the accept loop can check self.running
+            if TLS_CERT:
+                self.tls = server_context(TLS_CERT, TLS_KEY)
             self.running = True
 
             self.log(f"Server started on {HOST}:{PORT}")
+            if METRICS_PORT:
+                metrics.serve(METRICS_PORT)
+                self.log(f"Metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+            if FILE_PORT:
+                self.spool = Spool(SPOOL_DIR, MAX_FILE_SIZE)
+                FileServer(self.spool, HOST, FILE_PORT, tls=self.tls).start()
+                self.log(f"File sharing on {HOST}:{FILE_PORT}")
+            if UNIX_PATH:
+                self.unix_socket = listen_unix(UNIX_PATH, BACKLOG)
+                self.unix_socket.settimeout(1.0)
+                threading.Thread(target=self.accept_loop, args=(self.unix_socket,),
+                                 daemon=True).start()
+                self.log(f"Also listening on unix:{UNIX_PATH}")
             self.log("Waiting for connections...")
 
             # start accepting connections in background
-            t = threading.Thread(target=self.accept_loop, daemon=True)
+            t = threading.Thread(target=self.accept_loop, args=(self.server_socket, self.tls),
+                                 daemon=True)
             t.start()
 
             self.status_label.config(text="Status: Running", fg="green")
 
         except Exception as e:
-            self.log(f"ERROR starting server: {e}")
+            self.log("ERROR starting server: {error}", level=chatlog.ERROR, error=e)
             self.status_label.config(text="Status: Error", fg="red")
 
-    def log(self, msg):
-        """puts a message in the queue so the gui can show it"""
-        self.msg_queue.put(msg)
+    def log(self, msg, event='server', level=chatlog.INFO, **fields):
+        """logs through chatlog, which ends up in the gui's queue
+
+        with fields, msg is a template filled in on the log thread (see chatlog.py)
+        """
+        chatlog.LOGGER.log(level, event, msg, **fields)
 
-    def accept_loop(self):
+    def accept_loop(self, server_socket, tls=None):
         while self.running:
             try:
-                conn, addr = self.server_socket.accept()
-                self.log(f"New connection from {addr}")
+                conn, addr = server_socket.accept()
+                addr = peer(addr)
+                reason = self.admission.admit(peer_address(addr))
+                if reason is not None:
+                    self.log("Turned away {addr}: {reason}", event='rejected',
+                             level=chatlog.WARNING, addr=addr, reason=reason)
+                    self.bouncer.reject(conn, reason)
+                    continue
+                enable_keepalive(conn)
+                self.log("New connection from {addr}", event='connect', addr=addr)
 
                 # new thread for each client
-                t = threading.Thread(target=self.handle_client,
-                                     args=(conn, addr), daemon=True)
+                t = threading.Thread(target=self.serve_client,
+                                     args=(conn, addr, tls), daemon=True)
                 t.start()
 
             except socket.timeout:
@@ -103,130 +253,242 @@ class ChatServer:
                 break
             except:
                 if self.running:
-                    self.log("Error accepting connection")
+                    self.log("Error accepting connection", level=chatlog.ERROR)
                 break
 
+    def serve_client(self, conn, addr, tls=None):
+        try:
+            if tls is not None:
+                conn = accept_tls(tls, conn, addr)  # on this client's thread, not accept_loop's
+                if conn is None:
+                    return
+            self.handle_client(conn, addr)
+        finally:
+            self.admission.release(peer_address(addr))
+
     def handle_client(self, conn, addr):
         client_name = None
+        reader = FrameReader(conn, BUFFER_SIZE)
+        writer = ClientWriter(conn, max_queue=MAX_QUEUE, policy=SLOW_POLICY,
+                              flush_bytes=FLUSH_BYTES, flush_delay=FLUSH_DELAY)
+        self.reaper.watch(writer)
         try:
             # first message should be their name
-            name_data = conn.recv(BUFFER_SIZE).decode('utf-8')
-            if not name_data:
+            hello = reader.read_view()
+            hello = decode_message(hello) if hello else None
+            if hello is None or hello.type != HELLO:
+                writer.close()  # the reaper watches it already, it has to see it is gone
                 conn.close()
                 return
 
-            client_name = name_data.strip()
+            client_name, options = parse_hello(hello.text)
             # print(f"DEBUG: got name = {client_name}")
+            if not client_name:
+                # a blank name counts as no hello (the cleanup couldnt remove "" again)
+                writer.close()
+                conn.close()
+                return
+            bucket = self.admission.bucket(time.monotonic())
 
-            with self.lock:
-                self.clients[client_name] = (conn, addr)
+            writer.name = client_name
+            writer.id = self.clients.senders.assign(client_name)
+            writer.known.add(writer.id)
+            writer.compress = wants_compression(options)
+            writer.start()
+            writer.send(encode_message(WELCOME, client_name, sender=writer.id))
+            self.clients.add(client_name, writer, start_room(options))  # usually the lobby
 
-            self.log(f"{client_name} has joined the chat! ({addr})")
+            self.log("{name} has joined the chat! ({addr})", event='join', name=client_name,
+                     addr=addr)
 
-            # tell everyone
-            self.broadcast(f"[Server] {client_name} has joined the chat!",
-                          skip=client_name)
+            # tell everyone in the room
+            self.broadcast(encode_message(JOINED, client_name, sender=writer.id),
+                          skip=client_name, room=self.clients.room(client_name))
+            self.history.send_catch_up(writer, self.clients.room(client_name),
+                                       int_option(options, 'since'), self.clients.senders)
 
             # update count label
-            with self.lock:
-                n = len(self.clients)
-            self.msg_queue.put(f"##COUNT##{n}")
+            self.msg_queue.put((EVENT_CLIENT_COUNT, len(self.clients)))
 
             # main receive loop
             while self.running:
                 try:
-                    data = conn.recv(BUFFER_SIZE).decode('utf-8')
-                    if not data:
+                    frame = reader.read_view()  # no copy, good until the next read
+                    if frame is None:
                         break  # disconnected
-
-                    # print(f"DEBUG: {client_name} says: {data}")
-
-                    msg = f"{client_name}: {data}"
-                    self.log(f"[Broadcast] {msg}")
-                    self.broadcast(msg)
+                    now = writer.last_seen = time.monotonic()
+                    msg = decode_message(frame)
+                    if msg.type == PONG:
+                        continue  # heartbeat
+                    metrics.MESSAGES_IN.inc()
+                    metrics.BYTES_IN.inc(len(frame))
+                    if msg.type == BYE:
+                        # before the rate limit, leaving always works
+                        writer.send(BYE_FRAME)  # goes out before the writer closes
+                        break
+                    if over_limit(bucket, writer, now):
+                        continue  # too fast, dropped (they get told once)
+
+                    # print(f"DEBUG: {client_name} says: {msg}")
+
+                    if msg.type == COMMAND:
+                        handle_command(self.clients, client_name, writer, msg.text,
+                                       self.broadcast, self.direct, self.history)
+                        continue
+                    if msg.type == OFFER:
+                        self.share_file(writer, client_name, msg.body)
+                        continue
+                    if msg.type != CHAT:
+                        continue
+
+                    room = self.clients.room(client_name)
+                    # copied once into the outgoing frame, decoded only by the log thread
+                    frame = relay_frame(CHAT, msg.body, sender=writer.id)
+                    self.log("[Broadcast #{room}] {name}: {text}", event='message', room=room,
+                             name=client_name, text=BodyText(frame))
+                    self.broadcast(frame, room=room, record=True)
 
                 except socket.timeout:
                     continue
                 except ConnectionResetError:
-                    self.log(f"Connection reset by {client_name}")
+                    self.log("Connection reset by {name}", event='reset', level=chatlog.WARNING,
+                             name=client_name)
                     break
                 except Exception as e:
-                    self.log(f"Error receiving from {client_name}: {e}")
+                    self.log("Error receiving from {name}: {error}", level=chatlog.ERROR,
+                             name=client_name, error=e)
                     break
 
         except Exception as e:
-            self.log(f"Error in handle_client: {e}")
+            self.log("Error in handle_client: {error}", level=chatlog.ERROR, error=e)
 
         # cleanup
+        writer.close()
         try:
             conn.close()
         except:
             pass
 
         if client_name:
-            with self.lock:
-                if client_name in self.clients:
-                    del self.clients[client_name]
-
-            self.log(f"{client_name} has left the chat.")
-            self.broadcast(f"[Server] {client_name} has left the chat.")
-
-            with self.lock:
-                n = len(self.clients)
-            self.msg_queue.put(f"##COUNT##{n}")
-
-    def broadcast(self, message, skip=None):
-        """send message to all connected clients"""
-        with self.lock:
-            # had to use dict instead of list here because of index issues
-            for name in list(self.clients.keys()):
-                if name == skip:
-                    continue
-                sock = self.clients[name][0]
-                try:
-                    sock.sendall(message.encode('utf-8'))
-                except:
-                    self.log(f"Couldnt send to {name}")
-                    # let the receive loop handle removing them
+            # None means someone reconnected with the same name in the meantime
+            room = self.clients.remove(client_name, writer)
+
+            self.log("{name} has left the chat.", event='leave', name=client_name)
+            if room is not None:
+                self.broadcast(encode_message(LEFT, client_name, sender=writer.id), room=room)
+
+            self.msg_queue.put((EVENT_CLIENT_COUNT, len(self.clients)))
+
+    def broadcast(self, frame, skip=None, room=None, record=False):
+        """send an encoded message to everyone in room (all connected clients if
+        room is None), record=True also keeps it in the room history
+
+        only queues the frame for each client's writer thread, nothing here
+        touches the network so the lock is held just long enough to copy the list
+        """
+        start = time.perf_counter()
+        if record and room is not None:
+            _, frame = self.history.record(room, frame)  # with its seq in it now
+        targets = self.clients.members(room, skip=skip)
+        if message_type(frame) in NAMED:
+            self.clients.senders.introduce(targets, sender_of(frame))
+        packed, saved = compressed_copy(frame, targets, COMPRESS_LEVEL, COMPRESS_MIN_SIZE)
+        for writer in targets:
+            if not writer.send(packed if writer.compress else frame):
+                self.log("Couldnt send to {name}", event='slow', level=chatlog.WARNING,
+                         name=writer.name)
+                # let the receive loop handle removing them
+        metrics.MESSAGES_OUT.inc(len(targets))
+        metrics.BYTES_OUT.inc(len(frame) * len(targets) - saved)
+        metrics.BROADCAST_SECONDS.observe(time.perf_counter() - start)
+
+    def share_file(self, writer, name, body):
+        """OFFER - the file is uploaded already, tell the room about it"""
+        frame = offer_frame(self.spool, body, writer.id) if self.spool is not None else None
+        if frame is None:
+            writer.send(notice("That file isnt on the server (or file sharing is off)."))
+            return
+        self.log("{name} shares a file", event='file', name=name)
+        self.broadcast(frame, skip=name, room=self.clients.room(name), record=True)
+
+    def direct(self, target, frame):
+        """private message, False if target isnt connected"""
+        writer = self.clients.get(target)
+        if writer is None:
+            return False
+        sender = sender_of(frame)
+        self.log("[DM] {name} -> {target}: {text}", event='dm',
+                 name=self.clients.senders.name(sender), target=target,
+                 text=BodyText(frame))
+        self.clients.senders.introduce((writer,), sender)
+        return writer.send(frame)
 
     def check_queue(self):
         """checks queue and updates GUI"""
-        while not self.msg_queue.empty():
+        # events - only the newest value of each matters (e.g. the client count)
+        latest = {}
+        while True:
             try:
-                msg = self.msg_queue.get_nowait()
-
-                if msg.startswith("##COUNT##"):
-                    count = msg.replace("##COUNT##", "")
-                    self.clients_label.config(text=f"Connected clients: {count}")
-                else:
-                    self.log_area.config(state='normal')
-                    self.log_area.insert(tk.END, msg + "\n")
-                    self.log_area.see(tk.END)
-                    self.log_area.config(state='disabled')
+                event, value = self.msg_queue.get_nowait()
             except queue.Empty:
                 break
+            latest[event] = value
+        for event, value in latest.items():
+            self.event_handlers[event](value)
+
+        self.show_log_lines()
 
         if self.running:
             self.master.after(100, self.check_queue)
 
+    def show_client_count(self, count):
+        self.clients_label.config(text=f"Connected clients: {count}")
+
+    def show_log_lines(self):
+        """adds everything logged since last time with one insert, keeps LOG_LINES"""
+        lines, dropped = self.log_sink.take()
+        now = time.monotonic()
+        elapsed, self.last_check = now - self.last_check, now
+        if not lines and not dropped:
+            return
+
+        args = []
+        if dropped:
+            rate = dropped / elapsed if elapsed > 0 else dropped
+            args += [f"... skipped {dropped} lines ({rate:.0f}/s), too busy to show them all\n",
+                     "skipped"]
+        if lines:
+            args += ["\n".join(lines) + "\n", ()]
+
+        self.log_area.config(state='normal')
+        self.log_area.insert(tk.END, *args)
+        # line count includes the empty last line, hence the -1
+        extra = int(self.log_area.index('end-1c').split('.')[0]) - 1 - LOG_LINES
+        if extra > 0:
+            self.log_area.delete('1.0', f'{extra + 1}.0')
+        self.log_area.see(tk.END)
+        self.log_area.config(state='disabled')
+
     def on_closing(self):
         self.running = False
 
         # close all client sockets
-        with self.lock:
-            for name in self.clients:
-                try:
-                    self.clients[name][0].close()
-                except:
-                    pass
-            self.clients.clear()
+        for writer in self.clients.all_connections():
+            try:
+                writer.sock.close()
+            except:
+                pass
+        self.clients.clear()
 
         if self.server_socket:
             try:
                 self.server_socket.close()
             except:
                 pass
+        if self.unix_socket:
+            close_unix(self.unix_socket, UNIX_PATH)
 
+        chatlog.LOGGER.close()
         self.master.destroy()
 
 
@@ -0,0 +1,236 @@
+"""
+Where the servers listen and the clients connect - tcp, or a unix socket for
+programs on the same machine as the server
+
+    python chat_server.py --unix /tmp/chat.sock     (tcp as usual, plus the socket)
+    python chat_client.py --host unix:/tmp/chat.sock
+
+A unix socket skips the whole tcp/ip stack (no checksums, acks, windows or
+loopback interface, the kernel just moves the bytes to the other socket), so
+bots running next to the server get their messages sooner and cost both
+ends less cpu - see chat_bench.py --compare-transports. Past accept() both
+kinds of connection are the same, they end up in the same registry and
+rooms, and get the same limits.
+
+Addresses: a host starting with "unix:" is a socket path (the port is
+ignored), anything else is a normal tcp host.
+
+TLS, for tcp connections that leave the machine:
+
+    python chat_server.py --tls-cert cert.pem --tls-key key.pem
+    python chat_client.py --tls --cafile cert.pem
+
+The certificate is loaded once at startup (server_context()), not per
+connection. The handshake is the expensive part (key exchange, signing), so
+it never runs on the thread that calls accept() - the thread engines do it
+on the client's own thread (accept_tls()), the asyncio engine lets the
+loop do it without blocking. The client contexts from client_context()
+remember the last session and offer it on the next connect, the server
+then resumes it with a session ticket instead of sending and signing with
+its certificate again - a reconnect costs a lot less. Unix sockets stay
+plain, they never leave the machine.
+"""
+
+import asyncio
+import errno
+import os
+import socket
+import ssl
+import stat
+import time
+
+import chatlog
+import metrics
+
+UNIX_PREFIX = 'unix:'
+# what unix socket clients are called in the logs. the per address limits
+# (see admission.py) count all of them as this one address, like 127.0.0.1
+UNIX_PEER = 'unix'
+LOCALHOST = '127.0.0.1'
+
+HANDSHAKE_TIMEOUT = 10.0    # seconds a client gets for the tls handshake
+TLS_TICKETS = 2             # tls 1.3 session tickets the server hands out per handshake
+
+
+def is_unix(host):
+    return host.startswith(UNIX_PREFIX)
+
+
+def unix_path(host):
+    return host[len(UNIX_PREFIX):]
+
+
+def connect(host, port, timeout=None, tls=None):
+    """a connected socket to host:port, or to the socket of a unix: address.
+    tls is a client_context() for tcp, unix sockets ignore it"""
+    if not is_unix(host):
+        sock = socket.create_connection((host, port), timeout)
+        if tls is None:
+            return sock
+        try:
+            return tls.wrap_socket(sock, server_hostname=host)
+        except:
+            sock.close()
+            raise
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(unix_path(host))
+    except:
+        sock.close()
+        raise
+    return sock
+
+
+async def open_connection(host, port, tls=None):
+    """asyncio.open_connection() that takes unix: addresses too"""
+    if is_unix(host):
+        return await asyncio.open_unix_connection(unix_path(host))
+    return await asyncio.open_connection(host, port, ssl=tls)
+
+
+def tcp_host(host):
+    """host for the things that are tcp only (the file port). a unix socket
+    server is on this machine, so that is localhost"""
+    return LOCALHOST if is_unix(host) else host
+
+
+def remove_stale(path):
+    """deletes a socket file nobody listens on anymore (a server that crashed
+    leaves it behind, and bind() fails while it is there)"""
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return  # not a socket, let bind() complain about it
+    except FileNotFoundError:
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.unlink(path)  # nobody home
+    else:
+        raise OSError(errno.EADDRINUSE, f"a server is already listening on {path}")
+    finally:
+        probe.close()
+
+
+def listen_unix(path, backlog):
+    """a listening unix socket at path"""
+    remove_stale(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        sock.listen(backlog)
+    except:
+        sock.close()
+        raise
+    return sock
+
+
+def close_unix(sock, path):
+    """closes a listener from listen_unix() and removes its socket file"""
+    sock.close()
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def peer(addr):
+    """the address accept() gave us, for the logs - unix clients dont have one"""
+    return addr or UNIX_PEER
+
+
+def peer_address(addr):
+    """what the per address limits count: the ip, or UNIX_PEER"""
+    return addr[0] if isinstance(addr, tuple) else UNIX_PEER
+
+
+# --- tls ---
+
+def server_context(certfile, keyfile=None):
+    """the server's tls settings with its certificate, made once at startup"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.num_tickets = TLS_TICKETS  # tls 1.2 tickets are on by default too
+    return context
+
+
+def accept_tls(context, sock, addr, timeout=HANDSHAKE_TIMEOUT):
+    """the server side handshake for an accepted socket, on the calling thread
+    (the client's, never the accept thread - one slow client would hold up
+    every connect). returns the SSLSocket, None if it failed (sock is closed)"""
+    start = time.perf_counter()
+    try:
+        sock.settimeout(timeout)  # a client that never finishes it cant keep the thread
+        tls_sock = context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+    except OSError as e:
+        sock.close()
+        return _handshake_failed(addr, e)
+    try:
+        tls_sock.do_handshake()
+        tls_sock.settimeout(None)
+    except OSError as e:  # ssl.SSLError and socket.timeout are OSErrors
+        tls_sock.close()
+        return _handshake_failed(addr, e)
+    metrics.TLS_HANDSHAKE_SECONDS.observe(time.perf_counter() - start)
+    count_handshake(tls_sock)
+    return tls_sock
+
+
+def _handshake_failed(addr, error):
+    metrics.TLS_FAILURES.inc()
+    chatlog.warning('tls', "[!] tls handshake with {addr} failed: {error}", addr=addr, error=error)
+    return None
+
+
+def count_handshake(ssl_object):
+    metrics.TLS_HANDSHAKES.inc()
+    if ssl_object.session_reused:
+        metrics.TLS_RESUMED.inc()
+
+
+class ClientContext(ssl.SSLContext):
+    """an ssl.SSLContext that offers the last session it saw (remember()) to
+    the next connection, for sockets (wrap_socket) and asyncio (wrap_bio)
+    alike. a session is only good with the context it came from"""
+
+    session = None
+
+    def wrap_socket(self, sock, *args, session=None, **kwargs):
+        return super().wrap_socket(sock, *args, session=session or self.session, **kwargs)
+
+    def wrap_bio(self, incoming, outgoing, *args, session=None, **kwargs):
+        return super().wrap_bio(incoming, outgoing, *args, session=session or self.session,
+                                **kwargs)
+
+    def remember(self, ssl_object):
+        """keeps the session of a connection (an SSLSocket or SSLObject) for
+        the next one. call it once something was read - tls 1.3 tickets only
+        come after the handshake"""
+        if ssl_object is not None and ssl_object.session is not None:
+            self.session = ssl_object.session
+
+
+def client_context(cafile=None, verify=True):
+    """tls settings for a client. cafile to trust a self-signed server
+    certificate, verify=False to trust anything (testing only)"""
+    context = ClientContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif cafile:
+        context.load_verify_locations(cafile)
+    else:
+        context.load_default_certs()
+    return context
+
+
+def remember_session(context, ssl_object):
+    """ClientContext.remember() for any context and connection (a plain
+    socket or None is fine, there is just nothing to keep then)"""
+    if isinstance(context, ClientContext) and isinstance(ssl_object, (ssl.SSLSocket,
+                                                                      ssl.SSLObject)):
+        context.remember(ssl_object)